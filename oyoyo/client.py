@@ -15,6 +15,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
+import collections
+import random
 import socket
 import ssl
 import sys
@@ -23,7 +26,9 @@ import time
 import traceback
 import os
 
-from oyoyo.parse import parse_raw_irc_command
+from oyoyo.parse import parse_message, decode
+from oyoyo.sendqueue import SendQueue
+from oyoyo.split import line_budget, pack
 
 
 # Adapted from http://code.activestate.com/recipes/511490-implementation-of-the-token-bucket-algorithm/
@@ -49,6 +54,11 @@ class TokenBucket(object):
             return True
         return False
 
+    def delay(self, tokens=1):
+        """Return how many seconds it will take until the given amount
+        of tokens is available."""
+        return max(0.0, (tokens - self.tokens) / self.fill_rate)
+
     @property
     def tokens(self):
         now = time.time()
@@ -61,6 +71,151 @@ class TokenBucket(object):
     def __repr__(self):
         return "{self.__class__.__name__}(capacity={self.capacity}, fill rate={self.fill_rate}, tokens={self.tokens})".format(self=self)
 
+class AdaptiveTokenBucket(TokenBucket):
+    """A token bucket which adjusts its capacity and fill rate at runtime.
+
+    It starts from the given values and stays within the given bounds,
+    which default to the starting values (making it a plain TokenBucket).
+    The owner reports what it observes from the server:
+
+    - report_lag(seconds) with the round-trip time of a PING; a lag above
+      lag_high means the server is holding back our lines, so the limits
+      are lowered, and a lag below lag_low raises them slowly again (up to
+      the max bounds), unless we were throttled less than cooldown seconds
+      ago;
+    - report_throttle() when the server says we are flooding, which halves
+      the limits and empties the bucket.
+
+    >>> bucket = AdaptiveTokenBucket(23, 1.73, min_tokens=5, min_fill_rate=0.5)
+    >>> bucket.report_throttle()
+    >>> bucket.capacity, bucket.fill_rate
+    (11.5, 0.865)
+    """
+    def __init__(self, tokens, fill_rate, *, min_tokens=None, max_tokens=None,
+                 min_fill_rate=None, max_fill_rate=None, lag_high=2.0,
+                 lag_low=0.5, cooldown=300):
+        super().__init__(tokens, fill_rate)
+        self.min_capacity = float(tokens if min_tokens is None else min_tokens)
+        self.max_capacity = float(tokens if max_tokens is None else max_tokens)
+        self.min_fill_rate = float(fill_rate if min_fill_rate is None else min_fill_rate)
+        self.max_fill_rate = float(fill_rate if max_fill_rate is None else max_fill_rate)
+        self.lag_high = lag_high
+        self.lag_low = lag_low
+        self.cooldown = cooldown
+        self.lag = None # smoothed round-trip time
+        self.last_throttle = 0
+        self.throttle_count = 0
+
+    def _set_limits(self, capacity, fill_rate):
+        self.tokens # account for the tokens gained at the old rate
+        self.capacity = min(self.max_capacity, max(self.min_capacity, capacity))
+        self.fill_rate = min(self.max_fill_rate, max(self.min_fill_rate, fill_rate))
+        self._tokens = min(self._tokens, self.capacity)
+
+    def report_lag(self, lag):
+        """Feed a PING round-trip time (in seconds) into the model."""
+        if self.lag is None:
+            self.lag = lag
+        else:
+            self.lag = 0.7 * self.lag + 0.3 * lag
+
+        if self.lag > self.lag_high:
+            self._set_limits(self.capacity * 0.75, self.fill_rate * 0.75)
+        elif self.lag < self.lag_low and time.time() - self.last_throttle > self.cooldown:
+            step = max(0.05, (self.max_fill_rate - self.min_fill_rate) / 20)
+            self._set_limits(self.capacity + 1, self.fill_rate + step)
+
+    def report_throttle(self):
+        """Tell the model that the server complained about flooding."""
+        self.last_throttle = time.time()
+        self.throttle_count += 1
+        self._set_limits(self.capacity / 2, self.fill_rate / 2)
+        self._tokens = 0.0
+
+    def __repr__(self):
+        return ("{self.__class__.__name__}(capacity={self.capacity}, fill rate={self.fill_rate}, "
+                "tokens={self.tokens}, lag={self.lag}, throttled={self.throttle_count})").format(self=self)
+
+class LineBuffer(object):
+    """A receive buffer which frames incoming data into lines.
+
+    Data is read straight into a preallocated bytearray (with recv_into()
+    or feed()), and only the part that was not scanned yet is searched for
+    line endings. Complete lines are handed out without their line ending;
+    a partial line stays in the buffer until the rest of it arrives.
+
+    >>> buf = LineBuffer(8192)
+    >>> buf.recv_into(sock)
+    >>> for line in buf.lines():
+    ...     parse_message(line)
+    """
+    def __init__(self, size=8192):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # beginning of the first incomplete line
+        self._end = 0 # end of the received data
+        self._scan = 0 # where to resume looking for a line ending
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """Make sure at least size bytes can be written at the end."""
+        if len(self._buf) - self._end >= size:
+            return
+
+        pending = self._end - self._start
+        if pending + size > len(self._buf):
+            # a line larger than the buffer; grow it
+            new = bytearray(max(len(self._buf) * 2, pending + size))
+            new[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buf = new
+            self._view = memoryview(new)
+        else:
+            self._buf[:pending] = self._buf[self._start:self._end]
+
+        self._scan -= self._start
+        self._start = 0
+        self._end = pending
+
+    def recv_into(self, sock, size=None):
+        """Receive up to size bytes from sock directly into the buffer.
+        Returns the number of bytes received (0 means EOF)."""
+        if size is None:
+            size = len(self._buf) // 2
+        self._reserve(size)
+        received = sock.recv_into(self._view[self._end:self._end + size])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Append already received data to the buffer."""
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def lines(self):
+        """Return the complete lines in the buffer, as a list.
+
+        All of them are cut at once (rather than one at a time), since a
+        single read usually holds many lines. Lines may end with CR LF,
+        LF or a bare CR, as RFC 1459 asks clients to accept either; empty
+        lines may be left out.
+
+        """
+        last = self._buf.rfind(b"\n", self._scan, self._end)
+        if last < 0:
+            self._scan = self._end
+            return []
+
+        start = self._start
+        self._start = self._scan = last + 1
+        if self._start == self._end: # everything was consumed; rewind for free
+            self._start = self._end = self._scan = 0
+
+        return self._view[start:last].tobytes().splitlines()
+
 class IRCClient:
     """ IRC Client class. This handles one connection to a server.
     This can be used either with or without IRCApp ( see connect() docs )
@@ -83,6 +238,39 @@ class IRCClient:
         Warning: By default this class will not block on socket operations, this
         means if you use a plain while loop your app will consume 100% cpu.
         To enable blocking pass blocking=True.
+
+        Passing use_asyncio=True makes mainLoop() run the connection on an
+        asyncio event loop instead; see connect_async() for details.
+
+        With use_ssl, both ways of connecting use the same SSL context,
+        ssl_context, which is created on first use unless one is given. It
+        verifies the server's certificate and hostname, unless ssl_verify
+        is False.
+
+        Incoming data is read recv_size bytes at a time.
+
+        Log output goes to stream_handler(output, level). If stream_filter
+        is given, it is called with the level first, and the message is
+        only formatted and passed on if it returns a true value. Setting
+        raw_history_size keeps the last that many raw lines (both ways) in
+        self.raw_history; see dump_raw_history().
+
+        Outgoing messages are queued in self.send_queue (see
+        oyoyo.sendqueue.SendQueue), which holds at most send_queue_size
+        messages, and are written out by a dedicated writer. Tagged
+        messages identical to one queued at most merge_window seconds
+        earlier are merged into it.
+
+        If reconnect is set, mainLoop() connects again whenever the
+        connection is lost (unless quit() was called), waiting
+        reconnect_delay seconds before the first attempt and doubling that
+        (up to reconnect_max_delay, with random jitter) after each attempt
+        which did not get registered. connect_cb is only called for the
+        first connection, and disconnect_cb(client) is called each time the
+        connection is lost before reconnecting. Whatever was still queued
+        is dropped when registering again. If read_timeout is also set, the
+        connection is considered lost when nothing was received for that
+        many seconds; without reconnect, reads wait for as long as it takes.
         """
 
         self.socket = None
@@ -98,15 +286,64 @@ class IRCClient:
         self.blocking = True
         self.sasl_auth = False
         self.use_ssl = False
+        self.ssl_verify = True
+        self.ssl_context = None
         self.server_pass = None
+        self.use_asyncio = False
+        self.send_queue_size = 1000
+        self.merge_window = 5
+        self.recv_size = 16384
+        self.loop = None
         self.lock = threading.RLock()
         self.stream_handler = lambda output, level=None: print(output)
+        self.stream_filter = None
+        self.raw_history_size = 0
+        self.reconnect = False
+        self.reconnect_delay = 5
+        self.reconnect_max_delay = 300
+        self.read_timeout = None
+        self.disconnect_cb = None
 
-        self.tokenbucket = TokenBucket(23, 1.73)
+        self.tokenbucket = AdaptiveTokenBucket(23, 1.73)
 
         self.__dict__.update(kwargs)
         self.command_handler = cmd_handler
         self._end = 0
+        self.send_queue = SendQueue(self.send_queue_size, merge_window=self.merge_window)
+        self.raw_history = None
+        if self.raw_history_size:
+            self.raw_history = collections.deque(maxlen=self.raw_history_size)
+        self._sending = False
+        self._reader = None
+        self._writer = None
+        self._wakeup = None
+        self._loop_thread = None
+        self.message_tags = {}
+        self.quitting = False
+        self.connections = 0 # number of connections which got registered
+        self._registered = False
+        self._attempts = 0
+
+    def log_enabled(self, level="normal"):
+        """ return True if a log message of the given level would be written. """
+        return self.stream_filter is None or self.stream_filter(level)
+
+    def log(self, level, output, *args):
+        """ pass output.format(*args) to the stream handler. The message is
+        only formatted if the stream filter accepts its level.
+        """
+        if self.stream_filter is None or self.stream_filter(level):
+            self.stream_handler(output.format(*args), level=level)
+
+    def dump_raw_history(self, file):
+        """ write the recorded raw lines to file, which must be opened in
+        binary mode. Each line is prefixed with a UNIX timestamp and the
+        direction ('<' for received, '>' for sent).
+        """
+        if self.raw_history is None:
+            return
+        for ts, direction, line in list(self.raw_history):
+            file.write("{0:.3f} {1} ".format(ts, direction).encode("ascii") + line + b"\n")
 
     def __enter__(self):
         return self
@@ -127,7 +364,26 @@ class IRCClient:
         In python 3, all args must be of type str or bytes, *BUT* if they are
           str they will be converted to bytes with the encoding specified by the
           'encoding' keyword argument (default 'utf8').
+
+        The message is queued and this returns immediately. The priority
+        keyword argument selects the queue lane (see oyoyo.sendqueue); it is
+        guessed from the command and target if not given. The tag keyword
+        argument marks the message as one which may become stale before it
+        is sent; see cancel_queued().
         """
+        self._enqueue(self._build_message(args, kwargs), kwargs.get("priority"), tag=kwargs.get("tag"))
+
+    async def asend(self, *args, **kwargs):
+        """ asyncio counterpart of send(). The arguments are the same, but
+        the returned coroutine only completes once the message has been
+        handed over to the transport. This may only be used from within the
+        event loop running connect_async().
+        """
+        future = self.loop.create_future()
+        self._enqueue(self._build_message(args, kwargs), kwargs.get("priority"), future, kwargs.get("tag"))
+        await future
+
+    def _build_message(self, args, kwargs):
         with self.lock:
             # Convert all args to bytes if not already
             encoding = kwargs.get('encoding') or 'utf_8'
@@ -145,11 +401,171 @@ class IRCClient:
                                                                    for arg in args]), i))
 
             msg = bytes(" ", "utf_8").join(bargs)
-            self.stream_handler('---> send {0}'.format(str(msg)[1:]))
+            if self.log_enabled():
+                self.stream_handler('---> send {0}'.format(str(msg)[1:]))
+            return msg
+
+    def _drop_queued(self):
+        """ drop everything still queued, e.g. what was sent while the
+        client was disconnected, and cancel the futures waiting on it.
+        """
+        dropped = self.send_queue.clear()
+        for msg, future in dropped:
+            if future is not None:
+                future.cancel()
+        if dropped:
+            self.log("warning", "Dropped {0} queued message{1}", len(dropped), "" if len(dropped) == 1 else "s")
+
+    def cancel_queued(self, function):
+        """ drop or rewrite the tagged messages which are still queued.
+        function(message, tag) is called for each of them, and returns the
+        message (as bytes) to send instead, or None to drop it. Return how
+        many messages were dropped.
+        """
+        dropped = self.send_queue.filter(function)
+        for msg, future in dropped:
+            if future is not None:
+                self.loop.call_soon_threadsafe(future.cancel)
+        return len(dropped)
+
+    def _enqueue(self, msg, priority=None, future=None, tag=None):
+        dropped = self.send_queue.put(msg, priority, future, tag)
+        if dropped is not None:
+            msg, future = dropped
+            self.log("warning", "Send queue full, dropping {0!r}", msg)
+            if future is not None:
+                self.loop.call_soon_threadsafe(future.cancel)
+
+    def _take_batch(self):
+        """ pop the next queued line, for which a token was already taken,
+        and as many of the following ones as the token bucket allows right
+        now. Return the lines joined into one bytes object (with their line
+        endings) and the futures of the lines.
+        """
+        lines = []
+        futures = []
+        item = self.send_queue.get_nowait()
+        while item is not None:
+            msg, future = item
+            lines.append(msg)
+            if future is not None:
+                futures.append(future)
+            if self.raw_history is not None:
+                self.raw_history.append((time.time(), ">", msg))
+            if not self.send_queue or not self.tokenbucket.consume(1):
+                break
+            item = self.send_queue.get_nowait()
+
+        if not lines:
+            return None, futures
+        lines.append(b"")
+        return bytes("\r\n", "utf_8").join(lines), futures
+
+    def _write_thread(self, sock):
+        while self._sending and self.socket is sock:
+            if not self.send_queue.wait(1):
+                continue
+            while not self.tokenbucket.consume(1):
+                time.sleep(self.tokenbucket.delay(1))
+            data, futures = self._take_batch()
+            if data is None or not self._sending or self.socket is not sock:
+                continue
+            try:
+                with self.lock:
+                    sock.sendall(data)
+            except socket.error as e:
+                self.log("warning", "Error: {0}", e)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR) # wake up the reader
+                except socket.error:
+                    pass
+                return
 
+    async def _write_loop(self):
+        while True:
+            if not self.send_queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
             while not self.tokenbucket.consume(1):
-                time.sleep(0.3)
-            self.socket.send(msg + bytes("\r\n", "utf_8"))
+                await asyncio.sleep(self.tokenbucket.delay(1))
+            data, futures = self._take_batch()
+            if data is None:
+                continue
+            try:
+                self._writer.write(data)
+                await self._writer.drain()
+            except ConnectionError as e:
+                self.log("warning", "Error: {0}", e)
+                self._writer.close() # the reader will see the connection closing
+                for future in futures:
+                    future.cancel()
+                return
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+    def call_later(self, delay, func, *args):
+        """ call func(*args) after delay seconds, and return an object with a
+        cancel() method. When the client runs on an event loop and this is
+        called from within it, the call is scheduled on the loop; otherwise a
+        daemon threading.Timer is used.
+        """
+        if self.loop is not None and threading.get_ident() == self._loop_thread:
+            return self.loop.call_later(delay, func, *args)
+
+        t = threading.Timer(delay, func, args=args)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _register(self):
+        self._drop_queued()
+        self.send("CAP LS 302")
+
+        if (self.server_pass and "{password}" in self.server_pass
+                and self.password and not self.sasl_auth):
+            message = "PASS :{0}".format(self.server_pass).format(
+                account=self.authname if self.authname else self.nickname,
+                password=self.password)
+            self.send(message)
+
+        self.send("NICK", self.nickname)
+        self.user(self.ident, self.real_name)
+
+        if self.connect_cb and not self.connections:
+            try:
+                self.connect_cb(self)
+            except Exception as e:
+                sys.stderr.write(traceback.format_exc())
+                raise e
+
+    def _process_line(self, el):
+        if not el:
+            return
+
+        if self.raw_history is not None:
+            self.raw_history.append((time.time(), "<", el))
+
+        tags, prefix, command, args = parse_message(el)
+
+        try:
+            fargs = [decode(arg) for arg in args]
+            if prefix is not None:
+                prefix = decode(prefix)
+            self.message_tags = tags # IRCv3 tags of the message being handled
+            if command == "welcome" and not self._registered:
+                self._registered = True
+                self.connections += 1
+            if self.log_enabled("debug"):
+                self.stream_handler("<--- receive {0} {1} ({2})".format(prefix, command, ", ".join(fargs)), level="debug")
+            if command in self.command_handler:
+                self.command_handler[command](self, prefix,*fargs)
+            elif "" in self.command_handler:
+                self.command_handler[""](self, prefix, command, *fargs)
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc())
+            raise e  # ?
 
     def connect(self):
         """ initiates the connection to the server set in self.host:self.port
@@ -166,106 +582,149 @@ class IRCClient:
             while True:
                 try:
                     self.socket = socket.create_connection(("{0}".format(self.host), self.port))
+                    if self.use_ssl:
+                        self.socket = self.get_ssl_context().wrap_socket(self.socket, server_hostname=self.host)
                     break
-                except socket.error as e:
+                except (socket.error, ssl.SSLError) as e:
                     retries += 1
-                    self.stream_handler('Error: {0}'.format(e), level="warning")
+                    self.log("warning", "Error: {0}", e)
+                    if self.reconnect:
+                        return # mainLoop() will try again later
                     if retries > 3:
                         sys.exit(1)
 
-            if self.use_ssl:
-                self.socket = ssl.wrap_socket(self.socket)
-
             if not self.blocking:
                 self.socket.setblocking(0)
+            elif self.read_timeout and self.reconnect:
+                self.socket.settimeout(self.read_timeout)
 
-            self.send("CAP LS 302")
-
-            if (self.server_pass and "{password}" in self.server_pass
-                    and self.password and not self.sasl_auth):
-                message = "PASS :{0}".format(self.server_pass).format(
-                    account=self.authname if self.authname else self.nickname,
-                    password=self.password)
-                self.send(message)
+            self._sending = True
+            threading.Thread(target=self._write_thread, args=(self.socket,), name="IRCClient writer", daemon=True).start()
 
-            self.send("NICK", self.nickname)
-            self.user(self.ident, self.real_name)
+            self._register()
 
-            if self.connect_cb:
-                try:
-                    self.connect_cb(self)
-                except Exception as e:
-                    sys.stderr.write(traceback.format_exc())
-                    raise e
-
-            buffer = bytes()
+            buffer = LineBuffer(self.recv_size * 2)
             while not self._end:
                 try:
-                    buffer += self.socket.recv(1024)
+                    received = buffer.recv_into(self.socket, self.recv_size)
                 except socket.error as e:
                     if False and not self.blocking and e.errno == 11:
                         pass
+                    elif self.reconnect:
+                        self.log("warning", "Error: {0}", e)
+                        break
                     else:
                         sys.stderr.write(traceback.format_exc())
                         raise e
                 else:
-                    data = buffer.split(bytes("\n", "utf_8"))
-                    buffer = data.pop()
-
-                    for el in data:
-                        prefix, command, args = parse_raw_irc_command(el)
-
-                        try:
-                            enc = "utf8"
-                            fargs = [arg.decode(enc) for arg in args if isinstance(arg,bytes)]
-                        except UnicodeDecodeError:
-                            enc = "latin1"
-                            fargs = [arg.decode(enc) for arg in args if isinstance(arg,bytes)]
-
-                        try:
-                            largs = list(args)
-                            if prefix is not None:
-                                prefix = prefix.decode(enc)
-                            self.stream_handler("<--- receive {0} {1} ({2})".format(prefix, command, ", ".join(fargs)), level="debug")
-                            # for i,arg in enumerate(largs):
-                                # if arg is not None: largs[i] = arg.decode(enc)
-                            if command in self.command_handler:
-                                self.command_handler[command](self, prefix,*fargs)
-                            elif "" in self.command_handler:
-                                self.command_handler[""](self, prefix, command, *fargs)
-                        except Exception as e:
-                            sys.stderr.write(traceback.format_exc())
-                            raise e  # ?
+                    if not received: # connection closed by the server
+                        break
+
+                    for el in buffer.lines():
+                        self._process_line(el)
                 yield True
         finally:
+            self._sending = False
+            self.send_queue.wake()
             if self.socket:
                 self.stream_handler('closing socket')
                 self.socket.close()
-                yield False
-    def msg(self, user, msg):
-        for line in msg.split('\n'):
-            maxchars = 494 - len(self.nickname+self.ident+self.hostmask+user)
-            while line:
-                extra = ""
-                if len(line) > maxchars:
-                    extra = line[maxchars:]
-                    line = line[:maxchars]
-                self.send("PRIVMSG", user, ":{0}".format(line))
-                line = extra
+                if sys.exc_info()[0] is None: # don't swallow exceptions such as SystemExit
+                    yield False
+
+    def get_ssl_context(self):
+        """ return the SSL context used to connect, creating it the first
+        time. It is shared by connect() and connect_async(), so that both
+        check the server's certificate the same way.
+        """
+        if self.ssl_context is None:
+            context = ssl.create_default_context()
+            if not self.ssl_verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self.ssl_context = context
+        return self.ssl_context
+
+    async def connect_async(self):
+        """ asyncio counterpart of connect(). This opens the connection to
+        self.host:self.port with asyncio streams and returns once it is
+        closed. Reading, handler dispatch and writing all happen on the
+        running event loop; send() may still be called from any thread, it
+        only queues the message for the writer task.
+
+        >>> cli = IRCClient(my_handler, host="irc.freenode.net", port=6667)
+        >>> asyncio.get_event_loop().run_until_complete(cli.connect_async())
+
+        """
+        self.loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self.send_queue.notify = lambda: self.loop.call_soon_threadsafe(self._wakeup.set)
+
+        writer_task = None
+        self._reader = self._writer = None
+        try:
+            retries = 0
+            while True:
+                try:
+                    self._reader, self._writer = await asyncio.open_connection(
+                        "{0}".format(self.host), self.port,
+                        ssl=self.get_ssl_context() if self.use_ssl else None)
+                    break
+                except (socket.error, ssl.SSLError) as e:
+                    retries += 1
+                    self.log("warning", "Error: {0}", e)
+                    if self.reconnect:
+                        return # mainLoop() will try again later
+                    if retries > 3:
+                        sys.exit(1)
+
+            self.socket = self._writer.get_extra_info("socket")
+            writer_task = self.loop.create_task(self._write_loop())
+
+            self._register()
+
+            read_timeout = self.read_timeout if self.reconnect else None
+            buffer = LineBuffer(self.recv_size * 2)
+            while not self._end:
+                try:
+                    received = await asyncio.wait_for(self._reader.read(self.recv_size), read_timeout)
+                except (socket.error, asyncio.TimeoutError) as e:
+                    if self.reconnect:
+                        self.log("warning", "Error: {0}", str(e) or "read timed out")
+                        break
+                    sys.stderr.write(traceback.format_exc())
+                    raise e
+
+                if not received: # connection closed by the server
+                    break
+
+                buffer.feed(received)
+                for el in buffer.lines():
+                    self._process_line(el)
+
+                await asyncio.sleep(0) # give the writer a chance to run
+        finally:
+            if writer_task is not None:
+                writer_task.cancel()
+            self.send_queue.notify = None
+            if self._writer is not None:
+                self.stream_handler('closing socket')
+                self._writer.close()
+            self.loop = None
+    def msg(self, user, msg, tag=None):
+        budget = line_budget(self.nickname, self.ident, self.hostmask, "PRIVMSG", user)
+        for line in pack((msg,), "", budget):
+            self.send("PRIVMSG", user, ":" + line, tag=tag)
     privmsg = msg  # Same thing
-    def notice(self, user, msg):
-        for line in msg.split('\n'):
-            maxchars = 495 - len(self.nickname+self.ident+self.hostmask+user)
-            while line:
-                extra = ""
-                if len(line) > maxchars:
-                    extra = line[maxchars:]
-                    line = line[:maxchars]
-                self.send("NOTICE", user, ":{0}".format(line))
-                line = extra
+    def notice(self, user, msg, tag=None):
+        budget = line_budget(self.nickname, self.ident, self.hostmask, "NOTICE", user)
+        for line in pack((msg,), "", budget):
+            self.send("NOTICE", user, ":" + line, tag=tag)
     def join(self, channel):
         self.send("JOIN {0}".format(channel))
     def quit(self, msg=""):
+        self.quitting = True
         self.send("QUIT :{0}".format(msg))
     def part(self, chan, msg=""):
         self.send("PART {0} :{1}".format(chan, msg))
@@ -289,9 +748,131 @@ class IRCClient:
             self.msg(nickserv, command.format(nick=nick, password=password))
     def user(self, ident, rname):
         self.send("USER", ident, self.host, self.host, ":{0}".format(rname or ident))
+    def _reconnect_delay(self):
+        """ return how many seconds to wait before connecting again after
+        the connection was lost, or None if the client should not reconnect.
+        """
+        if not self.reconnect or self.quitting:
+            return None
+        if self._registered: # the last connection worked; start over
+            self._attempts = 0
+        self._registered = False
+
+        delay = min(self.reconnect_max_delay, self.reconnect_delay * 2 ** self._attempts)
+        self._attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def _disconnected(self):
+        """ called after the connection was lost. Return how long to wait
+        before reconnecting, or None to stop.
+        """
+        registered = self._registered
+        delay = self._reconnect_delay()
+        if delay is None:
+            return None
+        if self.disconnect_cb and registered:
+            try:
+                self.disconnect_cb(self)
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+        self.log("warning", "Reconnecting in {0:.1f} seconds", delay)
+        return delay
+
+    async def _supervise(self):
+        while True:
+            await self.connect_async()
+            delay = self._disconnected()
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
     def mainLoop(self):
-        conn = self.connect()
+        if self.use_asyncio:
+            manager = ConnectionManager()
+            manager.add(self)
+            manager.run()
+            self.stream_handler("Calling sys.exit()...", level="warning")
+            sys.exit()
+
         while True:
-            if not next(conn):
+            conn = self.connect()
+            for connected in conn:
+                if not connected:
+                    break
+            conn.close()
+
+            delay = self._disconnected()
+            if delay is None:
                 self.stream_handler("Calling sys.exit()...", level="warning")
                 sys.exit()
+            time.sleep(delay)
+
+
+class ConnectionManager:
+    """ run IRCClient instances on an asyncio event loop, connecting each
+    one again as its reconnect settings say. This is what mainLoop() uses
+    when use_asyncio is set.
+
+    >>> manager = ConnectionManager()
+    >>> manager.add(IRCClient(my_handler, host="irc.freenode.net", port=6667))
+    >>> manager.run()
+
+    run() returns once all of the clients are done, that is, once they
+    quit or gave up reconnecting. Clients can also be added while it runs;
+    they share the loop, but each keeps its own send queue and flood
+    control. The bot itself only ever runs one client: its game state is
+    not kept per connection.
+    """
+
+    def __init__(self):
+        self.clients = []
+        self.loop = None
+        self._tasks = {}
+        self._changed = None
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.clients!r})".format(self=self)
+
+    def add(self, client):
+        """ add a client, and start it if the manager is already running.
+        The client is switched over to asyncio if it was not using it.
+        """
+        client.use_asyncio = True
+        self.clients.append(client)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._start, client)
+        return client
+
+    def _start(self, client):
+        self._tasks[client] = self.loop.create_task(client._supervise())
+        self._changed.set()
+
+    async def _run(self):
+        self._changed = asyncio.Event()
+        for client in self.clients:
+            self._start(client)
+
+        while self._tasks:
+            self._changed.clear()
+            waiter = self.loop.create_task(self._changed.wait())
+            done, pending = await asyncio.wait(list(self._tasks.values()) + [waiter],
+                                               return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            for client, task in list(self._tasks.items()):
+                if task not in done:
+                    continue
+                del self._tasks[client]
+                self.clients.remove(client)
+                if not task.cancelled() and task.exception() is not None:
+                    exc = task.exception()
+                    sys.stderr.write("".join(traceback.format_exception(type(exc), exc, exc.__traceback__)))
+
+    def run(self):
+        """ run all the clients until they are done. """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+            self.loop = None
@@ -18,7 +18,113 @@
 from oyoyo.ircevents import numeric_events
 
 
-# avoiding regex
+_numeric_commands = {raw: name.lower() for raw, name in numeric_events.items()}
+_command_cache = dict(_numeric_commands)
+
+_tag_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def decode(data):
+    """Decode bytes received from the server, falling back to latin-1."""
+    try:
+        return data.decode("utf_8")
+    except UnicodeDecodeError:
+        return data.decode("latin_1")
+
+def _command_name(raw):
+    """Map a raw command to its event name (numerics through numeric_events)."""
+    try:
+        return _command_cache[raw]
+    except KeyError:
+        pass
+
+    name = raw.decode("latin_1").lower()
+    if len(_command_cache) < 1024: # don't let a weird server grow this forever
+        _command_cache[raw] = name
+    return name
+
+def parse_tags(data):
+    """Parse the IRCv3 message tags (without the leading '@') into a dict.
+
+    Tags without a value map to an empty string.
+    """
+    tags = {}
+    for tag in decode(data).split(";"):
+        if not tag:
+            continue
+        key, sep, value = tag.partition("=")
+        if "\\" in value:
+            chars = []
+            it = iter(value)
+            for char in it:
+                if char == "\\":
+                    char = next(it, "")
+                    char = _tag_escapes.get(char, char)
+                chars.append(char)
+            value = "".join(chars)
+        tags[key] = value
+    return tags
+
+def parse_message(element):
+    """
+    This function parses a raw irc line in a single pass and returns a
+    tuple of (tags, prefix, command, params).
+
+    tags is a dict of IRCv3 message tags (empty if there were none), prefix
+    is None or the raw prefix, command is the lowercase command name (with
+    numerics mapped through numeric_events), and params is a list of the
+    raw parameters. prefix and params are left as bytes, so that they are
+    only decoded by whoever needs them (see decode()).
+
+    <message>  ::= ['@' <tags> <SPACE>] [':' <prefix> <SPACE> ] <command> <params> <crlf>
+    <tags>     ::= <tag> [';' <tag>]*
+    <tag>      ::= <key> ['=' <escaped value>]
+    """
+    line = element.strip()
+    length = len(line)
+    pos = 0
+    tags = {}
+    prefix = None
+
+    if line[:1] == b"@":
+        pos = line.find(b" ")
+        if pos < 0:
+            pos = length
+        tags = parse_tags(line[1:pos])
+        while pos < length and line[pos] == 32: # ' '
+            pos += 1
+
+    if line[pos:pos+1] == b":":
+        end = line.find(b" ", pos)
+        if end < 0:
+            end = length
+        prefix = line[pos+1:end]
+        pos = end
+        while pos < length and line[pos] == 32:
+            pos += 1
+
+    end = line.find(b" ", pos)
+    if end < 0:
+        end = length
+    command = _command_name(line[pos:end])
+    pos = end
+
+    params = []
+    while pos < length:
+        if line[pos] == 32:
+            pos += 1
+            continue
+        if line[pos] == 58: # ':' - trailing parameter
+            params.append(line[pos+1:])
+            break
+        end = line.find(b" ", pos)
+        if end < 0:
+            params.append(line[pos:])
+            break
+        params.append(line[pos:end])
+        pos = end
+
+    return (tags, prefix, command, params)
+
 def parse_raw_irc_command(element):
     """
     This function parses a raw irc command and returns a tuple
@@ -37,33 +143,10 @@ def parse_raw_irc_command(element):
                      NUL or CR or LF>
 
     <crlf>     ::= CR LF
-    """
-    parts = element.strip().split(bytes(" ", "utf_8"))
-    if parts[0].startswith(bytes(':', 'utf_8')):
-        prefix = parts[0][1:]
-        command = parts[1]
-        args = parts[2:]
-    else:
-        prefix = None
-        command = parts[0]
-        args = parts[1:]
-
-    if command.isdigit():
-        try:
-            command = numeric_events[command]
-        except KeyError:
-            pass
-    command = command.lower()
-    if isinstance(command, bytes): command = command.decode("utf_8")
-
-    if args[0].startswith(bytes(':', 'utf_8')):
-        args = [bytes(" ", "utf_8").join(args)[1:]]
-    else:
-        for idx, arg in enumerate(args):
-            if arg.startswith(bytes(':', 'utf_8')):
-                args = args[:idx] + [bytes(" ", 'utf_8').join(args[idx:])[1:]]
-                break
 
+    Message tags, if any, are discarded; use parse_message() to get them.
+    """
+    tags, prefix, command, args = parse_message(element)
     return (prefix, command, args)
 
 
@@ -0,0 +1,229 @@
+# Copyright (c) 2011 Duncan Fordyce, Jimmy Cao
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+
+from collections import deque
+
+PROTOCOL = 0 # PONG, CAP, AUTHENTICATE and other registration traffic
+CHANNEL = 1  # channel messages and channel operations (MODE, KICK, ...)
+PRIVATE = 2  # private messages and notices to users
+INFO = 3     # everything else (WHO, mode queries, QUIT, ...)
+
+LANES = ("protocol", "channel", "private", "info")
+
+_protocol_commands = frozenset((b"PONG", b"PING", b"CAP", b"AUTHENTICATE", b"PASS", b"NICK", b"USER"))
+_channel_commands = frozenset((b"MODE", b"KICK", b"JOIN", b"PART", b"TOPIC", b"INVITE"))
+_message_commands = frozenset((b"PRIVMSG", b"NOTICE"))
+_channel_prefixes = b"#&!+@%~"
+
+def classify(msg):
+    """Return the priority lane of a raw outbound line (as bytes)."""
+    parts = msg.split(b" ", 2)
+    command = parts[0].upper()
+
+    if command in _protocol_commands:
+        return PROTOCOL
+
+    if command in _message_commands:
+        if len(parts) > 1 and parts[1][:1] and parts[1][0] in _channel_prefixes:
+            return CHANNEL
+        return PRIVATE
+
+    if command in _channel_commands:
+        if command == b"MODE" and len(parts) < 3:
+            return INFO # bare mode query
+        return CHANNEL
+
+    # QUIT lands here on purpose, so that it goes out after what was queued before it
+    return INFO
+
+class SendQueue:
+    """A bounded, thread-safe outbound queue with priority lanes.
+
+    Items are (message, future) pairs; the future is only used by the
+    asyncio send path and is otherwise None. Lower lanes are always
+    emptied first, and items within a lane are sent in order. When the
+    queue is full, the oldest item of the least important lane that is
+    less important than the new item is dropped; if there is none, the
+    new item is dropped instead. Protocol traffic is never dropped.
+
+    A message may also carry a tag (any hashable value), meaning that it
+    may become stale before it is sent: filter() then drops or rewrites
+    the tagged messages which are still queued. A tagged message which
+    is identical to one queued with the same tag at most merge_window
+    seconds earlier, and still waiting, is merged into it.
+
+    """
+
+    def __init__(self, maxsize=1000, notify=None, merge_window=0):
+        self.maxsize = maxsize
+        self.notify = notify
+        self.merge_window = merge_window
+        self._lanes = [deque() for _ in LANES]
+        self._size = 0
+        self._tagged = {} # {(lane, message, tag): time the latest copy was queued}
+        self._cond = threading.Condition(threading.Lock())
+
+        self.sent = 0
+        self.dropped = 0
+        self.merged = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, msg, priority=None, future=None, tag=None):
+        """Queue a message and return the item which was dropped to make room for it, if any."""
+        if priority is None:
+            priority = classify(msg)
+
+        now = time.time()
+        item = (msg, future, now, tag)
+        dropped = None
+
+        with self._cond:
+            if tag is not None and future is None and self.merge_window:
+                queued = self._tagged.get((priority, msg, tag))
+                if queued is not None and now - queued <= self.merge_window:
+                    self.merged += 1
+                    return None
+
+            if self.maxsize and self._size >= self.maxsize and priority != PROTOCOL:
+                for lane in reversed(range(priority + 1, len(self._lanes))):
+                    if self._lanes[lane]:
+                        dropped = self._lanes[lane].popleft()
+                        self._size -= 1
+                        self._untag(lane, dropped)
+                        break
+                else:
+                    self.dropped += 1
+                    return item[:2]
+                self.dropped += 1
+
+            self._lanes[priority].append(item)
+            self._size += 1
+            if tag is not None:
+                self._tagged[priority, msg, tag] = now
+            self._cond.notify()
+
+        if self.notify is not None:
+            self.notify()
+
+        return dropped[:2] if dropped is not None else None
+
+    def _untag(self, lane, item):
+        msg, future, queued, tag = item
+        if tag is not None and self._tagged.get((lane, msg, tag)) == queued:
+            del self._tagged[lane, msg, tag]
+
+    def wait(self, timeout=None):
+        """Block until the queue is not empty. Return False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._size, timeout)
+
+    def wake(self):
+        """Wake up all threads blocked in wait()."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def get_nowait(self):
+        """Remove and return the most important (message, future) pair, or None."""
+        with self._cond:
+            for index, lane in enumerate(self._lanes):
+                if lane:
+                    item = lane.popleft()
+                    self._size -= 1
+                    self._untag(index, item)
+                    msg, future, queued, tag = item
+                    break
+            else:
+                return None
+
+            wait = time.time() - queued
+            self.sent += 1
+            self.total_wait += wait
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+
+        return msg, future
+
+    def clear(self):
+        """Drop everything that is queued and return the dropped items."""
+        with self._cond:
+            items = [item[:2] for lane in self._lanes for item in lane]
+            for lane in self._lanes:
+                lane.clear()
+            self._size = 0
+            self._tagged.clear()
+        return items
+
+    def filter(self, function):
+        """Call function(message, tag) for every queued tagged message.
+
+        It returns the message to send in its place (possibly the same
+        one), or None to drop it. Untagged messages are left alone. The
+        dropped (message, future) pairs are returned.
+
+        """
+
+        dropped = []
+        with self._cond:
+            for index, lane in enumerate(self._lanes):
+                if not any(item[3] is not None for item in lane):
+                    continue
+                kept = []
+                for item in lane:
+                    msg, future, queued, tag = item
+                    if tag is not None:
+                        new = function(msg, tag)
+                        if new is None:
+                            self._untag(index, item)
+                            dropped.append((msg, future))
+                            continue
+                        if new != msg:
+                            self._untag(index, item)
+                            item = (new, future, queued, tag)
+                            self._tagged.setdefault((index, new, tag), queued)
+                    kept.append(item)
+                lane.clear()
+                lane.extend(kept)
+            self._size -= len(dropped)
+            self.cancelled += len(dropped)
+        return dropped
+
+    def stats(self):
+        """Return a dict with the queue depth and wait time statistics."""
+        with self._cond:
+            return {
+                "depth": self._size,
+                "lanes": {name: len(lane) for name, lane in zip(LANES, self._lanes)},
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "merged": self.merged,
+                "cancelled": self.cancelled,
+                "avg_wait": self.total_wait / self.sent if self.sent else 0.0,
+                "max_wait": self.max_wait,
+                "last_wait": self.last_wait,
+            }
+
+    def __repr__(self):
+        return "{self.__class__.__name__}(maxsize={self.maxsize}, depth={self._size})".format(self=self)
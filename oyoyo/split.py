@@ -0,0 +1,136 @@
+# Copyright (c) 2011 Duncan Fordyce, Jimmy Cao
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+""" Splitting outgoing messages into lines which fit the 512 bytes limit.
+
+The limit applies to the line as the server relays it to others, i.e.
+":nick!ident@host PRIVMSG target :text\r\n", and it is in bytes: lines
+are sent as UTF-8, so text is measured as such, and never split in the
+middle of a character. Splitting prefers spaces near the end of a line.
+"""
+
+import functools
+
+MAX_LINE = 512
+
+def bytelen(text):
+    """Return the length of text once encoded, without encoding ASCII text."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf_8"))
+
+@functools.lru_cache(maxsize=1024)
+def line_budget(nick, ident, host, command, target):
+    """Return how many bytes of text fit in a line sent by nick!ident@host to target."""
+    overhead = ":{0}!{1}@{2} {3} {4} :\r\n".format(nick, ident, host, command, target)
+    return MAX_LINE - bytelen(overhead)
+
+def split(text, budget):
+    """Yield pieces of text of at most budget bytes each.
+
+    A space at which text is split is dropped, as it would otherwise be
+    at the very start or end of a line. Empty text yields nothing.
+
+    """
+
+    if len(text) <= budget // 4: # fits even if every character takes 4 bytes
+        if text:
+            yield text
+        return
+
+    data = text.encode("utf_8")
+    if len(data) <= budget:
+        yield text
+        return
+
+    start = 0
+    while len(data) - start > budget:
+        cut = start + budget
+        while cut > start and data[cut] & 0xC0 == 0x80: # continuation byte
+            cut -= 1
+        if cut == start: # budget is smaller than a single character
+            cut += 1
+            while cut < len(data) and data[cut] & 0xC0 == 0x80:
+                cut += 1
+        space = data.rfind(b" ", start, cut + 1)
+        if space - start > budget // 2:
+            yield data[start:space].decode("utf_8")
+            start = space + 1
+        else:
+            yield data[start:cut].decode("utf_8")
+            start = cut
+
+    if start < len(data):
+        yield data[start:].decode("utf_8")
+
+def _breaks(items):
+    """Yield the lines of every item, with None where an item has a newline."""
+    for item in items:
+        first, *rest = item.split("\n")
+        yield first
+        for line in rest:
+            yield None
+            yield line
+
+def pack(items, sep, budget):
+    """Yield lines of at most budget bytes, made of the items joined by sep.
+
+    Items are put on the same line for as long as they fit. A newline in
+    an item starts a new line, and items which don't fit on a line of
+    their own are split with split(). Empty lines are skipped.
+
+    """
+
+    items = list(items)
+    text = sep.join(items)
+    if "\n" not in text and bytelen(text) <= budget:
+        if text: # the common case; it all fits in a single line
+            yield text
+        return
+
+    if "\n" in text:
+        items = _breaks(items)
+    measure = len if text.isascii() else bytelen
+    sep_len = measure(sep)
+    parts = []
+    append = parts.append
+    size = 0
+    for item in items:
+        if item is None: # a newline in the item
+            if parts:
+                yield "".join(parts)
+                parts.clear()
+            continue
+        length = measure(item)
+        if parts:
+            if size + sep_len + length <= budget:
+                append(sep)
+                append(item)
+                size += sep_len + length
+                continue
+            yield "".join(parts)
+            parts.clear()
+        if length > budget:
+            *full, item = split(item, budget)
+            yield from full
+            length = bytelen(item)
+        if item:
+            append(item)
+            size = length
+
+    if parts:
+        yield "".join(parts)
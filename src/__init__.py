@@ -5,7 +5,7 @@ import time
 import botconfig
 import src.settings as var
 from src import logger
-from src.logger import stream, stream_handler, debuglog, errlog, plog
+from src.logger import stream, stream_enabled, stream_handler, debuglog, errlog, plog
 from src import db
 
 # Import the user-defined game modes
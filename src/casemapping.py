@@ -0,0 +1,38 @@
+""" Case folding for nicks and channel names, as specified by the server's CASEMAPPING.
+
+The translation table for each supported casemapping is built once, and
+recently folded names are memoized, as the same nicks get folded over and
+over (for every message, every User.lower() and every database comparison).
+
+This module has no dependencies on the rest of the bot, so it can be
+imported from anywhere.
+"""
+
+import functools
+
+DEFAULT = "rfc1459"
+
+# characters which are considered the uppercase version of another character, per casemapping
+_MAPPINGS = {
+    "rfc1459": {"[": "{", "]": "}", "\\": "|", "^": "~"},
+    "strict-rfc1459": {"[": "{", "]": "}", "\\": "|"},
+    "ascii": {},
+}
+
+TABLES = {name: str.maketrans(mapping) for name, mapping in _MAPPINGS.items()}
+
+def supported(casemapping):
+    return casemapping in TABLES
+
+@functools.lru_cache(maxsize=4096)
+def lower(name, casemapping=DEFAULT):
+    """Return the folded version of name. Unknown casemappings are treated as rfc1459."""
+    table = TABLES.get(casemapping)
+    if table is None:
+        table = TABLES[DEFAULT]
+    return name.lower().translate(table)
+
+def equals(name1, name2, casemapping=DEFAULT):
+    return lower(name1, casemapping) == lower(name2, casemapping)
+
+# vim: set sw=4 expandtab:
@@ -1,8 +1,12 @@
 import time
 
+from collections.abc import Set
 from enum import Enum
 
-from src.context import IRCContext, Features, lower
+from oyoyo.split import bytelen, line_budget
+
+from src.context import IRCContext, IRCDict, Features, lower
+from src.completion import PrefixIndex
 from src.events import Event
 from src import settings as var
 from src import users
@@ -11,7 +15,11 @@ Main = None # main channel
 Dummy = None # fake channel
 Dev = None # dev channel
 
-_channels = {}
+_channels = {} # {client: IRCDict of {name: Channel}}; each connection has its own channels
+
+# How long a mode change we sent is taken as done while the server hasn't
+# echoed it back yet; after that, we assume it was refused
+PENDING_MODE_TIMEOUT = 60
 
 class _States(Enum):
     NotJoined = "not yet joined"
@@ -28,9 +36,18 @@ class _States(Enum):
 def predicate(name):
     return not name.startswith(tuple(Features["CHANTYPES"]))
 
-def get(name, *, allow_none=False):
+def _registry(cli):
+    """Return the channels of the given connection, which defaults to the bot's."""
+    if cli is None and users.Bot is not None:
+        cli = users.Bot.client
+    registry = _channels.get(cli)
+    if registry is None:
+        registry = _channels[cli] = IRCDict()
+    return registry
+
+def get(name, cli=None, *, allow_none=False):
     try:
-        return _channels[lower(name)]
+        return _registry(cli)[name]
     except KeyError:
         if allow_none:
             return None
@@ -41,44 +58,250 @@ def add(name, cli, key=""):
 
     # We use add() in a bunch of places where the channel probably (but
     # not surely) already exists. If it does, obviously we want to use
-    # that one. However, if the client is *not* the same, that means we
-    # would be trying to send something from one connection over to
-    # another one (or some other weird stuff like that). Instead of
-    # jumping through hoops, we just disallow it here.
+    # that one. Channels are looked up per connection, so the same name
+    # on two connections gives two different channels.
 
-    if lower(name) in _channels:
-        if cli is not _channels[lower(name)].client:
-            raise RuntimeError("different IRC client for channel {0}".format(name))
-        return _channels[lower(name)]
+    registry = _registry(cli)
+    if name in registry:
+        return registry[name]
 
     cls = Channel
     if predicate(name):
         cls = FakeChannel
 
-    chan = _channels[lower(name)] = cls(name, cli)
+    chan = registry[name] = cls(name, cli)
     chan._key = key
     chan.join()
     return chan
 
-def exists(name):
+def disconnected(cli=None):
+    """Forget who was in the channels after the connection was lost.
+
+    The channels themselves are kept, and rejoin() joins them again once
+    we are reconnected. Who left in the meantime is sorted out after the
+    first WHO reply following the rejoin.
+
+    """
+
+    for chan in _registry(cli).values():
+        if chan.state in (_States.Joined, _States.PendingJoin):
+            chan._reset()
+
+def rejoin(cli=None):
+    """Join the channels we were in again after reconnecting."""
+    for chan in _registry(cli).values():
+        if chan.state is _States.NotJoined:
+            chan.join()
+
+def mode_limit():
+    """Return how many modes with a parameter fit in a single MODE command, or None for no limit."""
+    if "MODES" not in Features:
+        return 3 # what servers which don't advertise it allow
+    return Features["MODES"]
+
+def _mode_kind(mode):
+    """Return "status", "list", "param" or "flag" for a channel mode, or None if it is unknown."""
+    if mode in Features.get("PREFIX", {}).values():
+        return "status"
+    if "CHANMODES" not in Features:
+        return None
+    list_modes, all_set, only_set, no_set = Features["CHANMODES"]
+    if mode in list_modes:
+        return "list"
+    if mode in all_set or mode in only_set:
+        return "param"
+    if mode in no_set:
+        return "flag"
+    return None
+
+def _pack_modes(changes, limit, budget):
+    """Yield the mode string and parameters of MODE commands applying changes in order.
+
+    changes is a list of (mode, parameter), where mode is e.g. "+v" and the
+    parameter is None for modes without one. Only modes with a parameter
+    count towards limit, and every command fits in budget bytes.
+
+    """
+
+    modes = []
+    params = []
+    sign = None
+    size = count = 0
+    for mode, param in changes:
+        if param is not None:
+            param = format(param)
+        extra = 0 if param is None else bytelen(param) + 1
+        if modes and (size + len(mode) + extra > budget or (param is not None and count == limit)):
+            yield "".join(modes), params
+            modes, params, sign, size, count = [], [], None, 0, 0
+        if mode[0] == sign:
+            mode = mode[1:]
+        else:
+            sign = mode[0]
+        modes.append(mode)
+        size += len(mode) + extra
+        if param is not None:
+            params.append(param)
+            count += 1
+
+    if modes:
+        yield "".join(modes), params
+
+def exists(name, cli=None):
     """Return True if a channel by the name exists, False otherwise."""
-    return lower(name) in _channels
+    return name in _registry(cli)
+
+def channels(cli=None):
+    """Iterate over all the current channels of a connection (by default, the bot's)."""
+    yield from _registry(cli).values()
+
+class Members(set):
+    """The users in a channel, with their nicks indexed.
+
+    The nicks are indexed both for lookups and for completion. The indexes
+    follow the set as users are added and removed; users notify it
+    themselves when they change nicks (see User.nick).
+
+    """
+
+    __slots__ = ("nicks", "_by_nick")
+
+    def __init__(self):
+        super().__init__()
+        self.nicks = PrefixIndex(lower)
+        self._by_nick = {} # {folded nick: user}
+
+    def add(self, user):
+        if user not in self:
+            super().add(user)
+            self.nicks.add(user.nick, user)
+            self._by_nick[lower(user.nick)] = user
+
+    def remove(self, user):
+        super().remove(user)
+        self.nicks.discard(user.nick, user)
+        self._unmap(user.nick, user)
+
+    def discard(self, user):
+        if user in self:
+            self.remove(user)
+
+    def clear(self):
+        super().clear()
+        self.nicks.clear()
+        self._by_nick.clear()
+
+    def _unmap(self, nick, user):
+        nick = lower(nick)
+        if self._by_nick.get(nick) is user:
+            del self._by_nick[nick]
+
+    def renamed(self, user, old):
+        """Reindex a user who changed nicks from old."""
+        if user in self:
+            self.nicks.discard(old, user)
+            self.nicks.add(user.nick, user)
+            self._unmap(old, user)
+            self._by_nick[lower(user.nick)] = user
+
+    def find(self, user):
+        """Return the member matching a nick or user, or None."""
+        if isinstance(user, str):
+            return self._by_nick.get(lower(user))
+        if user in self:
+            return user
+        return None
+
+_status_bits = {} # {status mode: bit}; bits are given out as modes are first seen
+_status_modes = [] # [status mode], by bit position
+
+def _status_bit(mode):
+    bit = _status_bits.get(mode)
+    if bit is None:
+        bit = _status_bits[mode] = 1 << len(_status_modes)
+        _status_modes.append(mode)
+    return bit
+
+class Membership(Set):
+    """A user's membership of a channel.
+
+    It holds the user's status modes in the channel (op, voice, etc.) as
+    bit flags, and behaves as a set of those modes. Changing them with
+    add() and discard() keeps the channel's index of who has each status
+    mode (in Channel.modes) up to date.
+
+    """
+
+    __slots__ = ("channel", "user", "flags")
+
+    def __init__(self, channel, user, modes=()):
+        self.channel = channel
+        self.user = user
+        self.flags = 0
+        for mode in modes:
+            self.add(mode)
 
-def channels():
-    """Iterate over all the current channels."""
-    yield from _channels.values()
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.channel.name!r}, {self.user.nick!r}, {modes!r})".format(self=self, modes=set(self))
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __contains__(self, mode):
+        bit = _status_bits.get(mode)
+        return bit is not None and self.flags & bit != 0
+
+    def __iter__(self):
+        flags = self.flags
+        for mode in _status_modes:
+            if not flags:
+                break
+            if flags & 1:
+                yield mode
+            flags >>= 1
+
+    def __len__(self):
+        return bin(self.flags).count("1")
+
+    def add(self, mode):
+        bit = _status_bit(mode)
+        if not self.flags & bit:
+            self.flags |= bit
+            holders = self.channel.modes.get(mode)
+            if holders is None:
+                holders = self.channel.modes[mode] = set()
+            holders.add(self.user)
+
+    def discard(self, mode):
+        bit = _status_bits.get(mode)
+        if bit is not None and self.flags & bit:
+            self.flags &= ~bit
+            holders = self.channel.modes.get(mode)
+            if holders is not None:
+                holders.discard(self.user)
+                if not holders:
+                    del self.channel.modes[mode]
+
+    def clear(self):
+        for mode in list(self):
+            self.discard(mode)
 
 class Channel(IRCContext):
 
+    __slots__ = ("users", "modes", "timestamp", "state", "_pending", "_stale", "_key", "_expected")
+
     is_channel = True
 
     def __init__(self, name, client):
         super().__init__(name, client)
-        self.users = set()
+        self.users = Members()
         self.modes = {}
         self.timestamp = None
         self.state = _States.NotJoined
         self._pending = []
+        self._stale = None # members from before the connection was lost
+        self._expected = {} # {(mode, key): (value, time)}; mode changes we sent, until the server echoes them
 
     def __del__(self):
         self.users.clear()
@@ -121,6 +344,30 @@ class Channel(IRCContext):
             self.state = _States.PendingLeave
             self.client.send("PART {0} :{1}".format(self.name, message))
 
+    def add_user(self, user, modes=()):
+        """Add a user to the channel with the given status modes, and return their membership.
+
+        Nothing changes if they are already in the channel.
+
+        """
+
+        membership = user.channels.get(self)
+        if membership is None:
+            membership = user.channels[self] = Membership(self, user, modes)
+            self.users.add(user)
+        return membership
+
+    def membership(self, user):
+        """Return the membership of a user (or nick) in the channel, or None."""
+        user = self.users.find(user)
+        if user is None:
+            return None
+        return user.channels.get(self)
+
+    def members_with(self, mode):
+        """Return the set of users who have a status mode in the channel (don't change it)."""
+        return self.modes.get(mode, frozenset())
+
     def kick(self, target, message=""):
         if self.state is _States.Joined:
             self.client.send("KICK {0} {1} :{2}".format(self.name, target, message))
@@ -150,7 +397,6 @@ class Channel(IRCContext):
             self.client.send("MODE", self.name)
             return
 
-        max_modes = Features["MODES"]
         params = []
         for change in changes:
             if isinstance(change, str):
@@ -161,25 +407,131 @@ class Channel(IRCContext):
             params.append((mode, target))
         params.sort(key=lambda x: x[0][0]) # sort by prefix
 
-        while params:
-            cur, params = params[:max_modes], params[max_modes:]
-            modes, targets = zip(*cur)
-            prefix = ""
-            final = []
-            for mode in modes:
-                if mode[0] == prefix:
-                    mode = mode[1:]
-                elif mode.startswith(("+", "-")):
-                    prefix = mode[0]
+        self._expect(params)
+        budget = line_budget(self.client.nickname, self.client.ident, self.client.hostmask, "MODE", self.name)
+        for modes, targets in _pack_modes(params, mode_limit(), budget):
+            self.client.send("MODE", self.name, modes, *targets)
+
+    def _mode_key(self, mode, target):
+        """Return how a mode and its target are kept track of, as (kind, key), or None if it isn't."""
+        kind = _mode_kind(mode)
+        if kind == "status":
+            user = self.users.find(target) if target is not None else None
+            if user is None:
+                return None
+            return kind, user
+        if kind == "list":
+            if target is None: # a list query
+                return None
+            return kind, lower(format(target))
+        if kind is None:
+            return None
+        return kind, None
+
+    def _mode_state(self, mode, kind, key, now):
+        """Return the current value of a mode (see _desired()), including the changes we sent."""
+        pending = self._expected.get((mode, key))
+        if pending is not None and now - pending[1] < PENDING_MODE_TIMEOUT:
+            return pending[0]
+        if kind == "status":
+            return key in self.modes.get(mode, ())
+        if kind == "list":
+            # we may not have received the whole list, so a mask which isn't
+            # in it is only known to be unset if we removed it ourselves
+            if any(lower(mask) == key for mask in self.modes.get(mode, ())):
+                return True
+            return None
+        if kind == "param":
+            return mode in self.modes and str(self.modes[mode])
+        return mode in self.modes
+
+    @staticmethod
+    def _desired(mode, kind, target):
+        """Return the value a mode change leads to.
+
+        That is whether the mode is set (for the user or mask, if any), or
+        its parameter for a set mode which has one.
+
+        """
+
+        if mode[0] == "-":
+            return False
+        if kind == "param":
+            return str(target)
+        return True
+
+    def _expect(self, changes):
+        now = time.time()
+        for mode, target in changes:
+            found = self._mode_key(mode[1], target)
+            if found is not None:
+                kind, key = found
+                self._expected[mode[1], key] = (self._desired(mode, kind, target), now)
+
+    def plan_modes(self, *changes, exact=None):
+        """Return the mode changes needed to bring the channel to a given state.
+
+        The changes are given as for mode(), but describe the state that
+        the channel should be in: those which are already in effect (or
+        which we already sent) are left out, and so are status modes for
+        users who are not in the channel. The last change for the same
+        mode (and user or mask) wins. Masks are only left out of list mode
+        removals if we just removed them; we may not know the whole list.
+
+        exact maps status modes to the users who should have them; every
+        other user in the channel who has one of them loses it. An explicit
+        change for the same user takes precedence. The bot itself is never
+        affected by exact.
+
+        The returned changes can be passed to mode() (see apply_modes()).
+
+        """
 
-                final.append(mode)
+        desired = {} # {(mode, key): (change, target, kind)}
+        for change in changes:
+            if isinstance(change, str):
+                change = (change, None)
+            mode, target = change
+            if len(mode) < 2:
+                mode = "+" + mode
+            found = self._mode_key(mode[1], target)
+            if found is None:
+                if _mode_kind(mode[1]) == "status":
+                    continue # not in the channel
+                desired[mode[1], object()] = (mode, target, None) # a list query or an unknown mode; always send it
+                continue
+            kind, key = found
+            desired.pop((mode[1], key), None) # keep the order of the last one
+            desired[mode[1], key] = (mode, target, kind)
+
+        if exact:
+            for mode, holders in exact.items():
+                holders = {self.users.find(user) for user in holders}
+                for user in self.users:
+                    if user is users.Bot or (mode, user) in desired:
+                        continue
+                    sign = "+" if user in holders else "-"
+                    desired[mode, user] = (sign + mode, user, "status")
+
+        now = time.time()
+        plan = []
+        for (mode, key), (change, target, kind) in desired.items():
+            if kind is None or self._mode_state(mode, kind, key, now) != self._desired(change, kind, target):
+                plan.append((change, target))
+        return plan
+
+    def apply_modes(self, *changes, exact=None):
+        """Bring the channel to a given state, with as few MODE commands as possible.
+
+        See plan_modes() for the arguments. The changes which were sent
+        are returned.
 
-            for target in targets:
-                if target is not None: # target will be None if the mode is parameter-less
-                    final.append(" ")
-                    final.append("{0}".format(target))
+        """
 
-            self.client.send("MODE", self.name, "".join(final))
+        plan = self.plan_modes(*changes, exact=exact)
+        if plan:
+            self.mode(*plan)
+        return plan
 
     def update_modes(self, actor, mode, targets):
         """Update the channel's mode registry with the new modes.
@@ -203,20 +555,20 @@ class Channel(IRCContext):
                 continue
 
             if prefix == "+":
-                if c in status_modes: # op/voice status; keep it here and update the user's registry too
-                    if c not in self.modes:
-                        self.modes[c] = set()
-                    user = users._get(targets[i], allow_bot=True) # FIXME
-                    self.modes[c].add(user)
-                    user.channels[self].add(c)
-                    if user in var.OLD_MODES:
-                        var.OLD_MODES[user].discard(c)
+                if c in status_modes: # op/voice status; the membership keeps both sides up to date
+                    user = self.users.find(targets[i])
+                    if user is not None:
+                        self._expected.pop((c, user), None)
+                        user.channels[self].add(c)
+                        if user in var.OLD_MODES:
+                            var.OLD_MODES[user].discard(c)
                     i += 1
 
                 elif c in list_modes: # stuff like bans, quiets, and ban and invite exempts
                     if c not in self.modes:
                         self.modes[c] = {}
                     self.modes[c][targets[i]] = (actor.rawnick, set_time)
+                    self._expected.pop((c, lower(targets[i])), None)
                     i += 1
 
                 else:
@@ -228,18 +580,18 @@ class Channel(IRCContext):
                     if c in only_set and targ.isdigit(): # +l/+j
                         targ = int(targ)
                     self.modes[c] = targ
+                    self._expected.pop((c, None), None)
 
             else:
                 if c in status_modes:
-                    if c in self.modes:
-                        user = users._get(targets[i], allow_bot=True) # FIXME
-                        self.modes[c].discard(user)
+                    user = self.users.find(targets[i])
+                    if user is not None:
+                        self._expected.pop((c, user), None)
                         user.channels[self].discard(c)
-                        if not self.modes[c]:
-                            del self.modes[c]
                     i += 1
 
                 elif c in list_modes:
+                    self._expected.pop((c, lower(targets[i])), None)
                     if c in self.modes:
                         self.modes[c].pop(targets[i], None)
                         if not self.modes[c]:
@@ -249,36 +601,62 @@ class Channel(IRCContext):
                 else:
                     if c in all_set:
                         i += 1 # -k needs a target, but we don't care about it
-                    del self.modes[c]
+                    self.modes.pop(c, None) # we may not know about it, e.g. right after rejoining
+                    self._expected.pop((c, None), None)
 
         if "k" in mode:
             self._key = self.modes.get("k", "")
 
     def remove_user(self, user):
         self.users.remove(user)
-        for mode in Features["PREFIX"].values():
-            if mode in self.modes:
-                self.modes[mode].discard(user)
-                if not self.modes[mode]:
-                    del self.modes[mode]
-        del user.channels[self]
+        user.channels.pop(self).clear()
         if len(user.channels) == 0:
             event = Event("cleanup_user", {})
             event.dispatch(var, user)
 
+    def _reset(self):
+        if self._stale is None:
+            self._stale = set(self.users)
+        for user in self.users:
+            del user.channels[self]
+        self.users.clear()
+        self.modes.clear()
+        self._expected.clear()
+        self.timestamp = None
+        self.state = _States.NotJoined
+        self._pending = []
+
+    def _resync(self):
+        if self._stale is None or self.state is not _States.Joined:
+            return
+        stale, self._stale = self._stale, None
+        for user in stale - self.users:
+            if user is users.Bot:
+                continue
+            # they left while we were gone; treat it like a part
+            Event("chan_part", {}).dispatch(var, self, user, "")
+            if not user.channels:
+                Event("cleanup_user", {}).dispatch(var, user)
+
     def _clear(self):
         for user in self.users:
             del user.channels[self]
         self.users.clear()
         self.modes.clear()
+        self._expected.clear()
         self.state = _States.Cleared
         self.timestamp = None
-        del _channels[self.name]
+        del _registry(self.client)[self.name]
 
 class FakeChannel(Channel):
 
+    __slots__ = ()
+
     is_fake = True
 
+    def _reset(self):
+        pass
+
     def join(self, key=""):
         self.state = _States.Joined
 
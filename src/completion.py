@@ -0,0 +1,123 @@
+""" Completion of nicks (and other names) from a unique prefix.
+
+A name matches a prefix if it starts with it, or if it does once its
+leading special characters are stripped, so that "_foo" and "[foo]" can
+be completed by typing "foo". A name equal to the prefix always wins,
+even if other names start with it too.
+
+A PrefixIndex keeps its names in a sorted array, so that finding the
+names with a given prefix is a binary search rather than a scan over all
+of them; it is meant to be updated as names come and go, e.g. as users
+join and leave a channel. complete() does the same matching over any
+iterable, for short-lived collections which aren't worth indexing.
+"""
+
+from bisect import bisect_left, bisect_right
+
+SPECIAL = "[{\\^_`|}]"
+
+def _identity(name):
+    return name
+
+def complete(prefix, items):
+    """Return the values whose name matches prefix, from an iterable of (folded name, value)."""
+    found = []
+    seen = set()
+    for name, value in items:
+        if name == prefix:
+            return [value]
+        if name.startswith(prefix) or name.lstrip(SPECIAL).startswith(prefix):
+            if id(value) not in seen:
+                seen.add(id(value))
+                found.append(value)
+    return found
+
+class PrefixIndex:
+    """A set of names, each with an associated value, indexed for completion.
+
+    fold is applied to names and prefixes alike (e.g. to make the index
+    case-insensitive). Every name is indexed twice when it starts with
+    special characters: as is, and stripped of them.
+
+    """
+
+    __slots__ = ("_fold", "_names", "_entries")
+
+    def __init__(self, fold=_identity):
+        self._fold = fold
+        self._names = [] # sorted folded names, stripped or not
+        self._entries = [] # [(value, stripped)], in the same order as _names
+
+    def __len__(self):
+        return sum(1 for value, stripped in self._entries if not stripped)
+
+    def _forms(self, name):
+        name = self._fold(name)
+        stripped = name.lstrip(SPECIAL)
+        if stripped != name:
+            return ((name, False), (stripped, True))
+        return ((name, False),)
+
+    def add(self, name, value):
+        for form, stripped in self._forms(name):
+            index = bisect_right(self._names, form)
+            self._names.insert(index, form)
+            self._entries.insert(index, (value, stripped))
+
+    def discard(self, name, value):
+        for form, stripped in self._forms(name):
+            index = bisect_left(self._names, form)
+            while index < len(self._names) and self._names[index] == form:
+                if self._entries[index][0] is value:
+                    del self._names[index]
+                    del self._entries[index]
+                    break
+                index += 1
+            else: # the name was folded differently when it was added
+                for index, (other, other_stripped) in enumerate(self._entries):
+                    if other is value and other_stripped is stripped:
+                        del self._names[index]
+                        del self._entries[index]
+                        break
+
+    def clear(self):
+        self._names.clear()
+        self._entries.clear()
+
+    def get(self, name, default=None):
+        """Return the value of the given name (not stripped of special characters), or default."""
+        name = self._fold(name)
+        names, entries = self._names, self._entries
+        index = bisect_left(names, name)
+        while index < len(names) and names[index] == name:
+            value, stripped = entries[index]
+            if not stripped:
+                return value
+            index += 1
+        return default
+
+    def complete(self, prefix):
+        """Return the values whose name matches prefix."""
+        prefix = self._fold(prefix)
+        names, entries = self._names, self._entries
+        found = []
+        seen = set()
+        index = bisect_left(names, prefix)
+        while index < len(names) and names[index].startswith(prefix):
+            value, stripped = entries[index]
+            if not stripped and names[index] == prefix:
+                return [value]
+            if id(value) not in seen:
+                seen.add(id(value))
+                found.append(value)
+            index += 1
+        return found
+
+    def complete_one(self, prefix):
+        """Return the value whose name uniquely matches prefix, or None."""
+        found = self.complete(prefix)
+        if len(found) == 1:
+            return found[0]
+        return None
+
+# vim: set sw=4 expandtab:
@@ -1,7 +1,13 @@
-from collections import defaultdict
+from collections import Counter, deque
+from contextlib import contextmanager
+import functools
+import threading
 from operator import attrgetter
 
+from oyoyo.split import bytelen, line_budget, pack
+
 from src.logger import debuglog
+from src import casemapping as _casemapping, hostmasks as _hostmasks
 
 Features = {"CASEMAPPING": "rfc1459", "CHARSET": "utf-8", "STATUSMSG": {"@", "+"}, "CHANTYPES": {"#"}, "TARGMAX": {"PRIVMSG": 1, "NOTICE": 1}}
 
@@ -26,50 +32,137 @@ def _who(cli, target, data=b""):
 
     return int.from_bytes(data, "little")
 
-def _send(data, first, sep, client, send_type, name):
-    full_address = "{cli.nickname}!{cli.ident}@{cli.hostmask}".format(cli=client)
-
-    # Maximum length of sent data is 512 bytes. However, we have to
-    # reduce the maximum length allowed to account for:
-    # 1 (1) - The initial colon at the front of the data
-    # 2 (1) - The space between the sender (us) and the command
-    # 3 (1) - The space between the command and the target
-    # 4 (1) - The space between the target and the data
-    # 5 (1) - The colon at the front of the data to send
-    # 6 (2) - The trailing \r\n
-    length = 512 - 7
-    # Next, we need to reduce the length to account for our address
-    length -= len(full_address)
-    # Then we also need to account for the target's length
-    length -= len(name)
-    # Finally, we need to account for the send type's length
-    length -= len(send_type)
+def _send(data, first, sep, client, send_type, name, tag=None):
+    # The line as relayed by the server must fit in 512 bytes; this
+    # accounts for our address, the command and the target, which are
+    # prepended to every line (see oyoyo.split).
+    length = line_budget(client.nickname, client.ident, client.hostmask, send_type, name)
     # The 'first' argument is sent along with every message, so deduce that too
-    if length - len(first) > 0: # make sure it's not negative (or worse, 0)
-        length -= len(first)
+    first_length = bytelen(first)
+    if length - first_length > 0: # make sure it's not negative (or worse, 0)
+        length -= first_length
     else:
         first = ""
 
-    messages = []
-    count = 0
-    for line in data:
-        if count and count + len(sep) + len(line) > length:
-            count = len(line)
-            cur_sep = "\n"
-        elif not messages:
-            count = len(line)
-            cur_sep = ""
-        else:
-            count += len(sep) + len(line)
-            cur_sep = sep
-
-        messages.append(cur_sep)
-        messages.append(line)
-
-    for line in "".join(messages).split("\n"):
-        while line:
-            extra, line = line[:length], line[length:]
-            client.send("{0} {1} :{2}{3}".format(send_type, name, first, extra))
+    prefix = "{0} {1} :{2}".format(send_type, name, first)
+    for line in pack(data, sep, length):
+        client.send(prefix + line, tag=tag)
+
+# Outgoing messages can be queued instead of sent right away, so that the
+# same message going to several targets is sent to as many of them as the
+# server allows in a single line (see TARGMAX). Messages are queued per
+# thread; every target still gets its own messages in the order they were
+# queued, even when the messages of different targets are interleaved.
+#
+# A message may be tagged (see IRCClient.send()), if it may become stale
+# while it waits for the rate limiter; only messages with the same tag are
+# sent together.
+
+_outbox = threading.local()
+
+def _pending():
+    if not hasattr(_outbox, "queues"):
+        _outbox.depth = 0
+        _outbox.queues = {} # {(client, folded name): deque([(message, name)])}
+    return _outbox
+
+def queue(client, send_type, name, data, *, first="", sep=" ", tag=None):
+    """Queue a message to name, to be sent by send_queued()."""
+    pending = _pending()
+    key = (client, lower(name))
+    entries = pending.queues.get(key)
+    if entries is None:
+        entries = pending.queues[key] = deque()
+    entries.append(((client, send_type, tuple(data), first, sep, tag), name))
+
+def send(client, send_type, name, data, *, first="", sep=" ", tag=None):
+    """Send a message to name, or queue it if this is within a batch()."""
+    if _pending().depth:
+        queue(client, send_type, name, data, first=first, sep=sep, tag=tag)
+    else:
+        _send(data, first, sep, client, send_type, name, tag)
+
+def send_queued():
+    """Send all queued messages, unless this is within a batch()."""
+    pending = _pending()
+    if not pending.depth and pending.queues:
+        queues, pending.queues = pending.queues, {}
+        _flush(queues)
+
+@contextmanager
+def batch():
+    """Queue every message sent within the block, and send them at the end.
+
+    This covers IRCContext.send() and utilities.pm(), but not the lower
+    level IRCClient methods. Batches may be nested; the messages are only
+    sent once the outermost one ends.
+
+    """
+
+    pending = _pending()
+    pending.depth += 1
+    try:
+        yield
+    finally:
+        pending.depth -= 1
+        send_queued()
+
+def _flush(queues):
+    remaining = Counter(entries[i][0] for entries in queues.values() for i in range(len(entries)))
+    while queues:
+        heads = {} # {message: [key]}, for the next message of every target
+        for key, entries in queues.items():
+            heads.setdefault(entries[0][0], []).append(key)
+        # Prefer a message which no target has further down its queue; it
+        # then goes to everyone getting it at once, rather than in pieces
+        message = next((msg for msg, keys in heads.items() if len(keys) == remaining[msg]), None)
+        if message is None:
+            message = next(iter(heads))
+        keys = heads[message]
+        remaining[message] -= len(keys)
+
+        names = []
+        for key in keys:
+            entries = queues[key]
+            names.append(entries.popleft()[1])
+            if not entries:
+                del queues[key]
+
+        client, send_type, data, first, sep, tag = message
+        for targets in _group_targets(client, send_type, names, data, first, sep):
+            _send(data, first, sep, client, send_type, ",".join(targets), tag)
+
+def _group_targets(client, send_type, names, data, first, sep):
+    """Split names into groups small enough to be sent the message in a single command."""
+    limit = Features["TARGMAX"].get(send_type, 1)
+    if limit is None: # no limit
+        limit = len(names)
+    if limit <= 1 or len(names) == 1:
+        for name in names:
+            yield (name,)
+        return
+
+    # The target list takes away from the room for the message itself;
+    # don't let it grow so long that the message needs more lines (unless
+    # it needs several anyway, then it may take up to half of every line)
+    budget = line_budget(client.nickname, client.ident, client.hostmask, send_type, "")
+    longest = max(bytelen(line) for line in sep.join(data).split("\n")) + bytelen(first)
+    room = budget - longest
+    if room < 0:
+        room = budget // 2
+
+    group = []
+    size = -1
+    for name in names:
+        length = bytelen(name) + 1
+        if group and (len(group) == limit or size + length > room):
+            yield group
+            group = []
+            size = -1
+        group.append(name)
+        size += length
+    if group:
+        yield group
 
 def lower(nick, *, casemapping=None):
     if nick is None:
@@ -79,23 +172,194 @@ def lower(nick, *, casemapping=None):
     if casemapping is None:
         casemapping = Features["CASEMAPPING"]
 
-    mapping = {
-        "[": "{",
-        "]": "}",
-        "\\": "|",
-        "^": "~",
-    }
-
-    if casemapping == "strict-rfc1459":
-        mapping.pop("^")
-    elif casemapping == "ascii":
-        mapping.clear()
-
-    return nick.lower().translate(str.maketrans(mapping))
+    return _casemapping.lower(nick, casemapping)
 
 def equals(nick1, nick2):
     return nick1 is not None and nick2 is not None and lower(nick1) == lower(nick2)
 
+class IRCDict(dict):
+    """A dict keyed by nicks, accounts, hostmasks or channel names.
+
+    Keys are folded with lower() when they are added, so lookups are
+    case-insensitive according to the server's casemapping. Iterating
+    yields the folded keys. If default_factory is given, it behaves like
+    a collections.defaultdict.
+
+    """
+
+    __slots__ = ("default_factory",)
+
+    _fold = staticmethod(lower)
+
+    def __init__(self, default_factory=None, *args, **kwargs):
+        super().__init__()
+        self.default_factory = default_factory
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return super().__getitem__(self._fold(key))
+
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        value = self.default_factory()
+        super().__setitem__(key, value) # key is already folded
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(self._fold(key), value)
+
+    def __delitem__(self, key):
+        super().__delitem__(self._fold(key))
+
+    def __contains__(self, key):
+        return super().__contains__(self._fold(key))
+
+    def get(self, key, default=None):
+        return super().get(self._fold(key), default)
+
+    def pop(self, key, *default):
+        return super().pop(self._fold(key), *default)
+
+    def setdefault(self, key, default=None):
+        return super().setdefault(self._fold(key), default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return type(self)(self.default_factory, self)
+
+    def __repr__(self):
+        return "{0}({1!r}, {2})".format(type(self).__name__, self.default_factory, super().__repr__())
+
+class IRCSet(set):
+    """A set of nicks, accounts, hostmasks or channel names, compared case-insensitively.
+
+    Items are folded with lower() when they are added; set operators
+    which return a new set return a plain set of the folded items.
+
+    """
+
+    __slots__ = ()
+
+    _fold = staticmethod(lower)
+
+    def __init__(self, iterable=()):
+        super().__init__(self._fold(item) for item in iterable)
+
+    def __contains__(self, item):
+        return super().__contains__(self._fold(item))
+
+    def add(self, item):
+        super().add(self._fold(item))
+
+    def discard(self, item):
+        super().discard(self._fold(item))
+
+    def remove(self, item):
+        super().remove(self._fold(item))
+
+    def update(self, *iterables):
+        for iterable in iterables:
+            super().update(self._fold(item) for item in iterable)
+
+    def copy(self):
+        return type(self)(self)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, set(self))
+
+def lower_hostmask(hostmask):
+    """Fold a nick!ident@host, ident@host or bare host; the host is folded as ascii."""
+    if hostmask is None:
+        return None
+    left, sep, host = hostmask.rpartition("@")
+    return lower(left) + sep + lower(host, casemapping="ascii")
+
+def _invalidates(method):
+    """Wrap a mutating method so that it discards the compiled hostmasks."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._compiled = None
+        return method(self, *args, **kwargs)
+    return wrapper
+
+class _HostmaskMatching:
+    """Match users against every hostmask of a HostmaskDict or HostmaskSet.
+
+    The hostmasks are compiled on first use and recompiled after the
+    collection changes, so checking a user is a lookup rather than a loop
+    over every hostmask.
+
+    """
+
+    __slots__ = ()
+
+    def compiled(self):
+        casemapping = Features["CASEMAPPING"]
+        compiled = self._compiled
+        if compiled is None or compiled.casemapping != casemapping:
+            compiled = self._compiled = _hostmasks.Hostmasks(self, casemapping)
+        return compiled
+
+    def match(self, nick, ident, host):
+        """Return True if the folded nick, ident and host match any hostmask."""
+        return self.compiled().match(nick, ident, host)
+
+    def matching(self, nick, ident, host):
+        """Return the hostmasks which the folded nick, ident and host match."""
+        return self.compiled().matching(nick, ident, host)
+
+class HostmaskDict(_HostmaskMatching, IRCDict):
+    """An IRCDict keyed by hostmasks, whose host part is folded as ascii."""
+
+    __slots__ = ("_compiled",)
+
+    _fold = staticmethod(lower_hostmask)
+
+    def __init__(self, *args, **kwargs):
+        self._compiled = None
+        super().__init__(*args, **kwargs)
+
+    __setitem__ = _invalidates(IRCDict.__setitem__)
+    __delitem__ = _invalidates(IRCDict.__delitem__)
+    pop = _invalidates(IRCDict.pop)
+    popitem = _invalidates(dict.popitem)
+    setdefault = _invalidates(IRCDict.setdefault)
+    clear = _invalidates(dict.clear)
+
+    def __missing__(self, key):
+        if self.default_factory is not None: # only then is a key added; a KeyError changes nothing
+            self._compiled = None
+        return IRCDict.__missing__(self, key)
+
+class HostmaskSet(_HostmaskMatching, IRCSet):
+    """An IRCSet of hostmasks, whose host part is folded as ascii."""
+
+    __slots__ = ("_compiled",)
+
+    _fold = staticmethod(lower_hostmask)
+
+    def __init__(self, iterable=()):
+        self._compiled = None
+        super().__init__(iterable)
+
+    add = _invalidates(IRCSet.add)
+    discard = _invalidates(IRCSet.discard)
+    remove = _invalidates(IRCSet.remove)
+    update = _invalidates(IRCSet.update)
+    pop = _invalidates(set.pop)
+    clear = _invalidates(set.clear)
+    difference_update = _invalidates(set.difference_update)
+    intersection_update = _invalidates(set.intersection_update)
+    symmetric_difference_update = _invalidates(set.symmetric_difference_update)
+    __ior__ = _invalidates(set.__ior__)
+    __iand__ = _invalidates(set.__iand__)
+    __isub__ = _invalidates(set.__isub__)
+    __ixor__ = _invalidates(set.__ixor__)
+
 def context_types(*types):
     def wrapper(cls):
         cls._getters = l = []
@@ -111,7 +375,7 @@ def context_types(*types):
 class IRCContext:
     """Base class for channels and users."""
 
-    _messages = defaultdict(list)
+    __slots__ = ("name", "client", "ref")
 
     def __init__(self, name, client):
         self.name = name
@@ -151,31 +415,26 @@ class IRCContext:
             return "NOTICE"
         return "PRIVMSG"
 
-    def queue_message(self, message):
+    def queue_message(self, message, *, notice=False, privmsg=False, tag=None):
+        """Queue a message (a string or a list of strings) until send_messages() is called.
+
+        Identical messages queued for several targets are then sent to as
+        many of them at once as the server allows.
+
+        """
+
+        if isinstance(message, str):
+            message = (message,)
+
         if self.is_fake:
-            self.send(message) # Don't actually queue it
+            self.send(*message) # Don't actually queue it
             return
 
-        if isinstance(message, list):
-            message = tuple(message)
-
-        self._messages[message].append(self)
+        queue(self.client, self.get_send_type(is_notice=notice, is_privmsg=privmsg), self.name, message, tag=tag)
 
     @classmethod
-    def send_messages(cls, *, notice=False, privmsg=False):
-        for message, targets in cls._messages.items():
-            if isinstance(message, str):
-                message = (message,)
-            send_types = defaultdict(list)
-            for target in targets:
-                send_types[target.get_send_type(is_notice=notice, is_privmsg=privmsg)].append(target)
-            for send_type, targets in send_types.items():
-                max_targets = Features["TARGMAX"][send_type]
-                while targets:
-                    using, targets = targets[:max_targets], targets[max_targets:]
-                    _send(message, "", " ", using[0].client, send_type, ",".join([t.nick for t in using]))
-
-        cls._messages.clear()
+    def send_messages(cls):
+        send_queued()
 
     @classmethod
     def get_context_type(cls, *, max_types=1):
@@ -207,7 +466,7 @@ class IRCContext:
 
         return _who(self.client, self.name, data)
 
-    def send(self, *data, first=None, sep=None, notice=False, privmsg=False, prefix=None):
+    def send(self, *data, first=None, sep=None, notice=False, privmsg=False, prefix=None, tag=None):
         if self.is_fake:
             # Leave out 'fake' from the message; get_context_type() takes care of that
             debuglog("Would message {0} {1}: {2!r}".format(self.get_context_type(), self.name, " ".join(data)))
@@ -221,4 +480,4 @@ class IRCContext:
             first = ""
         if sep is None:
             sep = " "
-        _send(data, first, sep, self.client, send_type, name)
+        send(self.client, send_type, name, data, first=first, sep=sep, tag=tag)
@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 
 import botconfig
 import src.settings as var
+from src.context import IRCDict, IRCSet, HostmaskDict, HostmaskSet
 from src.utilities import irc_lower, break_long_message, role_order, singular
 
 # increment this whenever making a schema change so that the schema upgrade functions run on start
@@ -41,26 +42,26 @@ def init_vars():
                        ON at.id = a.template
                      WHERE pl.active = 1""")
 
-        var.SIMPLE_NOTIFY = set()  # cloaks of people who !simple, who don't want detailed instructions
-        var.SIMPLE_NOTIFY_ACCS = set() # same as above, except accounts. takes precedence
-        var.PREFER_NOTICE = set()  # cloaks of people who !notice, who want everything /notice'd
-        var.PREFER_NOTICE_ACCS = set() # Same as above, except accounts. takes precedence
-        var.STASISED = defaultdict(int)
-        var.STASISED_ACCS = defaultdict(int)
-        var.PING_IF_PREFS = {}
-        var.PING_IF_PREFS_ACCS = {}
-        var.PING_IF_NUMS = defaultdict(set)
-        var.PING_IF_NUMS_ACCS = defaultdict(set)
-        var.DEADCHAT_PREFS = set()
-        var.DEADCHAT_PREFS_ACCS = set()
-        var.FLAGS = defaultdict(str)
-        var.FLAGS_ACCS = defaultdict(str)
-        var.DENY = defaultdict(set)
-        var.DENY_ACCS = defaultdict(set)
+        # keys are folded on insert, so look them up without lowering them first
+        var.SIMPLE_NOTIFY = HostmaskSet()  # cloaks of people who !simple, who don't want detailed instructions
+        var.SIMPLE_NOTIFY_ACCS = IRCSet() # same as above, except accounts. takes precedence
+        var.PREFER_NOTICE = HostmaskSet()  # cloaks of people who !notice, who want everything /notice'd
+        var.PREFER_NOTICE_ACCS = IRCSet() # Same as above, except accounts. takes precedence
+        var.STASISED = HostmaskDict(int)
+        var.STASISED_ACCS = IRCDict(int)
+        var.PING_IF_PREFS = HostmaskDict()
+        var.PING_IF_PREFS_ACCS = IRCDict()
+        var.PING_IF_NUMS = defaultdict(HostmaskSet)
+        var.PING_IF_NUMS_ACCS = defaultdict(IRCSet)
+        var.DEADCHAT_PREFS = HostmaskSet()
+        var.DEADCHAT_PREFS_ACCS = IRCSet()
+        var.FLAGS = HostmaskDict(str)
+        var.FLAGS_ACCS = IRCDict(str)
+        var.DENY = HostmaskDict(set)
+        var.DENY_ACCS = IRCDict(set)
 
         for acc, host, notice, simple, dc, pi, stasis, stasisexp, flags in c:
             if acc is not None:
-                acc = irc_lower(acc)
                 if simple == 1:
                     var.SIMPLE_NOTIFY_ACCS.add(acc)
                 if notice == 1:
@@ -75,12 +76,6 @@ def init_vars():
                 if flags:
                     var.FLAGS_ACCS[acc] = flags
             elif host is not None:
-                # nick!ident lowercased per irc conventions, host uses normal casing
-                try:
-                    hl, hr = host.split("@", 1)
-                    host = irc_lower(hl) + "@" + hr.lower()
-                except ValueError:
-                    host = host.lower()
                 if simple == 1:
                     var.SIMPLE_NOTIFY.add(host)
                 if notice == 1:
@@ -115,10 +110,8 @@ def init_vars():
                        )""")
         for acc, host, command in c:
             if acc is not None:
-                acc = irc_lower(acc)
                 var.DENY_ACCS[acc].add(command)
             if host is not None:
-                host = irc_lower(host)
                 var.DENY[host].add(command)
 
 def decrement_stasis(acc=None, hostmask=None):
@@ -262,7 +262,7 @@ class command:
         if users.equals(chan, users.Bot.nick): # PM
             target = users.Bot
         else:
-            target = channels.get(chan, allow_none=True)
+            target = channels.get(chan, cli, allow_none=True)
 
         if user is None or target is None:
             return
@@ -307,15 +307,13 @@ class command:
             dispatcher.pm(messages["not_owner"])
             return
 
-        temp = user.lower()
-
-        flags = var.FLAGS[temp.rawnick] + var.FLAGS_ACCS[temp.account] # TODO: add flags handling to User
+        flags = var.FLAGS.get(user.rawnick, "") + var.FLAGS_ACCS.get(user.account, "") # TODO: add flags handling to User
 
         if self.flag and (user.is_admin() or user.is_owner()):
             adminlog(chan, rawnick, self.name, rest)
             return self.func(var, dispatcher, rest)
 
-        denied_commands = var.DENY[temp.rawnick] | var.DENY_ACCS[temp.account] # TODO: add denied commands handling to User
+        denied_commands = var.DENY.get(user.rawnick, set()) | var.DENY_ACCS.get(user.account, set()) # TODO: add denied commands handling to User
 
         if self.commands & denied_commands:
             dispatcher.pm(messages["invalid_permissions"])
@@ -468,13 +466,13 @@ class cmd:
                 cli.notice(nick, messages["not_owner"])
             return
 
-        flags = var.FLAGS[hostmask] + var.FLAGS_ACCS[acc]
+        flags = var.FLAGS.get(hostmask, "") + var.FLAGS_ACCS.get(acc, "")
         admin = is_admin(nick, ident, host)
         if self.flag and (admin or owner):
             adminlog(chan, rawnick, self.name, rest)
             return self.func(*largs)
 
-        denied_cmds = var.DENY[hostmask] | var.DENY_ACCS[acc]
+        denied_cmds = var.DENY.get(hostmask, set()) | var.DENY_ACCS.get(acc, set())
         for command in self.cmds:
             if command in denied_cmds:
                 if chan == nick:
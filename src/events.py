@@ -1,21 +1,124 @@
 # event system
-from collections import defaultdict
+import functools
+import inspect
+import time
+from collections import namedtuple
 from types import SimpleNamespace
-EVENT_CALLBACKS = defaultdict(list)
+
+# {event name: tuple of (priority, callback) pairs, sorted by priority}
+# The tuples are never modified; adding or removing a listener replaces
+# them, so dispatching can walk them without copying.
+EVENT_CALLBACKS = {}
+
+# {(event name, priority, callback): [calls, total time, max time]}, filled while profiling
+PROFILE_STATS = {}
+_profiling = False
+
+# {event name: EventSchema}, see declare() and the declarations at the bottom of this file
+EVENT_SCHEMAS = {}
+
+# args are the positional arguments given to dispatch() (after the event itself),
+# keywords the keyword arguments given to dispatch(), data the keys of Event.data
+# and params the keyword arguments given to Event()
+EventSchema = namedtuple("EventSchema", ("name", "args", "keywords", "data", "params"))
 
 __all__ = ["add_listener", "remove_listener", "Event"]
 
+def declare(name, args, *, keywords=(), data=(), params=()):
+    """Declare an event. Every event must be declared before listeners can be added to it."""
+    if name in EVENT_SCHEMAS:
+        raise ValueError("Event {0!r} is already declared".format(name))
+    EVENT_SCHEMAS[name] = EventSchema(name, tuple(args), tuple(keywords), tuple(data), tuple(params))
+
+def _check_listener(event, callback):
+    schema = EVENT_SCHEMAS.get(event)
+    if schema is None:
+        raise ValueError("Cannot add listener {0} to undeclared event {1!r}".format(_listener_name(callback), event))
+
+    # unwrap handle_error and event_listener, keeping track of the instance the former is bound to
+    func = callback
+    args = [None] * (len(schema.args) + 1)
+    while hasattr(func, "func") and not isinstance(func, functools.partial):
+        if getattr(func, "instance", None) is not None:
+            args.insert(0, func.instance)
+        func = func.func
+
+    try:
+        sig = inspect.signature(func)
+    except (TypeError, ValueError): # some builtins and C callables have no signature; don't bother
+        return
+
+    try:
+        sig.bind(*args, **dict.fromkeys(schema.keywords))
+    except TypeError as e:
+        raise TypeError("Listener {0}{1} does not match event {2!r}, which is dispatched with (evt, {3}): {4}".format(
+            _listener_name(callback), sig, event, ", ".join(schema.args + tuple(k + "=" for k in schema.keywords)), e)) from None
+
+def _priority(item):
+    return item[0]
+
 def add_listener(event, callback, priority=5):
-    if (priority, callback) not in EVENT_CALLBACKS[event]:
-        EVENT_CALLBACKS[event].append((priority, callback))
-        EVENT_CALLBACKS[event].sort(key = lambda x: x[0])
+    _check_listener(event, callback)
+    listeners = EVENT_CALLBACKS.get(event, ())
+    if (priority, callback) not in listeners:
+        # sorted() is stable, so listeners with the same priority keep the order they were added in
+        EVENT_CALLBACKS[event] = tuple(sorted(listeners + ((priority, callback),), key=_priority))
 
 def remove_listener(event, callback, priority = 5):
-    if (priority, callback) in EVENT_CALLBACKS[event]:
-        EVENT_CALLBACKS[event].remove((priority, callback))
+    listeners = EVENT_CALLBACKS.get(event, ())
+    if (priority, callback) in listeners:
+        listeners = tuple(item for item in listeners if item != (priority, callback))
+        if listeners:
+            EVENT_CALLBACKS[event] = listeners
+        else:
+            del EVENT_CALLBACKS[event]
+
+def start_profiling():
+    """Start timing every listener call. Existing stats are kept."""
+    global _profiling
+    _profiling = True
+
+def stop_profiling():
+    global _profiling
+    _profiling = False
+
+def reset_profiling():
+    PROFILE_STATS.clear()
+
+def _listener_name(callback):
+    # unwrap handle_error, event_listener and functools.partial
+    while hasattr(callback, "func"):
+        callback = callback.func
+    module = getattr(callback, "__module__", None)
+    name = getattr(callback, "__qualname__", None) or repr(callback)
+    if module:
+        return "{0}.{1}".format(module, name)
+    return name
+
+def unused_events():
+    """Return the sorted names of the declared events that have no listeners."""
+    return sorted(name for name in EVENT_SCHEMAS if name not in EVENT_CALLBACKS)
+
+def profile_table(limit=None):
+    """Return the profiling stats as lines of text, slowest listeners (by total time) first.
+
+    Times include any events dispatched from within a listener.
+
+    """
+
+    rows = sorted(PROFILE_STATS.items(), key=lambda x: x[1][1], reverse=True)
+    if limit is not None:
+        rows = rows[:limit]
+    lines = []
+    for (event, priority, callback), (calls, total, most) in rows:
+        lines.append("{0:9.3f}s {1:8d} calls {2:9.3f}ms avg {3:9.3f}ms max  {4} ({5}) {6}".format(
+            total, calls, total / calls * 1000, most * 1000, event, priority, _listener_name(callback)))
+    return lines
 
 class Event:
     def __init__(self, _name, _data, **kwargs):
+        if _name not in EVENT_SCHEMAS:
+            raise ValueError("Event {0!r} is not declared".format(_name))
         self.stop_processing = False
         self.prevent_default = False
         self.name = _name
@@ -23,13 +126,143 @@ class Event:
         self.params = SimpleNamespace(**kwargs)
 
     def dispatch(self, *args, **kwargs):
+        if _profiling:
+            return self._dispatch_profiled(args, kwargs)
+
+        self.stop_processing = False
+        self.prevent_default = False
+        if kwargs:
+            for priority, callback in EVENT_CALLBACKS.get(self.name, ()):
+                callback(self, *args, **kwargs)
+                if self.stop_processing:
+                    break
+        else: # most events have no keyword arguments, don't build an empty dict for every listener
+            for priority, callback in EVENT_CALLBACKS.get(self.name, ()):
+                callback(self, *args)
+                if self.stop_processing:
+                    break
+
+        return not self.prevent_default
+
+    def _dispatch_profiled(self, args, kwargs):
         self.stop_processing = False
         self.prevent_default = False
-        for item in list(EVENT_CALLBACKS[self.name]):
-            item[1](self, *args, **kwargs)
+        for priority, callback in EVENT_CALLBACKS.get(self.name, ()):
+            start = time.perf_counter()
+            try:
+                callback(self, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                stats = PROFILE_STATS.get((self.name, priority, callback))
+                if stats is None:
+                    stats = PROFILE_STATS[(self.name, priority, callback)] = [0, 0.0, 0.0]
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
             if self.stop_processing:
                 break
 
         return not self.prevent_default
 
+# Event declarations. Keep these in sync with the dispatch() calls; listeners are
+# checked against them when they are added, so a listener for an event that is
+# no longer dispatched fails loudly instead of silently never being called.
+
+declare("init", ())
+
+# IRC and bookkeeping events
+declare("who_result", ("var", "chan", "user"),
+        params=("away", "data", "ip_address", "server", "hop_count", "idle_time", "extended_who"))
+declare("who_end", ("var", "target"))
+declare("mode_change", ("var", "actor", "target"), data=("mode", "targets"))
+declare("end_listmode", ("var", "chan", "mode"))
+declare("nick_change", ("var", "user", "old_rawnick"))
+declare("account_change", ("var", "user"))
+declare("chan_join", ("var", "chan", "user"))
+declare("chan_part", ("var", "chan", "user", "reason"))
+declare("chan_kick", ("var", "chan", "actor", "user", "reason"))
+declare("server_quit", ("var", "user", "reason"))
+declare("cleanup_user", ("var", "user"))
+declare("swap_player", ("var", "old_user", "user"))
+declare("rename_player", ("cli", "var", "prefix", "nick"))
+declare("reset", ("var",))
+
+# commands
+declare("join", ("var", "wrapper", "message"), keywords=("forced",),
+        data=("join_player", "join_deadchat", "vote_gamemode"))
+declare("abstain", ("cli", "var", "nick"))
+declare("myrole", ("cli", "var", "nick"), data=("role", "messages"))
+declare("revealroles", ("var", "wrapper"), data=("output",))
+declare("revealroles_role", ("var", "wrapper", "nickname", "role"), data=("special_case",))
+declare("frole_role", ("cli", "var", "who", "role", "oldrole", "args"))
+declare("frole_template", ("cli", "var", "addrem", "who", "template", "args"))
+declare("can_exchange", ("var", "actor", "nick"))
+declare("exchange_roles", ("cli", "var", "actor", "nick", "actor_role", "nick_role"),
+        data=("actor_messages", "nick_messages"))
+declare("targeted_command", ("cli", "var", "cmd", "actor", "orig_target", "tags"),
+        data=("target", "misdirection", "exchange"), params=("action",))
+declare("doctor_immunize", ("cli", "var", "doctor", "target"), data=("success", "message"))
+
+# game setup and queries
+declare("role_attribution", ("cli", "var", "chk_win_conditions", "villagers"), data=("addroles",))
+declare("role_assignment", ("cli", "var", "gamemode", "pl", "restart"))
+declare("list_participants", ("var",), data=("pl",))
+declare("get_participant_role", ("var", "nick"), data=("role",))
+declare("get_reveal_role", ("var", "nick"), data=("role",))
+declare("get_special", ("cli", "var"), data=("special",))
+declare("get_voters", ("cli", "var"), data=("voters",))
+declare("get_role_metadata", ("cli", "var", "kind")) # data is keyed by role
+declare("wolflist", ("cli", "var", "player", "wolf"), data=("tags",))
+declare("night_acted", ("cli", "var", "target", "spy"), data=("acted",))
+
+# day
+declare("begin_day", ("cli", "var"))
+declare("transition_day_begin", ("cli", "var"))
+declare("transition_day", ("cli", "var"),
+        data=("victims", "killers", "bywolves", "onlybywolves", "protected", "bitten", "numkills"))
+declare("bite", ("cli", "var", "alpha", "target"), data=("can_bite", "kill"),
+        params=("victims", "killers", "bywolves", "onlybywolves", "protected", "bitten", "numkills"))
+declare("transition_day_resolve", ("cli", "var", "victim"),
+        data=("message", "novictmsg", "dead", "bywolves", "onlybywolves", "killers", "protected", "bitten"))
+declare("transition_day_resolve_end", ("cli", "var", "victims"),
+        data=("message", "novictmsg", "dead", "bywolves", "onlybywolves", "killers", "protected", "bitten"))
+declare("transition_day_end", ("cli", "var"), data=("begin_day",))
+declare("chk_decision", ("cli", "var", "force"),
+        data=("not_lynching", "votelist", "numvotes", "weights", "transition_night"), params=("voters", "timeout"))
+declare("chk_decision_abstain", ("cli", "var", "not_lynching"), params=("votelist", "numvotes"))
+declare("chk_decision_lynch", ("cli", "var", "voters"), data=("votee", "deadlist"),
+        params=("del_player", "original_votee", "force", "votelist", "not_lynching"))
+declare("lynch", ("cli", "var", "nick"), data=("target",))
+declare("revealing_totem", ("cli", "var", "votee"), data=("role",))
+declare("desperation_totem", ("cli", "var", "votee", "target", "prot"))
+declare("retribution_kill", ("cli", "var", "victim", "orig_target"), data=("target", "message"))
+declare("retribution_totem", ("cli", "var", "victim", "loser", "prot"), data=("message",))
+
+# night
+declare("transition_night_begin", ("cli", "var"))
+declare("transition_night_end", ("cli", "var"))
+declare("chk_nightdone", ("cli", "var"), data=("actedcount", "nightroles", "transition_day"))
+declare("amnesiac_turn", ("var", "amnesiac", "role"))
+declare("dullahan_targets", ("cli", "var", "dullahans", "max_targets"), data=("targets",))
+declare("get_random_totem_targets", ("cli", "var", "shaman"), data=("targets",))
+declare("see", ("cli", "var", "nick", "victim"), data=("role",))
+declare("investigate", ("cli", "var", "nick", "victim"), data=("role",))
+declare("harlot_visit", ("cli", "var", "harlot", "victim"))
+declare("succubus_visit", ("cli", "var", "succubus", "victim"))
+declare("fallen_angel_guard_break", ("cli", "var", "victim", "killer")) # shares its data with del_player
+declare("vg_kill", ("var", "ghost", "target"), data=("pl",))
+
+# deaths and the end of the game
+declare("del_player", ("cli", "var", "nick", "nickrole", "nicktpls", "death_triggers"), data=("pl",),
+        params=("forced_death", "end_game", "deadlist", "original", "killer_role", "ismain", "refresh_pl", "del_player"))
+declare("assassinate", ("cli", "var", "nick", "target", "prot"), data=("pl",),
+        params=("del_player", "deadlist", "original", "refresh_pl", "message_prefix", "nickrole", "nicktpls", "prots"))
+declare("update_stats", ("cli", "var", "nick", "nickrole", "nickreveal", "nicktpls"), data=("possible", "known_role"),
+        params=("killer_role", "ismain"))
+declare("reconfigure_stats", ("cli", "var", "stats"))
+declare("chk_win", ("cli", "var", "rolemap", "lpl", "lwolves", "lrealwolves"),
+        data=("winner", "message", "additional_winners"))
+declare("player_win", ("var", "user", "role", "winner", "survived"), data=("won", "iwon", "special"))
+
 # vim: set sw=4 expandtab:
@@ -1226,8 +1226,7 @@ class MaelstromMode(GameMode):
         var.ORIGINAL_ROLES[role].add(wrapper.source.nick)
         var.FINAL_ROLES[wrapper.source.nick] = role
         var.LAST_SAID_TIME[wrapper.source.nick] = datetime.now()
-        if wrapper.source.nick in var.USERS:
-            var.PLAYERS[wrapper.source.nick] = var.USERS[wrapper.source.nick]
+        var.PLAYERS[wrapper.source.nick] = wrapper.source
 
         if role == "doctor":
             lpl = len(list_players())
@@ -3,10 +3,10 @@
 import base64
 import socket
 import sys
-import threading
 import time
 import traceback
 import functools
+import re
 
 import botconfig
 import src.settings as var
@@ -17,11 +17,18 @@ from src.dispatcher import MessageDispatcher
 from src.decorators import handle_error
 
 cmd = decorators.cmd
+command = decorators.command
 hook = decorators.hook
 
+# server notice telling us that we're sending too fast (ratbox, charybdis, solanum, hybrid):
+# "*** Message to <target> throttled due to flooding"
+_flood_notice = re.compile(r"^\*\*\* Message to \S+ throttled due to flooding")
+
 @handle_error
 def on_privmsg(cli, rawnick, chan, msg, *, notice=False, force_role=None):
     if notice and "!" not in rawnick or not rawnick: # server notice; we don't care about those
+        if notice and _flood_notice.match(msg): # except when they tell us to slow down
+            cli.tokenbucket.report_throttle()
         return
 
     user = users._get(rawnick, allow_none=True) # FIXME
@@ -29,7 +36,7 @@ def on_privmsg(cli, rawnick, chan, msg, *, notice=False, force_role=None):
     if users.equals(chan, users.Bot.nick): # PM
         target = users.Bot
     else:
-        target = channels.get(chan, allow_none=True)
+        target = channels.get(chan, cli, allow_none=True)
 
     if user is None or target is None:
         return
@@ -139,6 +146,51 @@ def latency(cli, nick, chan, rest):
         reply(cli, nick, chan, messages["latency"].format(lat, "" if lat == 1 else "s"))
         hook.unhook(300)
 
+@command("floodcontrol", flag="D", pm=True)
+def flood_control(var, wrapper, message):
+    """Show the current state of the outgoing flood control."""
+    bucket = wrapper.client.tokenbucket
+    stats = wrapper.client.send_queue.stats()
+    wrapper.pm(messages["flood_control"].format(bucket.capacity, bucket.fill_rate, bucket.tokens,
+                                                -1 if bucket.lag is None else bucket.lag,
+                                                bucket.throttle_count, stats["depth"],
+                                                stats["avg_wait"], stats["max_wait"], stats["dropped"],
+                                                stats["merged"], stats["cancelled"]))
+
+@command("eventprofile", flag="D", pm=True)
+def event_profile(var, wrapper, message):
+    """Time the event listeners, and show which ones are slow."""
+    args = message.split()
+    action = args[0].lower() if args else ""
+
+    if action == "on":
+        events.start_profiling()
+        wrapper.pm(messages["event_profile_on"])
+    elif action == "off":
+        events.stop_profiling()
+        wrapper.pm(messages["event_profile_off"])
+    elif action == "reset":
+        events.reset_profiling()
+        wrapper.pm(messages["event_profile_reset"])
+    elif action == "dump":
+        if not events.PROFILE_STATS:
+            wrapper.pm(messages["event_profile_empty"])
+        elif len(args) > 1 and args[1].lower() == "full":
+            lines = events.profile_table()
+            with open("eventprofile.log", "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            wrapper.pm(messages["event_profile_written"].format(len(lines), "eventprofile.log"))
+        elif len(args) > 1:
+            wrapper.pm(messages["event_profile_usage"])
+        else:
+            for line in events.profile_table(limit=20):
+                if channels.Dev is not None:
+                    channels.Dev.send(line, prefix=botconfig.DEV_PREFIX)
+                else:
+                    wrapper.pm(line)
+    else:
+        wrapper.pm(messages["event_profile_usage"])
+
 def connect_callback(cli):
     regaincount = 0
     releasecount = 0
@@ -148,9 +200,6 @@ def connect_callback(cli):
     def prepare_stuff(cli, prefix, *args):
         alog("Received end of MOTD from {0}".format(prefix))
 
-        # This callback only sets up event listeners
-        wolfgame.connect_callback()
-
         # just in case we haven't managed to successfully auth yet
         if botconfig.PASS and not botconfig.SASL_AUTHENTICATION:
             cli.ns_identify(botconfig.USERNAME or botconfig.NICK,
@@ -158,6 +207,16 @@ def connect_callback(cli):
                             nickserv=var.NICKSERV,
                             command=var.NICKSERV_IDENTIFY_COMMAND)
 
+        if channels.Main is not None:
+            # We reconnected; everything is still set up, so we only need to get back into our channels
+            channels.rejoin(cli)
+            if users.Bot.nick != botconfig.NICK:
+                users.Bot.change_nick(botconfig.NICK)
+            return
+
+        # This callback only sets up event listeners
+        wolfgame.connect_callback()
+
         channels.Main = channels.add(botconfig.CHANNEL, cli)
         channels.Dummy = channels.add("*", cli)
 
@@ -179,10 +238,7 @@ def connect_callback(cli):
         if var.SERVER_PING_INTERVAL > 0:
             def ping_server_timer(cli):
                 ping_server(cli)
-
-                t = threading.Timer(var.SERVER_PING_INTERVAL, ping_server_timer, args=(cli,))
-                t.daemon = True
-                t.start()
+                cli.call_later(var.SERVER_PING_INTERVAL, ping_server_timer, cli)
 
             ping_server_timer(cli)
 
@@ -194,9 +250,16 @@ def connect_callback(cli):
 
     events.add_listener("who_end", setup_handler)
 
+    def use_temp_nick():
+        users.Bot.nick += "_"
+        users.Bot.change_nick()
+
     def mustregain(cli, server, bot_nick, nick, msg):
         nonlocal regaincount
 
+        if bot_nick == "*": # not registered yet; our old connection may not have timed out
+            use_temp_nick()
+            return
         if not botconfig.PASS or bot_nick == nick or regaincount > 3:
             return
         if var.NICKSERV_REGAIN_COMMAND:
@@ -212,6 +275,9 @@ def connect_callback(cli):
     def mustrelease(cli, server, bot_nick, nick, msg):
         nonlocal releasecount
 
+        if bot_nick == "*":
+            use_temp_nick()
+            return
         if not botconfig.PASS or bot_nick == nick or releasecount > 3:
             return # prevents the bot from trying to release without a password
         if var.NICKSERV_RELEASE_COMMAND:
@@ -224,8 +290,7 @@ def connect_callback(cli):
     @hook("unavailresource", hookid=239)
     @hook("nicknameinuse", hookid=239)
     def must_use_temp_nick(cli, *etc):
-        users.Bot.nick += "_"
-        users.Bot.change_nick()
+        use_temp_nick()
         cli.user(botconfig.NICK, "") # TODO: can we remove this?
 
         hook.unhook(239)
@@ -290,4 +355,13 @@ def connect_callback(cli):
 
     users.Bot = users.BotUser(cli, botconfig.NICK)
 
+def disconnect_callback(cli):
+    alog("Lost the connection to the server")
+
+    # Register with the nick we had, so that the bot user stays in sync
+    cli.nickname = users.Bot.nick
+
+    # The game state is kept as is; the channel members are fetched again after rejoining
+    channels.disconnected(cli)
+
 # vim: set sw=4 expandtab:
@@ -6,6 +6,8 @@ further in the relevant hook functions.
 
 """
 
+import time
+
 from src.decorators import event_listener, hook
 from src.context import Features
 from src.events import Event
@@ -49,20 +51,11 @@ def who_reply(cli, bot_server, bot_nick, chan, ident, host, server, nick, status
     user = users._add(cli, nick=nick, ident=ident, host=host, realname=realname) # FIXME
     ch = channels.add(chan, cli)
 
-    if ch not in user.channels:
-        user.channels[ch] = modes
-        ch.users.add(user)
-        for mode in modes:
-            if mode not in ch.modes:
-                ch.modes[mode] = set()
-            ch.modes[mode].add(user)
+    ch.add_user(user, modes)
 
     event = Event("who_result", {}, away=is_away, data=0, ip_address=None, server=server, hop_count=hop, idle_time=None, extended_who=False)
     event.dispatch(var, ch, user)
 
-    if ch is channels.Main and not users.exists(nick): # FIXME
-        users.add(nick, ident=ident, host=host, account="*", inchan=True, modes=modes, moded=set())
-
 @hook("whospcrpl")
 def extended_who_reply(cli, bot_server, bot_nick, data, chan, ident, ip_address, host, server, nick, status, hop, idle, account, realname):
     """Handle WHOX responses for servers that support it.
@@ -112,20 +105,11 @@ def extended_who_reply(cli, bot_server, bot_nick, data, chan, ident, ip_address,
     user = users._add(cli, nick=nick, ident=ident, host=host, realname=realname, account=account) # FIXME
     ch = channels.add(chan, cli)
 
-    if ch not in user.channels:
-        user.channels[ch] = modes
-        ch.users.add(user)
-        for mode in modes:
-            if mode not in ch.modes:
-                ch.modes[mode] = set()
-            ch.modes[mode].add(user)
+    ch.add_user(user, modes)
 
     event = Event("who_result", {}, away=is_away, data=data, ip_address=ip_address, server=server, hop_count=hop, idle_time=idle, extended_who=True)
     event.dispatch(var, ch, user)
 
-    if ch is channels.Main and not users.exists(nick): # FIXME
-        users.add(nick, ident=ident, host=host, account=account, inchan=True, modes=modes, moded=set())
-
 @hook("endofwho")
 def end_who(cli, bot_server, bot_nick, target, rest):
     """Handle the end of WHO/WHOX responses from the server.
@@ -145,7 +129,7 @@ def end_who(cli, bot_server, bot_nick, target, rest):
     """
 
     try:
-        target = channels.get(target)
+        target = channels.get(target, cli)
     except KeyError:
         try:
             target = users._get(target) # FIXME
@@ -156,6 +140,7 @@ def end_who(cli, bot_server, bot_nick, target, rest):
             for name, params, args in target._pending:
                 Event(name, params).dispatch(*args)
             target._pending = None
+        target._resync()
 
     Event("who_end", {}).dispatch(var, target)
 
@@ -176,6 +161,42 @@ def on_ping(cli, prefix, server):
     with cli:
         cli.send("PONG", server)
 
+@hook("pong")
+def on_pong(cli, server, target, ts):
+    """Feed the round-trip time of our own PINGs into the flood control.
+
+    Ordering and meaning of arguments for a PONG reply:
+
+    0 - The IRCClient instance (like everywhere else)
+    1 - The server which sent out the reply
+    2 - The server which was pinged
+    3 - The data sent with the PING (a UNIX timestamp for our PINGs)
+
+    """
+
+    try:
+        lag = time.time() - float(ts)
+    except ValueError:
+        return
+
+    cli.tokenbucket.report_lag(lag)
+
+@hook("tryagain")
+def on_try_again(cli, server, bot_nick, command, message):
+    """Slow down when the server asks us to try again later.
+
+    Ordering and meaning of arguments for RPL_TRYAGAIN:
+
+    0 - The IRCClient instance (like everywhere else)
+    1 - The server the requester (i.e. the bot) is on
+    2 - The nickname of the requester (i.e. the bot)
+    3 - The command which was refused
+    4 - A string containing some information; traditionally "Please wait a while and try again."
+
+    """
+
+    cli.tokenbucket.report_throttle()
+
 ### Fetch and store server information
 
 @hook("featurelist")
@@ -531,8 +552,7 @@ def join_chan(cli, rawnick, chan, account=None, realname=None):
     ch.state = channels._States.Joined
 
     user = users._add(cli, nick=rawnick, realname=realname, account=account) # FIXME
-    ch.users.add(user)
-    user.channels[ch] = set()
+    ch.add_user(user)
 
     if user is users.Bot:
         ch.mode()
@@ -606,7 +626,7 @@ def quit(context, message=""):
         raise SystemExit
 
     with cli:
-        cli.send("QUIT :{0}".format(message))
+        cli.quit(message)
 
 @hook("quit")
 def on_quit(cli, rawnick, reason):
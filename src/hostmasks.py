@@ -0,0 +1,134 @@
+""" Matching users against many hostmask or account patterns at once.
+
+Hostmask patterns are n!u@h, u@h or just h, and each part may use
+fnmatch-style wildcards. Rather than parsing and matching every pattern
+in turn, a Hostmasks object compiles a whole collection of them once:
+patterns whose host has no wildcards (the vast majority, since cloaks and
+userhosts are stored as-is) are looked up by host in a dict, and all the
+others are combined into a single regular expression.
+
+Like casemapping, this module has no dependencies on the rest of the bot.
+"""
+
+import fnmatch
+import functools
+import re
+
+from src import casemapping as _casemapping
+
+_split = re.compile("(?:(?:(.*?)!)?(.*?)@)?(.*)").match
+
+def split(hostmask):
+    """Return the nick, ident and host of a hostmask pattern; missing parts are empty."""
+    return _split(hostmask).groups("")
+
+def _is_literal(pattern):
+    return not ("*" in pattern or "?" in pattern or "[" in pattern)
+
+def _combine(patterns):
+    """Compile a list of fnmatch patterns into the match method of a single regex, or None."""
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns)).match
+
+class Globs:
+    """A collection of fnmatch patterns (such as account patterns), matched all at once.
+
+    Patterns and matched strings are expected to be folded already.
+
+    """
+
+    __slots__ = ("_literal", "_match")
+
+    def __init__(self, patterns):
+        self._literal = set()
+        globs = []
+        for pattern in patterns:
+            if _is_literal(pattern):
+                self._literal.add(pattern)
+            else:
+                globs.append(pattern)
+        self._match = _combine(globs)
+
+    def match(self, string):
+        if string is None:
+            return False
+        if string in self._literal:
+            return True
+        return self._match is not None and self._match(string) is not None
+
+class Hostmasks:
+    """A collection of hostmask patterns, matched all at once.
+
+    The patterns are folded according to the given casemapping, with the
+    host folded as ascii. The nick, ident and host given to match() and
+    matching() need to be folded the same way (User.folded already is).
+
+    """
+
+    __slots__ = ("casemapping", "_by_host", "_globs", "_match")
+
+    def __init__(self, patterns, casemapping=_casemapping.DEFAULT):
+        self.casemapping = casemapping
+        self._by_host = {} # {host: [(index, match or None, pattern)]}; match checks the nick!ident part
+        self._globs = [] # [(index, match, pattern)]; match checks the whole nick!ident@host
+        for index, pattern in enumerate(patterns):
+            nick, ident, host = split(pattern)
+            nick = _casemapping.lower(nick or "*", casemapping)
+            ident = _casemapping.lower(ident or "*", casemapping)
+            host = _casemapping.lower(host, "ascii")
+            if _is_literal(host):
+                check = None
+                if nick != "*" or ident != "*":
+                    check = _combine(["{0}!{1}".format(nick, ident)])
+                self._by_host.setdefault(host, []).append((index, check, pattern))
+            else:
+                self._globs.append((index, _combine(["{0}!{1}@{2}".format(nick, ident, host)]), pattern))
+
+        # a single regex for all the globs, so that users matching none of them (most of them) are rejected at once
+        self._match = None
+        if self._globs:
+            self._match = re.compile("|".join(match.__self__.pattern for index, match, pattern in self._globs)).match
+
+    def __bool__(self):
+        return bool(self._by_host or self._globs)
+
+    def match(self, nick, ident, host):
+        """Return True if the user matches any of the patterns."""
+        nick, ident, host = nick or "", ident or "", host or ""
+        for index, check, pattern in self._by_host.get(host, ()):
+            if check is None or check(nick + "!" + ident) is not None:
+                return True
+        return self._match is not None and self._match("{0}!{1}@{2}".format(nick, ident, host)) is not None
+
+    def matching(self, nick, ident, host):
+        """Return the patterns which the user matches, in the order they were given."""
+        nick, ident, host = nick or "", ident or "", host or ""
+        found = []
+        for index, check, pattern in self._by_host.get(host, ()):
+            if check is None or check(nick + "!" + ident) is not None:
+                found.append((index, pattern))
+        if self._globs:
+            full = "{0}!{1}@{2}".format(nick, ident, host)
+            if self._match(full) is not None:
+                found.extend((index, pattern) for index, match, pattern in self._globs if match(full) is not None)
+        found.sort()
+        return [pattern for index, pattern in found]
+
+@functools.lru_cache(maxsize=1024)
+def _compile(patterns, casemapping):
+    return Hostmasks(patterns, casemapping)
+
+@functools.lru_cache(maxsize=256)
+def _compile_globs(patterns, casemapping):
+    return Globs(_casemapping.lower(pattern, casemapping) for pattern in patterns)
+
+def compile(patterns, casemapping=_casemapping.DEFAULT):
+    """Return a Hostmasks for the given patterns, reusing it as long as they don't change."""
+    return _compile(tuple(patterns), casemapping)
+
+def compile_globs(patterns, casemapping=_casemapping.DEFAULT):
+    """Return a Globs for the given patterns (folded first), reusing it as long as they don't change."""
+    return _compile_globs(tuple(patterns), casemapping)
+
+# vim: set sw=4 expandtab:
@@ -50,10 +50,12 @@ def get_timestamp(use_utc=None, ts_format=None):
         offset += str(time.timezone // 36).zfill(4)
     return tmf.format(tzname=tz, tzoffset=offset).strip().upper() + " "
 
+def stream_enabled(level="normal"):
+    """Return True if stream() would log a message of this level."""
+    return bool(botconfig.VERBOSE_MODE or botconfig.DEBUG_MODE or level == "warning")
+
 def stream(output, level="normal"):
-    if botconfig.VERBOSE_MODE or botconfig.DEBUG_MODE:
-        plog(output)
-    elif level == "warning":
+    if stream_enabled(level):
         plog(output)
 
 
@@ -21,13 +21,6 @@ def on_get_reveal_role(evt, var, nick):
     if evt.data["role"] == "traitor" and var.HIDDEN_TRAITOR and var.ROLE_REVEAL != "team":
         evt.data["role"] = var.DEFAULT_ROLE
 
-@event_listener("get_final_role")
-def on_get_final_role(evt, cli, var, nick, role):
-    # if a traitor turns we want to show them as traitor in the end game readout
-    # instead of "wolf (was traitor)"
-    if role == "traitor" and evt.data["role"] == "wolf":
-        evt.data["role"] = "traitor"
-
 @event_listener("update_stats", priority=1)
 def on_update_stats1(evt, cli, var, nick, nickrole, nickreveal, nicktpls):
     if nickrole == var.DEFAULT_ROLE and var.HIDDEN_TRAITOR:
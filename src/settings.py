@@ -49,10 +49,6 @@ PART_GRACE_TIME = 30
 QUIT_GRACE_TIME = 60
 ACC_GRACE_TIME = 30
 START_QUIT_DELAY = 10
-#  controls how many people it does in one /msg; only works for messages that are the same
-MAX_PRIVMSG_TARGETS = 4
-# how many mode values can be specified at once; used only as fallback
-MODELIMIT = 3
 QUIET_DEAD_PLAYERS = False
 DEVOICE_DURING_NIGHT = False
 ALWAYS_PM_ROLE = False
@@ -208,6 +204,28 @@ TRACEBACK_VERBOSITY = 2 # 0 = no locals at all, 1 = innermost frame's locals, 2
 # How often to ping the server (in seconds) to detect unclean disconnection
 SERVER_PING_INTERVAL = 120
 
+# Outgoing flood control. The bot starts with FLOOD_CAPACITY lines of burst and
+# FLOOD_FILL_RATE lines per second, and adjusts both within the MIN/MAX bounds
+# based on server lag and flood notices (see !floodcontrol). It backs off when the
+# server lags or complains, and recovers up to the MAX values once it no longer does.
+# Low lag says nothing about the server's flood limits, so only raise the MAX values
+# above the starting ones if you know the server allows it
+FLOOD_CAPACITY = 23
+FLOOD_FILL_RATE = 1.73
+FLOOD_MIN_CAPACITY = 5
+FLOOD_MAX_CAPACITY = 23
+FLOOD_MIN_FILL_RATE = 0.5
+FLOOD_MAX_FILL_RATE = 1.73
+
+# Reconnect when the connection to the server is lost, keeping any game going. The first
+# attempt is made after up to RECONNECT_DELAY seconds, doubling after each failed attempt
+# up to RECONNECT_MAX_DELAY. The connection is considered lost if nothing was received for
+# twice SERVER_PING_INTERVAL seconds. Without RECONNECT, the bot exits when the connection
+# is lost, and waits for the server however long it stays quiet
+RECONNECT = True
+RECONNECT_DELAY = 5
+RECONNECT_MAX_DELAY = 300
+
 # Shorthand for naming roles, used to set up command aliases as well as be valid targets when
 # specifying role names for things (such as !pstats or prophet's !pray)
 ROLE_ALIASES = {
@@ -1,36 +1,125 @@
-import fnmatch
 import re
+from collections import namedtuple
+from collections.abc import Mapping
 
-from src.context import IRCContext, Features, lower, equals
+from src.context import IRCContext, IRCDict, Features, lower, equals
+from src.completion import complete
 from src import settings as var
-from src import db, events
+from src import db, events, hostmasks
 
 import botconfig
 
 Bot = None # bot instance
 
-_users = set()
+_registries = {} # {client: _Registry}; each connection has its own users
 _ghosts = set()
 
 _arg_msg = "(nick={0!r}, ident={1!r}, host={2!r}, realname={3!r}, account={4!r}, allow_bot={5})"
 
-class _user:
-    def __init__(self, nick):
-        self.nick = nick
-
-    for name in ("ident", "host", "account", "inchan", "modes", "moded"):
-        locals()[name] = property(lambda self, name=name: var.USERS[self.nick][name], lambda self, value, name=name: var.USERS[self.nick].__setitem__(name, value))
-
 # This is used to tell if this is a fake nick or not. If this function
 # returns a true value, then it's a fake nick. This is useful for
 # testing, where we might want everyone to be fake nicks.
 predicate = re.compile(r"^[0-9]+$").search
 
-def _get(nick=None, ident=None, host=None, realname=None, account=None, *, allow_multiple=False, allow_none=False, allow_bot=False):
+class _Registry:
+    """The users of one connection, with indexes to find them quickly.
+
+    The indexes only narrow down which users could match; whether they
+    actually match is still decided by User.__eq__, so lookups behave
+    exactly as if every user was compared.
+
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.users = set()
+        self.by_nick = IRCDict() # {nick: set of users}, folded
+        self.by_userhost = {} # {(ident, host): set of users}
+        self.by_account = IRCDict() # {account: set of users}, folded
+        self.no_userhost = set() # users with no ident or host (i.e. fake users)
+
+    def add(self, user):
+        if user in self.users:
+            return
+        self.users.add(user)
+        self.by_nick.setdefault(user.nick, set()).add(user)
+        if user.ident is None or user.host is None:
+            self.no_userhost.add(user)
+        else:
+            self.by_userhost.setdefault((user.ident, user.host), set()).add(user)
+        if user.account is not None:
+            self.by_account.setdefault(user.account, set()).add(user)
+
+    def discard(self, user):
+        if user not in self.users:
+            return
+        self.users.discard(user)
+        _discard(self.by_nick, user.nick, user)
+        if user.ident is None or user.host is None:
+            self.no_userhost.discard(user)
+        else:
+            _discard(self.by_userhost, (user.ident, user.host), user)
+        if user.account is not None:
+            _discard(self.by_account, user.account, user)
+
+    def __contains__(self, user):
+        # don't hash the user; it may not be hashable yet
+        for other in self.by_nick.get(user.nick, ()):
+            if other is user:
+                return True
+        return False
+
+    def candidates(self, nick, ident, host, realname, account):
+        """Return the users which may compare equal to a user with the given attributes.
+
+        A user only compares equal to another if none of the attributes
+        that both have differ, so we can only use an index on attributes
+        which every candidate is guaranteed to have. Every user has a nick.
+
+        """
+
+        if nick is not None:
+            return self.by_nick.get(nick, ())
+        if ident is not None and host is not None:
+            return self.by_userhost.get((ident, host), set()) | self.no_userhost
+        if account is not None and realname is None:
+            return self.by_account.get(account, ())
+        return self.users
+
+    def bot(self):
+        """Return the bot if it is connected through this registry's connection, or None."""
+        if Bot is not None and Bot.client is self.client:
+            return Bot
+        return None
+
+def _discard(index, key, user):
+    users = index.get(key)
+    if users is not None:
+        users.discard(user)
+        if not users:
+            del index[key]
+
+def _registry(cli):
+    """Return the users of the given connection, which defaults to the bot's."""
+    if cli is None and Bot is not None:
+        cli = Bot.client
+    registry = _registries.get(cli)
+    if registry is None:
+        registry = _registries[cli] = _Registry(cli)
+    return registry
+
+def _registry_of(user):
+    """Return the registry which the user is in, or None if it isn't in any."""
+    registry = _registries.get(user.client)
+    if registry is not None and user in registry:
+        return registry
+    return None
+
+def _get(nick=None, ident=None, host=None, realname=None, account=None, *, allow_multiple=False, allow_none=False, allow_bot=False, cli=None):
     """Return the matching user(s) from the user list.
 
     This takes up to 5 positional arguments (nick, ident, host, realname,
-    account) and may take up to three keyword-only arguments:
+    account) and may take up to four keyword-only arguments:
 
     - allow_multiple (defaulting to False) allows multiple matches,
       and returns a list, even if there's only one match;
@@ -42,6 +131,9 @@ def _get(nick=None, ident=None, host=None, realname=None, account=None, *, allow
     - allow_bot (defaulting to False) allows the bot to be matched and
       returned;
 
+    - cli (defaulting to the bot's connection) is the connection whose
+      users to look through;
+
     If allow_multiple is not set and multiple users match, a ValueError
     will be raised. If allow_none is not set and no users match, a KeyError
     will be raised.
@@ -51,21 +143,21 @@ def _get(nick=None, ident=None, host=None, realname=None, account=None, *, allow
     if ident is None and host is None and nick is not None:
         nick, ident, host = parse_rawnick(nick)
 
-    potential = []
-    users = set(_users)
-    if allow_bot:
-        users.add(Bot)
-
-    sentinel = object()
+    registry = _registry(cli)
 
-    temp = User(sentinel, nick, ident, host, realname, account)
-    if temp.client is not sentinel: # actual client
+    temp = User(registry.client, nick, ident, host, realname, account)
+    if temp is registry.bot() or temp in registry: # actual user
         return [temp] if allow_multiple else temp
 
-    for user in users:
+    potential = []
+    for user in registry.candidates(nick, ident, host, realname, account):
         if user == temp:
             potential.append(user)
 
+    bot = registry.bot()
+    if allow_bot and bot is not None and bot == temp:
+        potential.append(bot)
+
     if allow_multiple:
         return potential
 
@@ -82,8 +174,7 @@ def _get(nick=None, ident=None, host=None, realname=None, account=None, *, allow
     return None
 
 def get(nick, *stuff, **morestuff): # backwards-compatible API - kill this as soon as possible!
-    var.USERS[nick] # _user(nick) evaluates lazily, so check eagerly if the nick exists
-    return _user(nick)
+    return _by_nick(nick)
 
 def _add(cli, *, nick, ident=None, host=None, realname=None, account=None):
     """Create a new user, add it to the user list and return it.
@@ -110,14 +201,10 @@ def _add(cli, *, nick, ident=None, host=None, realname=None, account=None):
         except ValueError:
             pass
         else:
-            _users.add(new)
+            _registry(cli).add(new)
 
     return new
 
-def add(nick, **blah): # backwards-compatible API
-    var.USERS[nick] = blah
-    return _user(nick)
-
 def _exists(nick=None, ident=None, host=None, realname=None, account=None, *, allow_multiple=False, allow_bot=False):
     """Return True if a matching user exists.
 
@@ -126,8 +213,6 @@ def _exists(nick=None, ident=None, host=None, realname=None, account=None, *, al
 
     """
 
-    sentinel = object()
-
     if ident is None and host is None and nick is not None:
         nick, ident, host = parse_rawnick(nick)
 
@@ -135,19 +220,20 @@ def _exists(nick=None, ident=None, host=None, realname=None, account=None, *, al
     if predicate(nick):
         cls = FakeUser
 
-    temp = cls(sentinel, nick, ident, host, realname, account)
+    registry = _registry(None)
+    temp = cls(registry.client, nick, ident, host, realname, account)
 
-    if temp.client is sentinel: # doesn't exist; if it did, the client would be an actual client
-        return False
+    if temp is registry.bot():
+        return allow_bot
 
-    return temp is not Bot or allow_bot
+    return temp in registry
 
 def exists(nick, *stuff, **morestuff): # backwards-compatible API
-    return nick in var.USERS
+    return _by_nick(nick, None) is not None
 
-def users_():
-    """Iterate over the users in the registry."""
-    yield from _users
+def users_(cli=None):
+    """Iterate over the users of a connection (by default, the bot's)."""
+    yield from _registry(cli).users
 
 class users: # backwards-compatible API
     def __iter__(self):
@@ -156,15 +242,106 @@ class users: # backwards-compatible API
     def items():
         yield from var.USERS.items()
 
+_missing = object()
+
+def _by_nick(nick, default=_missing):
+    """Return the user of the bot's connection with the given nick, for the backwards-compatible API."""
+    found = None
+    for user in _registry(None).by_nick.get(nick, ()):
+        found = user
+        if user.channels: # prefer a user who is still around over a ghost
+            break
+    if found is None:
+        if default is _missing:
+            raise KeyError(nick)
+        return default
+    return found
+
+class _LegacyUser(Mapping):
+    """A read-only, dict-like view of a user, as found in var.USERS."""
+
+    __slots__ = ("user",)
+
+    _keys = ("ident", "host", "account", "inchan", "modes")
+
+    def __init__(self, user):
+        self.user = user
+
+    def __getitem__(self, key):
+        user = self.user
+        if key == "ident":
+            return user.ident
+        if key == "host":
+            return user.host
+        if key == "account":
+            return "*" if user.account is None else user.account
+        if key in ("inchan", "modes"):
+            for channel in user.channels:
+                if equals(channel.name, botconfig.CHANNEL):
+                    return True if key == "inchan" else set(user.channels[channel])
+            return False if key == "inchan" else set()
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self))
+
+class LegacyUsers(Mapping):
+    """A read-only view of the bot's users, keyed by nick; this is var.USERS.
+
+    The users registry is the only place where users are stored; this
+    view follows it as users come and go or change nicks, for code which
+    still uses the old nick-keyed API. It can't be modified. Fake users
+    (the fake players of debug mode) are left out, as they never were in
+    var.USERS and have no ident or host.
+
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def _get(nick):
+        user = _by_nick(nick, None)
+        if user is None or user.is_fake:
+            return None
+        return user
+
+    def __getitem__(self, nick):
+        user = self._get(nick)
+        if user is None:
+            raise KeyError(nick)
+        return _LegacyUser(user)
+
+    def __contains__(self, nick):
+        return self._get(nick) is not None
+
+    def __iter__(self):
+        for user in list(_registry(None).users):
+            if not user.is_fake:
+                yield user.nick
+
+    def __len__(self):
+        return sum(1 for user in _registry(None).users if not user.is_fake)
+
 def complete_match(string, users):
-    matches = []
-    string = lower(string)
-    for user in users:
-        nick = lower(user.nick)
-        if nick == string:
-            return user, 1
-        elif nick.startswith(string) or nick.lstrip("[{\\^_`|}]").startswith(string):
-            matches.append(user)
+    """Find the user whose nick matches string, ignoring case and leading special characters.
+
+    Return a tuple of (user, 1) if exactly one user matches (or one
+    matches exactly), or (None, number of matches) otherwise. The users
+    of a channel are looked up through the channel's nick index.
+
+    """
+
+    nicks = getattr(users, "nicks", None)
+    if nicks is not None:
+        matches = nicks.complete(string)
+    else:
+        matches = complete(lower(string), ((user.folded.nick, user) for user in users))
 
     if len(matches) != 1:
         return None, len(matches)
@@ -186,7 +363,7 @@ def parse_rawnick_as_dict(rawnick, *, default=None):
 def _cleanup_user(evt, var, user):
     """Removes a user from our global tracking set once it has left all channels."""
     if var.PHASE not in var.GAME_PHASES or user not in var.ALL_PLAYERS:
-        _users.discard(user)
+        _registry(user.client).discard(user)
     elif var.PHASE in var.GAME_PHASES and user in var.ALL_PLAYERS:
         _ghosts.add(user)
 
@@ -194,7 +371,7 @@ def _reset(evt, var):
     """Cleans up users that left during game during game end."""
     for user in _ghosts:
         if not user.channels:
-            _users.discard(user)
+            _registry(user.client).discard(user)
     _ghosts.clear()
 
 # Can't use @event_listener decorator since src/decorators.py imports us
@@ -205,14 +382,34 @@ events.add_listener("reset", _reset)
 # to remove the swapped player from _ghosts if they're in there (helps prevent
 # duplicate user lookup bugs where the ghost and new player have the same nick)
 
+class _Folded(namedtuple("_Folded", ("nick", "ident", "host", "realname", "account", "casemapping"))):
+    """The case-folded identity of a user, as returned by User.folded, and the casemapping it was folded with."""
+
+    __slots__ = ()
+
+    @property
+    def rawnick(self):
+        if self.nick is None or self.ident is None or self.host is None:
+            return None
+        return "{self.nick}!{self.ident}@{self.host}".format(self=self)
+
+    @property
+    def userhost(self):
+        if self.ident is None or self.host is None:
+            return None
+        return "{self.ident}@{self.host}".format(self=self)
+
 class User(IRCContext):
 
+    __slots__ = ("_ident", "_host", "_realname", "_account", "_folded", "channels")
+
     is_user = True
 
     def __new__(cls, cli, nick, ident, host, realname, account):
         self = super().__new__(cls)
         super(__class__, self).__init__(nick, cli)
 
+        self._folded = None
         self._ident = ident
         self._host = host
         self.realname = realname
@@ -227,13 +424,15 @@ class User(IRCContext):
             self.account = account
 
         elif ident is not None and host is not None:
-            users = set(_users)
-            users.add(Bot)
-            if self in users:
-                for user in users:
-                    if self == user:
-                        self = user
-                        break
+            # only users with the same hash can be in a set with us, i.e. the same (ident, host)
+            registry = _registry(cli)
+            for user in registry.by_userhost.get((ident, host), ()):
+                if self == user:
+                    self = user
+                    break
+            else:
+                if registry.bot() is not None and (Bot.ident, Bot.host) == (ident, host) and self == Bot:
+                    self = Bot
 
         else:
             # This takes a different code path because of slightly different
@@ -252,7 +451,8 @@ class User(IRCContext):
             # the set compares equal with the new one. We can't know in advance
             # whether or not there is an instance that compares equal to this one
             # in the set, or if multiple instances are going to compare equal to
-            # this one.
+            # this one. The registry's indexes narrow down which instances need
+            # to be checked, without changing which ones compare equal.
             #
             # The code paths, while similar in functionality, fulfill two distinct
             # purposes; the first path is usually for when new users are created
@@ -269,8 +469,10 @@ class User(IRCContext):
             # and instead opt for the sake of clarity that this separation provides.
 
             potential = None
-            users = set(_users)
-            users.add(Bot)
+            registry = _registry(cli)
+            users = list(registry.candidates(nick, ident, host, realname, account))
+            if registry.bot() is not None:
+                users.append(Bot)
             for user in users:
                 if self == user:
                     if potential is None:
@@ -307,43 +509,54 @@ class User(IRCContext):
             temp.ref = self.ref or self
         return temp
 
+    @property
+    def folded(self):
+        """The case-folded nick, ident, host, realname and account.
+
+        Unlike lower(), this doesn't create a new user; the result is
+        cached until one of those attributes changes, or until the server
+        announces another CASEMAPPING.
+
+        """
+
+        folded = self._folded
+        casemapping = Features["CASEMAPPING"]
+        if folded is None or folded.casemapping != casemapping:
+            folded = self._folded = _Folded(lower(self.nick, casemapping=casemapping), lower(self.ident, casemapping=casemapping),
+                                            lower(self.host, casemapping="ascii"), lower(self.realname, casemapping=casemapping),
+                                            lower(self.account, casemapping=casemapping), casemapping)
+        return folded
+
     def is_owner(self):
         if self.is_fake:
             return False
 
-        hosts = set(botconfig.OWNERS)
-        accounts = set(botconfig.OWNERS_ACCOUNTS)
-
-        if not var.DISABLE_ACCOUNTS and self.account is not None:
-            for pattern in accounts:
-                if fnmatch.fnmatch(lower(self.account), lower(pattern)):
-                    return True
+        temp = self.folded
+        casemapping = Features["CASEMAPPING"]
 
-        for hostmask in hosts:
-            if self.match_hostmask(hostmask):
+        if not var.DISABLE_ACCOUNTS and temp.account is not None:
+            if hostmasks.compile_globs(botconfig.OWNERS_ACCOUNTS, casemapping).match(temp.account):
                 return True
 
-        return False
+        return hostmasks.compile(botconfig.OWNERS, casemapping).match(temp.nick, temp.ident, temp.host)
 
     def is_admin(self):
         if self.is_fake:
             return False
 
-        flags = var.FLAGS[self.rawnick] + var.FLAGS_ACCS[self.account]
+        flags = var.FLAGS.get(self.rawnick, "") + var.FLAGS_ACCS.get(self.account, "")
 
         if "F" not in flags:
             try:
-                hosts = set(botconfig.ADMINS)
-                accounts = set(botconfig.ADMINS_ACCOUNTS)
+                temp = self.folded
+                casemapping = Features["CASEMAPPING"]
 
-                if not var.DISABLE_ACCOUNTS and self.account is not None:
-                    for pattern in accounts:
-                        if fnmatch.fnmatch(lower(self.account), lower(pattern)):
-                            return True
-
-                for hostmask in hosts:
-                    if self.match_hostmask(hostmask):
+                if not var.DISABLE_ACCOUNTS and temp.account is not None:
+                    if hostmasks.compile_globs(botconfig.ADMINS_ACCOUNTS, casemapping).match(temp.account):
                         return True
+
+                if hostmasks.compile(botconfig.ADMINS, casemapping).match(temp.nick, temp.ident, temp.host):
+                    return True
             except AttributeError:
                 pass
 
@@ -362,23 +575,17 @@ class User(IRCContext):
 
     def match_hostmask(self, hostmask):
         """Match n!u@h, u@h, or just h by itself."""
-        nick, ident, host = re.match("(?:(?:(.*?)!)?(.*?)@)?(.*)", hostmask).groups("")
-        temp = self.lower()
-
-        return ((not nick or fnmatch.fnmatch(temp.nick, lower(nick))) and
-                (not ident or fnmatch.fnmatch(temp.ident, lower(ident))) and
-                fnmatch.fnmatch(temp.host, lower(host, casemapping="ascii")))
+        temp = self.folded
+        return hostmasks.compile((hostmask,), Features["CASEMAPPING"]).match(temp.nick, temp.ident, temp.host)
 
     def prefers_notice(self):
-        temp = self.lower()
+        temp = self.folded
 
         if temp.account in var.PREFER_NOTICE_ACCS:
             return True
 
         if not var.ACCOUNTS_ONLY:
-            for hostmask in var.PREFER_NOTICE:
-                if temp.match_hostmask(hostmask):
-                    return True
+            return var.PREFER_NOTICE.match(temp.nick, temp.ident, temp.host)
 
         return False
 
@@ -386,34 +593,31 @@ class User(IRCContext):
         if self.is_fake:
             return True
 
-        temp = self.lower()
+        temp = self.folded
 
         if temp.account in var.SIMPLE_NOTIFY_ACCS:
             return True
 
         if not var.ACCOUNTS_ONLY:
-            for hostmask in var.SIMPLE_NOTIFY:
-                if temp.match_hostmask(hostmask):
-                    return True
+            return var.SIMPLE_NOTIFY.match(temp.nick, temp.ident, temp.host)
 
         return False
 
     def get_pingif_count(self):
-        temp = self.lower()
+        temp = self.folded
 
         if not var.DISABLE_ACCOUNTS and temp.account is not None:
             if temp.account in var.PING_IF_PREFS_ACCS:
                 return var.PING_IF_PREFS_ACCS[temp.account]
 
         elif not var.ACCOUNTS_ONLY:
-            for hostmask, pref in var.PING_IF_PREFS.items():
-                if temp.match_hostmask(hostmask):
-                    return pref
+            for hostmask in var.PING_IF_PREFS.matching(temp.nick, temp.ident, temp.host):
+                return var.PING_IF_PREFS[hostmask]
 
         return 0
 
     def set_pingif_count(self, value, old=None):
-        temp = self.lower()
+        temp = self.folded
 
         if not value:
             if not var.DISABLE_ACCOUNTS and temp.account:
@@ -426,15 +630,14 @@ class User(IRCContext):
                                 var.PING_IF_NUMS_ACCS[old].discard(temp.account)
 
             if not var.ACCOUNTS_ONLY:
-                for hostmask in list(var.PING_IF_PREFS):
-                    if temp.match_hostmask(hostmask):
-                        del var.PING_IF_PREFS[hostmask]
-                        db.set_pingif(0, None, hostmask)
-                        if old is not None:
-                            with var.WARNING_LOCK:
-                                if old in var.PING_IF_NUMS:
-                                    var.PING_IF_NUMS[old].discard(hostmask)
-                                    var.PING_IF_NUMS[old].discard(temp.host)
+                for hostmask in var.PING_IF_PREFS.matching(temp.nick, temp.ident, temp.host):
+                    del var.PING_IF_PREFS[hostmask]
+                    db.set_pingif(0, None, hostmask)
+                    if old is not None:
+                        with var.WARNING_LOCK:
+                            if old in var.PING_IF_NUMS:
+                                var.PING_IF_NUMS[old].discard(hostmask)
+                                var.PING_IF_NUMS[old].discard(temp.host)
 
         else:
             if not var.DISABLE_ACCOUNTS and temp.account:
@@ -461,7 +664,7 @@ class User(IRCContext):
                             var.PING_IF_NUMS[old].discard(temp.userhost)
 
     def wants_deadchat(self):
-        temp = self.lower()
+        temp = self.folded
 
         if temp.account in var.DEADCHAT_PREFS_ACCS:
             return False
@@ -474,7 +677,7 @@ class User(IRCContext):
 
     def stasis_count(self):
         """Return the number of games the user is in stasis for."""
-        temp = self.lower()
+        temp = self.folded
         amount = 0
 
         if not var.DISABLE_ACCOUNTS:
@@ -490,7 +693,15 @@ class User(IRCContext):
 
     @nick.setter
     def nick(self, nick):
-        self.name = nick
+        registry = _registry_of(self) # the indexes need to be updated
+        if registry is not None:
+            registry.discard(self)
+        old, self.name = self.name, nick
+        self._folded = None
+        if registry is not None:
+            registry.add(self)
+        for channel in self.channels:
+            channel.users.renamed(self, old)
         if self is Bot: # update the client's nickname as well
             self.client.nickname = nick
 
@@ -501,7 +712,13 @@ class User(IRCContext):
     @ident.setter
     def ident(self, ident):
         if self._ident is None:
+            registry = _registry_of(self)
+            if registry is not None:
+                registry.discard(self)
             self._ident = ident
+            self._folded = None
+            if registry is not None:
+                registry.add(self)
             if self is Bot:
                 self.client.ident = ident
         elif self._ident != ident:
@@ -514,7 +731,13 @@ class User(IRCContext):
     @host.setter
     def host(self, host):
         if self._host is None:
+            registry = _registry_of(self)
+            if registry is not None:
+                registry.discard(self)
             self._host = host
+            self._folded = None
+            if registry is not None:
+                registry.add(self)
             if self is Bot:
                 self.client.hostmask = host
         elif self._host != host:
@@ -527,6 +750,7 @@ class User(IRCContext):
     @realname.setter
     def realname(self, realname):
         self._realname = realname
+        self._folded = None
         if self is Bot:
             self.client.real_name = realname
 
@@ -538,7 +762,13 @@ class User(IRCContext):
     def account(self, account):
         if account in ("0", "*"):
             account = None
+        registry = _registry_of(self)
+        if registry is not None:
+            registry.discard(self)
         self._account = account
+        self._folded = None
+        if registry is not None:
+            registry.add(self)
 
     @property
     def rawnick(self):
@@ -562,6 +792,8 @@ class User(IRCContext):
 
 class FakeUser(User):
 
+    __slots__ = ()
+
     is_fake = True
 
     def __hash__(self):
@@ -589,6 +821,8 @@ class FakeUser(User):
 
 class BotUser(User): # TODO: change all the 'if x is Bot' for 'if isinstance(x, BotUser)'
 
+    __slots__ = ("modes",)
+
     def __new__(cls, cli, nick):
         self = super().__new__(cls, cli, nick, None, None, None, None)
         self.modes = set()
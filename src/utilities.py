@@ -1,14 +1,15 @@
 import itertools
-import fnmatch
 import re
 
 import botconfig
 import src.settings as var
-from src import proxy, debuglog
+from src import casemapping, context, hostmasks, proxy, debuglog
+from src.completion import complete
 from src.events import Event
 from src.messages import messages
 
-__all__ = ["pm", "is_fake_nick", "mass_mode", "mass_privmsg", "reply",
+__all__ = ["pm", "is_fake_nick", "mass_privmsg", "reply",
+           "phase_tag", "drop_stale_messages",
            "is_user_simple", "is_user_notice", "in_wolflist",
            "relay_wolfchat_command", "chk_nightdone", "chk_decision",
            "chk_win", "irc_lower", "irc_equals", "is_role", "match_hostmask",
@@ -17,78 +18,68 @@ __all__ = ["pm", "is_fake_nick", "mass_mode", "mass_privmsg", "reply",
            "get_reveal_role", "get_templates", "role_order", "break_long_message",
            "complete_match","complete_one_match", "get_victim", "get_nick", "InvalidModeException"]
 # message either privmsg or notice, depending on user settings
-def pm(cli, target, message):
+def pm(cli, target, message, tag=None):
     if is_fake_nick(target) and botconfig.DEBUG_MODE:
         debuglog("Would message fake nick {0}: {1!r}".format(target, message))
         return
 
+    send_type = "PRIVMSG"
     if is_user_notice(target):
-        cli.notice(target, message)
-        return
+        send_type = "NOTICE"
 
-    cli.msg(target, message)
+    context.send(cli, send_type, target, (message,), tag=tag)
 
 is_fake_nick = re.compile(r"^[0-9]+$").search
 
-def mass_mode(cli, md_param, md_plain):
-    """ Example: mass_mode(cli, [('+v', 'asdf'), ('-v','wobosd')], ['-m']) """
-    lmd = len(md_param)  # store how many mode changes to do
-    if md_param:
-        for start_i in range(0, lmd, var.MODELIMIT):  # 4 mode-changes at a time
-            if start_i + var.MODELIMIT > lmd:  # If this is a remainder (mode-changes < 4)
-                z = list(zip(*md_param[start_i:]))  # zip this remainder
-                ei = lmd % var.MODELIMIT  # len(z)
-            else:
-                z = list(zip(*md_param[start_i:start_i+var.MODELIMIT])) # zip four
-                ei = var.MODELIMIT # len(z)
-            # Now z equal something like [('+v', '-v'), ('asdf', 'wobosd')]
-            arg1 = "".join(md_plain) + "".join(z[0])
-            arg2 = " ".join(z[1])  # + " " + " ".join([x+"!*@*" for x in z[1]])
-            cli.mode(botconfig.CHANNEL, arg1, arg2)
-    elif md_plain:
-            cli.mode(botconfig.CHANNEL, "".join(md_plain))
-
-def mass_privmsg(cli, targets, msg, notice=False, privmsg=False):
-    if not targets:
-        return
-    if not notice and not privmsg:
-        msg_targs = []
-        not_targs = []
-        for target in targets:
-            if is_fake_nick(target):
-                debuglog("Would message fake nick {0}: {1!r}".format(target, msg))
-            elif is_user_notice(target):
-                not_targs.append(target)
-            else:
-                msg_targs.append(target)
-        while msg_targs:
-            if len(msg_targs) <= var.MAX_PRIVMSG_TARGETS:
-                bgs = ",".join(msg_targs)
-                msg_targs = None
-            else:
-                bgs = ",".join(msg_targs[:var.MAX_PRIVMSG_TARGETS])
-                msg_targs = msg_targs[var.MAX_PRIVMSG_TARGETS:]
-            cli.msg(bgs, msg)
-        while not_targs:
-            if len(not_targs) <= var.MAX_PRIVMSG_TARGETS:
-                bgs = ",".join(not_targs)
-                not_targs = None
-            else:
-                bgs = ",".join(not_targs[:var.MAX_PRIVMSG_TARGETS])
-                not_targs = not_targs[var.MAX_PRIVMSG_TARGETS:]
-            cli.notice(bgs, msg)
-    else:
-        while targets:
-            if len(targets) <= var.MAX_PRIVMSG_TARGETS:
-                bgs = ",".join(targets)
-                targets = None
-            else:
-                bgs = ",".join(targets[:var.MAX_PRIVMSG_TARGETS])
-                target = targets[var.MAX_PRIVMSG_TARGETS:]
-            if notice:
-                cli.notice(bgs, msg)
-            else:
-                cli.msg(bgs, msg)
+def mass_privmsg(cli, targets, msg, notice=False, privmsg=False, tag=None):
+    """Send msg to all targets, to as many of them per line as the server allows."""
+    for target in targets:
+        if is_fake_nick(target):
+            debuglog("Would message fake nick {0}: {1!r}".format(target, msg))
+            continue
+        if notice:
+            send_type = "NOTICE"
+        elif privmsg:
+            send_type = "PRIVMSG"
+        elif is_user_notice(target):
+            send_type = "NOTICE"
+        else:
+            send_type = "PRIVMSG"
+        context.queue(cli, send_type, target, (msg,), tag=tag)
+
+    context.send_queued()
+
+def phase_tag():
+    """Return the tag of messages which are stale once the current phase of the game is over.
+
+    Messages sent with this tag (e.g. idle warnings) are dropped by
+    drop_stale_messages() if they are still waiting to be sent by then.
+
+    """
+
+    return (var.GAME_ID, var.PHASE, var.DAY_COUNT, var.NIGHT_COUNT)
+
+def drop_stale_messages(cli, nick=None):
+    """Drop the queued messages tagged for another phase, and those tagged ones sent to nick."""
+    current = phase_tag()
+    if nick is not None:
+        nick = irc_lower(nick)
+
+    def check(msg, tag):
+        if tag != current:
+            return None
+        parts = msg.split(b" ", 2)
+        if nick is None or len(parts) < 3:
+            return msg
+        targets = parts[1].split(b",")
+        kept = [t for t in targets if irc_lower(t.decode("utf_8", "replace")) != nick]
+        if len(kept) == len(targets):
+            return msg
+        if not kept:
+            return None
+        return b" ".join((parts[0], b",".join(kept), parts[2]))
+
+    cli.cancel_queued(check)
 
 # Decide how to reply to a user, depending on the channel / query it was called in, and whether a game is running and they are playing
 def reply(cli, nick, chan, msg, private=False, prefix_nick=False):
@@ -116,21 +107,17 @@ def is_user_simple(nick):
             return True
         return False
     elif not var.ACCOUNTS_ONLY:
-        for hostmask in var.SIMPLE_NOTIFY:
-            if match_hostmask(hostmask, nick, ident, host):
-                return True
+        return var.SIMPLE_NOTIFY.match(irc_lower(nick), ident, host)
     return False
 
 def is_user_notice(nick):
     if nick in var.USERS and var.USERS[nick]["account"] and var.USERS[nick]["account"] != "*" and not var.DISABLE_ACCOUNTS:
-        if irc_lower(var.USERS[nick]["account"]) in var.PREFER_NOTICE_ACCS:
+        if var.USERS[nick]["account"] in var.PREFER_NOTICE_ACCS:
             return True
     if nick in var.USERS and not var.ACCOUNTS_ONLY:
         ident = irc_lower(var.USERS[nick]["ident"])
         host = var.USERS[nick]["host"].lower()
-        for hostmask in var.PREFER_NOTICE:
-            if match_hostmask(hostmask, nick, ident, host):
-                return True
+        return var.PREFER_NOTICE.match(irc_lower(nick), ident, host)
     return False
 
 def in_wolflist(nick, who):
@@ -188,22 +175,9 @@ def irc_lower(nick):
     if nick is None:
         return None
 
-    mapping = {
-        "[": "{",
-        "]": "}",
-        "\\": "|",
-        "^": "~",
-    }
-
     # var.CASEMAPPING may not be defined yet in some circumstances (like database upgrades)
     # if so, default to rfc1459
-    if hasattr(var, "CASEMAPPING"):
-        if var.CASEMAPPING == "strict-rfc1459":
-            mapping.pop("^")
-        elif var.CASEMAPPING == "ascii":
-            mapping = {}
-
-    return nick.lower().translate(str.maketrans(mapping))
+    return casemapping.lower(nick, getattr(var, "CASEMAPPING", casemapping.DEFAULT))
 
 def irc_equals(nick1, nick2):
     return irc_lower(nick1) == irc_lower(nick2)
@@ -212,18 +186,15 @@ is_role = lambda plyr, rol: rol in var.ROLES and plyr in var.ROLES[rol]
 
 def match_hostmask(hostmask, nick, ident, host):
     # support n!u@h, u@h, or just h by itself
-    matches = re.match('(?:(?:(.*?)!)?(.*?)@)?(.*)', hostmask)
+    return _hostmasks((hostmask,)).match(irc_lower(nick), irc_lower(ident), host.lower())
 
-    if ((not matches.group(1) or fnmatch.fnmatch(irc_lower(nick), irc_lower(matches.group(1)))) and
-            (not matches.group(2) or fnmatch.fnmatch(irc_lower(ident), irc_lower(matches.group(2)))) and
-            fnmatch.fnmatch(host.lower(), matches.group(3).lower())):
-        return True
+def _hostmasks(patterns):
+    return hostmasks.compile(patterns, getattr(var, "CASEMAPPING", casemapping.DEFAULT))
 
-    return False
+def _account_globs(patterns):
+    return hostmasks.compile_globs(patterns, getattr(var, "CASEMAPPING", casemapping.DEFAULT))
 
 def is_owner(nick, ident=None, host=None, acc=None):
-    hosts = set(botconfig.OWNERS)
-    accounts = set(botconfig.OWNERS_ACCOUNTS)
     if nick in var.USERS:
         if not ident:
             ident = var.USERS[nick]["ident"]
@@ -233,14 +204,11 @@ def is_owner(nick, ident=None, host=None, acc=None):
             acc = var.USERS[nick]["account"]
 
     if not var.DISABLE_ACCOUNTS and acc and acc != "*":
-        for pattern in accounts:
-            if fnmatch.fnmatch(irc_lower(acc), irc_lower(pattern)):
-                return True
+        if _account_globs(botconfig.OWNERS_ACCOUNTS).match(irc_lower(acc)):
+            return True
 
     if host:
-        for hostmask in hosts:
-            if match_hostmask(hostmask, nick, ident, host):
-                return True
+        return _hostmasks(botconfig.OWNERS).match(irc_lower(nick), irc_lower(ident), host.lower())
 
     return False
 
@@ -254,22 +222,17 @@ def is_admin(nick, ident=None, host=None, acc=None):
             acc = var.USERS[nick]["account"]
     acc = irc_lower(acc)
     hostmask = irc_lower(nick) + "!" + irc_lower(ident) + "@" + host.lower()
-    flags = var.FLAGS[hostmask] + var.FLAGS_ACCS[acc]
+    flags = var.FLAGS.get(hostmask, "") + var.FLAGS_ACCS.get(acc, "")
 
     if not "F" in flags:
         try:
-            hosts = set(botconfig.ADMINS)
-            accounts = set(botconfig.ADMINS_ACCOUNTS)
-
             if not var.DISABLE_ACCOUNTS and acc and acc != "*":
-                for pattern in accounts:
-                    if fnmatch.fnmatch(irc_lower(acc), irc_lower(pattern)):
-                        return True
+                if _account_globs(botconfig.ADMINS_ACCOUNTS).match(acc):
+                    return True
 
             if host:
-                for hostmask in hosts:
-                    if match_hostmask(hostmask, nick, ident, host):
-                        return True
+                if _hostmasks(botconfig.ADMINS).match(irc_lower(nick), irc_lower(ident), host.lower()):
+                    return True
         except AttributeError:
             pass
 
@@ -418,13 +381,7 @@ def break_long_message(phrases, joinstr = " "):
 
 #completes a partial nickname or string from a list
 def complete_match(string, matches):
-    possible_matches = set()
-    for possible in matches:
-        if string == possible:
-            return [string]
-        if possible.startswith(string) or possible.lstrip("[{\\^_`|}]").startswith(string):
-            possible_matches.add(possible)
-    return sorted(possible_matches)
+    return sorted(set(complete(string, ((possible, possible) for possible in matches))))
 
 def complete_one_match(string, matches):
     matches = complete_match(string,matches) 
@@ -439,29 +396,26 @@ def get_victim(cli, nick, victim, in_chan, self_in_list=False, bot_in_list=False
         reply(cli, nick, chan, messages["not_enough_parameters"], private=True)
         return
     pl = [x for x in list_players() if x != nick or self_in_list]
-    pll = [x.lower() for x in pl]
 
     if bot_in_list: # for villagergame
         pl.append(botconfig.NICK)
-        pll.append(botconfig.NICK.lower())
 
-    tempvictims = complete_match(victim.lower(), pll)
+    # match on the lowercased nicks, but return them in their normal casing
+    tempvictims = complete(victim.lower(), ((x.lower(), x) for x in pl))
     if len(tempvictims) != 1:
         #ensure messages about not being able to act on yourself work
         if len(tempvictims) == 0 and nick.lower().startswith(victim.lower()):
             return nick
         reply(cli, nick, chan, messages["not_playing"].format(victim), private=True)
         return
-    return pl[pll.index(tempvictims.pop())] #convert back to normal casing
+    return tempvictims[0]
 
 # wrapper around complete_match() used for any nick on the channel
 def get_nick(cli, nick):
-    ul = [x for x in var.USERS]
-    ull = [x.lower() for x in var.USERS]
-    lnick = complete_match(nick.lower(), ull)
-    if not lnick:
+    lnick = complete(nick.lower(), ((x.lower(), x) for x in var.USERS))
+    if len(lnick) != 1:
         return None
-    return ul[ull.index(lnick)]
+    return lnick[0]
 
 class InvalidModeException(Exception): pass
 
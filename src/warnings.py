@@ -24,9 +24,8 @@ def is_user_stasised(nick):
     if not var.DISABLE_ACCOUNTS and acc and acc != "*":
         if acc in var.STASISED_ACCS:
             amount = var.STASISED_ACCS[acc]
-    for hostmask in var.STASISED:
-        if match_hostmask(hostmask, nick, ident, host):
-           amount = max(amount, var.STASISED[hostmask])
+    for hostmask in var.STASISED.matching(irc_lower(nick), ident, host):
+        amount = max(amount, var.STASISED[hostmask])
     return amount
 
 def decrement_stasis(nick=None):
@@ -37,9 +36,8 @@ def decrement_stasis(nick=None):
         # decrement account stasis even if accounts are disabled
         if acc in var.STASISED_ACCS:
             db.decrement_stasis(acc=acc)
-        for hostmask in var.STASISED:
-            if match_hostmask(hostmask, nick, ident, host):
-                db.decrement_stasis(hostmask=hostmask)
+        for hostmask in var.STASISED.matching(irc_lower(nick), ident, host):
+            db.decrement_stasis(hostmask=hostmask)
     else:
         db.decrement_stasis()
     # Also expire any expired stasis and tempbans and update our tracking vars
@@ -53,7 +51,7 @@ def expire_tempbans():
         cmodes.append(("-b", "{0}{1}".format(var.ACCOUNT_PREFIX, acc)))
     for hm in hmlist:
         cmodes.append(("-b", "*!*@{0}".format(hm.split("@")[1])))
-    channels.Main.mode(*cmodes)
+    channels.Main.apply_modes(*cmodes)
 
 def parse_warning_target(target, lower=False):
     if target[0] == "=":
@@ -200,7 +198,7 @@ def add_warning(cli, target, amount, actor, reason, notes=None, expires=None, sa
             cmodes.append(("+b", "{0}{1}".format(var.ACCOUNT_PREFIX, acc)))
         for hm in hmlist:
             cmodes.append(("+b", "*!*@{0}".format(hm.split("@")[1])))
-        mass_mode(cli, cmodes, [])
+        channels.Main.apply_modes(*cmodes)
         for (nick, user) in var.USERS.items():
             if user["account"] in acclist:
                 cli.kick(botconfig.CHANNEL, nick, messages["tempban_kick"].format(nick=nick, botnick=botconfig.NICK, reason=reason))
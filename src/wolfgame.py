@@ -47,7 +47,7 @@ import botconfig
 import src
 import src.settings as var
 from src.utilities import *
-from src import db, events, dispatcher, channels, users, hooks, logger, proxy, debuglog, errlog, plog
+from src import casemapping, context, db, events, dispatcher, channels, users, hooks, logger, proxy, debuglog, errlog, plog
 from src.decorators import command, cmd, hook, handle_error, event_listener, COMMANDS
 from src.messages import messages
 from src.warnings import *
@@ -68,7 +68,7 @@ var.LAST_START = {}
 var.LAST_WAIT = {}
 var.LAST_GOAT = {}
 
-var.USERS = {}
+var.USERS = users.LegacyUsers()
 
 var.ADMIN_PINGING = False
 var.ORIGINAL_ROLES = {}
@@ -167,7 +167,7 @@ def connect_callback():
             # Devoice all on connect
             mode = hooks.Features["PREFIX"]["+"]
             pending = []
-            for user in channels.Main.modes.get(mode, ()):
+            for user in channels.Main.members_with(mode):
                 pending.append(("-" + mode, user))
             accumulator.send(pending)
             next(accumulator, None)
@@ -252,13 +252,6 @@ def check_for_modes(cli, rnick, chan, modeaction, *target):
                 keeptrg = True
             if change not in var.MODES_PREFIXES.values():
                 continue
-            if trgt in var.USERS:
-                if prefix == "+":
-                    var.USERS[trgt]["modes"].add(change)
-                    if change in var.USERS[trgt]["moded"]:
-                        var.USERS[trgt]["moded"].remove(change)
-                elif change in var.USERS[trgt]["modes"]:
-                    var.USERS[trgt]["modes"].remove(change)
     # Only sync modes if a server changed modes because
     # 1) human ops probably know better
     # 2) other bots might start a fight over modes
@@ -292,11 +285,13 @@ def reset_modes_timers(var):
         for deadguy in var.DEAD:
             if not is_fake_nick(deadguy):
                 cmodes.append(("-{0}".format(var.QUIET_MODE), var.QUIET_PREFIX+deadguy+"!*@*"))
-    channels.Main.mode("-m", *cmodes)
+    channels.Main.apply_modes("-m", *cmodes)
 
 def reset():
     var.PHASE = "none" # "join", "day", or "night"
     var.GAME_ID = 0
+    var.DAY_COUNT = 0
+    var.NIGHT_COUNT = 0
     var.RESTART_TRIES = 0
     var.DEAD = set()
     var.ROLES = {"person" : set()}
@@ -333,25 +328,16 @@ def fsync(var, wrapper, message):
     sync_modes(var)
 
 def sync_modes(var):
-    voices = [None]
     mode = hooks.Features["PREFIX"]["+"]
-    pl = list_players()
-
-    for user in channels.Main.users:
-        if var.DEVOICE_DURING_NIGHT and var.PHASE == "night":
-            if mode in user.channels[channels.Main]:
-                voices.append(("-" + mode, user))
-            elif user.nick in pl and mode not in user.channels[channels.Main]: # FIXME: Need to fix for when list_players() returns User instances
-                voices.append(("+" + mode, user))
-            elif user.nick not in pl and mode in user.channels[channels.Main]: # FIXME: See above comment
-                voices.append(("-" + mode, user))
+    voiced = list_players()
+    if var.DEVOICE_DURING_NIGHT and var.PHASE == "night":
+        voiced = []
 
+    moderated = "-m"
     if var.PHASE in var.GAME_PHASES:
-        voices[0] = "+m"
-    else:
-        voices[0] = "-m"
+        moderated = "+m"
 
-    channels.Main.mode(*voices)
+    channels.Main.apply_modes(moderated, exact={mode: voiced})
 
 @command("refreshdb", flag="m", pm=True)
 def refreshdb(var, wrapper, message):
@@ -485,7 +471,7 @@ def pinger(var, wrapper, message):
 def mark_simple_notify(var, wrapper, message):
     """Makes the bot give you simple role instructions, in case you are familiar with the roles."""
 
-    temp = wrapper.source.lower()
+    temp = wrapper.source.folded
 
     account = temp.account
     userhost = temp.userhost
@@ -511,7 +497,7 @@ def mark_prefer_notice(var, wrapper, message):
         # and not an intentional invocation of this command
         return
 
-    temp = wrapper.source.lower()
+    temp = wrapper.source.folded
 
     account = temp.account
     userhost = temp.userhost
@@ -784,7 +770,7 @@ def deadchat_pref(var, wrapper, message):
     if not var.ENABLE_DEADCHAT:
         return
 
-    temp = wrapper.source.lower()
+    temp = wrapper.source.folded
 
     if wrapper.source.account is None:
         if var.ACCOUNTS_ONLY:
@@ -851,7 +837,7 @@ def join_player(var, wrapper, who=None, forced=False, *, sanity=True):
                 "s" if stasis != 1 else ""), notice=True)
             return False
 
-    temp = wrapper.source.lower()
+    temp = wrapper.source.folded
 
     # don't check unacked warnings on fjoin
     if wrapper.source is who and db.has_unacknowledged_warnings(temp.account, temp.rawnick):
@@ -956,7 +942,7 @@ def join_player(var, wrapper, who=None, forced=False, *, sanity=True):
         t.start()
 
     if not wrapper.source.is_fake or not botconfig.DEBUG_MODE:
-        channels.Main.mode(*cmodes)
+        channels.Main.apply_modes(*cmodes)
 
     return True
 
@@ -995,17 +981,16 @@ def fjoin(var, wrapper, message):
         evt.data["join_player"](var, wrapper, forced=True)
 
     parts = re.split(" +", message)
-    possible_users = {u.lower().nick for u in wrapper.target.users}
     to_join = []
     if not botconfig.DEBUG_MODE:
-        match = complete_one_match(users.lower(parts[0]), possible_users)
+        match, _ = users.complete_match(parts[0], wrapper.target.users)
         if match:
-            to_join.append(match)
+            to_join.append(match.nick)
     else:
         for i, s in enumerate(parts):
-            match = complete_one_match(users.lower(s), possible_users)
+            match, _ = users.complete_match(s, wrapper.target.users)
             if match:
-                to_join.append(match)
+                to_join.append(match.nick)
             else:
                 to_join.append(s)
     for tojoin in to_join:
@@ -1715,7 +1700,7 @@ def hurry_up(cli, gameid, change):
     chan = botconfig.CHANNEL
 
     if not change:
-        cli.msg(chan, messages["daylight_warning"])
+        cli.msg(chan, messages["daylight_warning"], tag=phase_tag())
         return
 
     var.DAY_ID = 0
@@ -2233,6 +2218,7 @@ def stop_game(cli, winner="", abort=False, additional_winners=None, log=True):
 
     reset_modes_timers(var)
     reset()
+    drop_stale_messages(cli)
     expire_tempbans()
 
     # This must be after reset()
@@ -2392,6 +2378,7 @@ def del_player(cli, nick, forced_death=False, devoice=True, end_game=True, death
             var.ROLES[nickrole].remove(nick)
             for t in nicktpls:
                 var.ROLES[t].remove(nick)
+            drop_stale_messages(cli, nick) # e.g. idle warnings still waiting to be sent
             if nick in var.BITTEN_ROLES:
                 del var.BITTEN_ROLES[nick]
             if nick in var.CHARMED:
@@ -2696,7 +2683,7 @@ def del_player(cli, nick, forced_death=False, devoice=True, end_game=True, death
                     deadchat.append(users._get(nick)) # FIXME
             # devoice all players that died as a result, if we are in the original del_player
             if ismain:
-                mass_mode(cli, cmode, [])
+                channels.Main.apply_modes(*cmode)
                 del cmode[:]
             if var.PHASE == "join":
                 if nick in var.GAMEMODE_VOTES:
@@ -2840,9 +2827,9 @@ def reaper(cli, gameid):
                 pl = list_players()
                 x = [a for a in to_warn if a in pl]
                 if x:
-                    cli.msg(chan, messages["channel_idle_warning"].format(", ".join(x)))
+                    cli.msg(chan, messages["channel_idle_warning"].format(", ".join(x)), tag=phase_tag())
                 msg_targets = [p for p in to_warn_pm if p in pl]
-                mass_privmsg(cli, msg_targets, messages["player_idle_warning"].format(chan), privmsg=True)
+                mass_privmsg(cli, msg_targets, messages["player_idle_warning"].format(chan), privmsg=True, tag=phase_tag())
             for dcedplayer in list(var.DISCONNECTED.keys()):
                 acc, hostmask, timeofdc, what = var.DISCONNECTED[dcedplayer]
                 if what in ("quit", "badnick") and (datetime.now() - timeofdc) > timedelta(seconds=var.QUIT_GRACE_TIME):
@@ -2917,15 +2904,6 @@ def on_join(cli, raw_nick, chan, acc="*", rname=""):
     nick, _, ident, host = parse_nick(raw_nick)
     if nick == botconfig.NICK:
         plog("Joined {0}".format(chan))
-    elif not users.exists(nick):
-        users.add(nick, ident=ident,host=host,account=acc,inchan=(chan == botconfig.CHANNEL),modes=set(),moded=set())
-    else:
-        users.get(nick).ident = ident
-        users.get(nick).host = host
-        users.get(nick).account = acc
-        if not users.get(nick).inchan:
-            # Will be True if the user joined the main channel, else False
-            users.get(nick).inchan = (chan == botconfig.CHANNEL)
     if chan != botconfig.CHANNEL:
         return
     with var.GRAVEYARD_LOCK:
@@ -2936,7 +2914,7 @@ def on_join(cli, raw_nick, chan, acc="*", rname=""):
             act = var.DISCONNECTED[nick][0]
             if (lacc == act and not var.DISABLE_ACCOUNTS) or (hostmask == hm and not var.ACCOUNTS_ONLY):
                 if not var.DEVOICE_DURING_NIGHT or var.PHASE != "night":
-                    cli.mode(chan, "+v", nick, nick+"!*@*")
+                    channels.Main.apply_modes(("+v", nick))
                 del var.DISCONNECTED[nick]
                 var.LAST_SAID_TIME[nick] = datetime.now()
                 cli.msg(chan, messages["player_return"].format(nick))
@@ -2947,9 +2925,6 @@ def on_join(cli, raw_nick, chan, acc="*", rname=""):
                         break
                 if nick in var.DCED_PLAYERS.keys():
                     var.PLAYERS[nick] = var.DCED_PLAYERS.pop(nick)
-    if nick == botconfig.NICK:
-        #var.OPPED = False
-        cli.send("NAMES " + chan)
     #if nick == var.CHANSERV and not var.OPPED and var.CHANSERV_OP_COMMAND:
     #    cli.msg(var.CHANSERV, var.CHANSERV_OP_COMMAND.format(channel=botconfig.CHANNEL))
 
@@ -2995,7 +2970,7 @@ def fgoat(var, wrapper, message):
 @handle_error
 def return_to_village(var, chan, target, *, show_message):
     with var.GRAVEYARD_LOCK:
-        temp = target.lower()
+        temp = target.folded
         if temp.nick in var.DISCONNECTED:
             account, hostmask, when, what = var.DISCONNECTED[temp.nick]
             if ((not var.DISABLE_ACCOUNTS and temp.account is not None and users.equals(temp.account, account)) or
@@ -3210,12 +3185,6 @@ def nick_change(evt, var, user, old_rawnick):
 def cleanup_user(evt, var, user):
     var.LAST_GOAT.pop(user, None)
 
-@event_listener("nick_change")
-def update_users(evt, var, user, old_rawnick): # FIXME: This is a temporary hack while var.USERS still exists
-    nick = users.parse_rawnick_as_dict(old_rawnick)["nick"]
-    if nick in var.USERS:
-        var.USERS[user.nick] = var.USERS.pop(nick)
-
 @event_listener("chan_part")
 def left_channel(evt, var, chan, user, reason):
     leave(var, "part", user, chan)
@@ -3291,14 +3260,10 @@ def leave(var, what, user, why=None):
     var.SPECTATING_DEADCHAT.discard(user)
     leave_deadchat(var, user)
 
-    if what not in ("badnick", "account") and user.nick in var.USERS: # FIXME: Need to move mode toggling somewhere saner
-        var.USERS[user.nick]["modes"] = set()
-        var.USERS[user.nick]["moded"] = set()
-
     if killplayer:
         del_player(user.client, user.nick, death_triggers=False)
     else:
-        temp = user.lower()
+        temp = user.folded
         var.DISCONNECTED[user.nick] = (temp.account, temp.userhost, datetime.now(), what) # FIXME: Need to make var.DISCONNECTED hold User instances
 
 @cmd("quit", "leave", pm=True, phases=("join", "day", "night"))
@@ -3400,7 +3365,7 @@ def begin_day(cli):
         modes = []
         for player in list_players():
             modes.append(("+v", player))
-        mass_mode(cli, modes, [])
+        channels.Main.apply_modes(*modes)
 
     event = Event("begin_day", {})
     event.dispatch(cli, var)
@@ -3415,7 +3380,7 @@ def night_warn(cli, gameid):
     if var.PHASE != "night":
         return
 
-    cli.msg(botconfig.CHANNEL, (messages["twilight_warning"]))
+    cli.msg(botconfig.CHANNEL, messages["twilight_warning"], tag=phase_tag())
 
 @handle_error
 def transition_day(cli, gameid=0):
@@ -3429,6 +3394,7 @@ def transition_day(cli, gameid=0):
 
     var.PHASE = "day"
     var.DAY_COUNT += 1
+    drop_stale_messages(cli)
     var.FIRST_DAY = (var.DAY_COUNT == 1)
     var.DAY_START_TIME = datetime.now()
     var.VOTES = {}
@@ -5058,21 +5024,9 @@ def on_targeted_command(evt, cli, var, cmd, actor, orig_target, tags):
         evt.stop_processing = True
         evt.prevent_default = True
 
-@hook("featurelist")  # For multiple targets with PRIVMSG
+@hook("featurelist")
 def getfeatures(cli, nick, *rest):
     for r in rest:
-        if r.startswith("TARGMAX="):
-            x = r[r.index("PRIVMSG:"):]
-            if "," in x:
-                l = x[x.index(":")+1:x.index(",")]
-            else:
-                l = x[x.index(":")+1:]
-            l = l.strip()
-            if not l or not l.isdigit():
-                continue
-            else:
-                var.MAX_PRIVMSG_TARGETS = int(l)
-                continue
         if r.startswith("PREFIX="):
             prefs = r[7:]
             chp = []
@@ -5110,17 +5064,12 @@ def getfeatures(cli, nick, *rest):
         if r.startswith("CHANMODES="):
             chans = r[10:].split(",")
             var.LISTMODES, var.MODES_ALLSET, var.MODES_ONLYSET, var.MODES_NOSET = chans
-        if r.startswith("MODES="):
-            try:
-                var.MODELIMIT = int(r[6:])
-            except ValueError:
-                pass
         if r.startswith("STATUSMSG="):
             var.STATUSMSG_PREFIXES = list(r.split("=")[1])
         if r.startswith("CASEMAPPING="):
             var.CASEMAPPING = r.split("=")[1]
 
-            if var.CASEMAPPING not in ("rfc1459", "strict-rfc1459", "ascii"):
+            if not casemapping.supported(var.CASEMAPPING):
                 # This is very unlikely to happen, but just in case.
                 errlog("Unsupported case mapping: {0!r}; falling back to rfc1459.".format(var.CASEMAPPING))
                 var.CASEMAPPING = "rfc1459"
@@ -5147,7 +5096,7 @@ def relay(var, wrapper, message):
     pl = list_players()
 
     if wrapper.source.nick in pl and wrapper.source.nick in getattr(var, "IDLE_WARNED_PM", ()):
-        wrapper.pm(messages["privmsg_idle_warning"].format(channels.Main))
+        wrapper.pm(messages["privmsg_idle_warning"].format(channels.Main), tag=phase_tag())
         var.IDLE_WARNED_PM.add(wrapper.source)
 
     if message.startswith(botconfig.CMD_CHAR):
@@ -5205,6 +5154,7 @@ def transition_night(cli):
 
     var.NIGHT_START_TIME = datetime.now()
     var.NIGHT_COUNT += 1
+    drop_stale_messages(cli)
     var.FIRST_NIGHT = (var.NIGHT_COUNT == 1)
 
     event_begin = Event("transition_night_begin", {})
@@ -5214,7 +5164,7 @@ def transition_night(cli):
         modes = []
         for player in list_players():
             modes.append(("-v", player))
-        mass_mode(cli, modes, [])
+        channels.Main.apply_modes(*modes)
 
     for x, tmr in var.TIMERS.items():  # cancel daytime timer
         tmr[0].cancel()
@@ -5304,7 +5254,21 @@ def transition_night(cli):
     if chk_win(cli):
         return
 
-    # send PMs
+    # send PMs; identical ones (e.g. to everyone with the same role) go out together
+    with context.batch():
+        _send_night_pms(cli)
+
+    dmsg = (daydur_msg + messages["night_begin"])
+
+    if not var.FIRST_NIGHT:
+        dmsg = (dmsg + messages["first_night_begin"])
+    cli.msg(chan, dmsg)
+    debuglog("BEGIN NIGHT")
+    # If there are no nightroles that can act, immediately turn it to daytime
+    chk_nightdone(cli)
+
+
+def _send_night_pms(cli):
     ps = list_players()
 
     for pht in var.ROLES["prophet"]:
@@ -5506,15 +5470,6 @@ def transition_night(cli):
     event_end = Event("transition_night_end", {})
     event_end.dispatch(cli, var)
 
-    dmsg = (daydur_msg + messages["night_begin"])
-
-    if not var.FIRST_NIGHT:
-        dmsg = (dmsg + messages["first_night_begin"])
-    cli.msg(chan, dmsg)
-    debuglog("BEGIN NIGHT")
-    # If there are no nightroles that can act, immediately turn it to daytime
-    chk_nightdone(cli)
-
 
 def cgamemode(cli, arg):
     chan = botconfig.CHANNEL
@@ -5884,7 +5839,7 @@ def start(cli, nick, chan, forced = False, restart = ""):
             options = ""
 
         cli.msg(chan, messages["welcome"].format(", ".join(pl), gamemode, options))
-        cli.mode(chan, "+m")
+        channels.Main.apply_modes("+m")
 
     var.ORIGINAL_ROLES = copy.deepcopy(var.ROLES)  # Make a copy
 
@@ -5918,7 +5873,7 @@ def start(cli, nick, chan, forced = False, restart = ""):
 
     var.LAST_PING = None
 
-    var.PLAYERS = {plr:dict(var.USERS[plr]) for plr in pl if plr in var.USERS}
+    var.PLAYERS = {plr: users.get(plr) for plr in pl if users.exists(plr)}
 
     debuglog("ROLES:", " | ".join("{0}: {1}".format(role, ", ".join(players))
         for role, players in sorted(var.ROLES.items()) if players and role not in var.TEMPLATE_RESTRICTIONS.keys()))
@@ -5949,7 +5904,13 @@ def start(cli, nick, chan, forced = False, restart = ""):
 
 @hook("error")
 def on_error(cli, pfx, msg):
-    if var.RESTARTING or msg.endswith("(Excess Flood)"):
+    if var.RESTARTING:
+        _restart_program()
+    elif cli.reconnect and not cli.quitting:
+        # the server is dropping us; the client reconnects once the link is closed
+        if msg.endswith("(Excess Flood)"):
+            cli.tokenbucket.report_throttle()
+    elif msg.endswith("(Excess Flood)"):
         _restart_program()
     elif msg.startswith("Closing Link:"):
         raise SystemExit
@@ -6946,7 +6907,7 @@ def _say(wrapper, rest, cmd, action=False):
     target, message = rest
 
     if target.startswith(tuple(hooks.Features["CHANTYPES"])):
-        targ = channels.get(target, allow_none=True)
+        targ = channels.get(target, wrapper.client, allow_none=True)
     else:
         targ = users._get(target, allow_multiple=True) # FIXME
         if len(targ) == 1:
@@ -7312,7 +7273,7 @@ if botconfig.DEBUG_MODE or botconfig.ALLOWED_NORMAL_MODE_COMMANDS:
                     var.ROLES[var.DEFAULT_ROLE].add(who)
                     var.ALL_PLAYERS.append(users._get(who)) # FIXME
                     if not is_fake_nick(who):
-                        cli.mode(chan, "+v", who)
+                        channels.Main.apply_modes(("+v", who))
                     cli.msg(chan, messages["template_default_role"].format(var.DEFAULT_ROLE))
 
                 var.ROLES[rol].add(who)
@@ -7345,7 +7306,7 @@ if botconfig.DEBUG_MODE or botconfig.ALLOWED_NORMAL_MODE_COMMANDS:
             evt = Event("frole_role", {})
             evt.dispatch(cli, var, who, rol, oldrole, rolargs)
             if not is_fake_nick(who):
-                cli.mode(chan, "+v", who)
+                channels.Main.apply_modes(("+v", who))
         else:
             cli.msg(chan, messages["invalid_role"])
             return
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""Benchmark of nick case folding (context.lower() and src.casemapping).
+
+Times folding a set of typical nicks with the translation table built on
+every call, as lower() and irc_lower() used to do. It compares that with
+src.casemapping, both on a cache miss (only the precomputed table) and
+on a cache hit. It also times context.lower(), which looks up the
+server's CASEMAPPING and is what most of the bot calls.
+
+It imports the bot, so it needs a botconfig.py like the bot does:
+
+    python3 tools/bench_casemapping.py --nicks 1000
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def _old_lower(nick, casemapping="rfc1459"):
+    """Fold a nick the way lower() and irc_lower() did before src.casemapping."""
+    if nick is None:
+        return None
+
+    mapping = {
+        "[": "{",
+        "]": "}",
+        "\\": "|",
+        "^": "~",
+    }
+
+    if casemapping == "strict-rfc1459":
+        mapping.pop("^")
+    elif casemapping == "ascii":
+        mapping.clear()
+
+    return nick.lower().translate(str.maketrans(mapping))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nicks", type=int, default=1000, help="number of distinct nicks to fold")
+    parser.add_argument("--rounds", type=int, default=20, help="times to fold every nick per timing")
+    args = parser.parse_args()
+    del sys.argv[1:] # src parses the command line when it is imported
+
+    from src import casemapping
+    from src.context import lower
+
+    shapes = ("Wolf{0}", "[Hunter]{0}", "Seer^{0}", "night\\owl{0}", "VILLAGER_{0}")
+    nicks = [shapes[i % len(shapes)].format(i) for i in range(args.nicks)]
+    for nick in nicks:
+        assert _old_lower(nick) == casemapping.lower(nick) == lower(nick)
+
+    def fold_all(function):
+        def run():
+            for nick in nicks:
+                function(nick)
+        return run
+
+    casemapping.lower.cache_clear()
+    for nick in nicks: # warm the cache, as the same nicks keep coming back
+        casemapping.lower(nick)
+        lower(nick)
+
+    timings = (
+        ("table built per call", fold_all(_old_lower)),
+        ("cache miss", fold_all(casemapping.lower.__wrapped__)),
+        ("cache hit", fold_all(casemapping.lower)),
+        ("context.lower()", fold_all(lower)),
+    )
+    calls = args.nicks * args.rounds
+    print("Folding {0} distinct nicks, per call:".format(args.nicks))
+    for label, run in timings:
+        timer = timeit.Timer(run)
+        print("  {0:<22} {1:>6.2f}us".format(label, min(timer.repeat(5, args.rounds)) / calls * 1e6))
+    print("Cache: {0}".format(casemapping.lower.cache_info()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""Memory and speed of users as channel members, for a large simulated channel.
+
+Creates the given number of users in the registry and in a channel, as
+the bot does for a WHO reply, and reports how much memory each member
+takes (measured with tracemalloc) and where it goes: the User object, the
+registry, the channel, and the cached folded identity. For comparison, it
+shows how large the User object would be with a __dict__ instead of
+__slots__. It then times the per-message checks which use the folded
+identity against User.lower().
+
+It imports the bot, so it needs a botconfig.py like the bot does:
+
+    python3 tools/bench_members.py --members 5000
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+class FakeClient:
+    nickname = "mywolfbot"
+    ident = "~wolf"
+    hostmask = "unaffiliated/mywolfbot"
+
+    def send(self, *args, **kwargs):
+        pass
+
+def _instance_size(obj):
+    """Return the size of an object along with its __dict__, if any (but not its attributes)."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def _dict_equivalent(user):
+    """Return an object with the same attributes as user, stored in a __dict__."""
+    class DictUser:
+        pass
+    obj = DictUser()
+    for cls in type(user).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if hasattr(user, name):
+                setattr(obj, name, getattr(user, name))
+    return obj
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--number", type=int, default=20000, help="calls per timing")
+    args = parser.parse_args()
+    del sys.argv[1:] # src parses the command line when it is imported
+
+    from src import channels, db, users
+    from src.context import Features
+
+    db.init_vars() # the preferences and stasis checks look up the bot's database
+
+    cli = FakeClient()
+    Features["PREFIX"] = {"@": "o", "+": "v"}
+    Features["CHANMODES"] = ("beIq", "k", "l", "imnst")
+    users.Bot = users.BotUser(cli, cli.nickname)
+    users.Bot.ident = cli.ident
+    users.Bot.host = cli.hostmask
+    channel = channels.add("##werewolf", cli)
+    channel.add_user(users.Bot, "o")
+
+    identities = [("Player{0}".format(i), "~player{0}".format(i), "user/player{0}".format(i),
+                   "Player {0}".format(i), "player{0}".format(i)) for i in range(args.members)]
+    modes = ["v" if i % 10 == 0 else "" for i in range(args.members)]
+
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    members = []
+    for nick, ident, host, realname, account in identities:
+        members.append(users._add(cli, nick=nick, ident=ident, host=host, realname=realname, account=account))
+    registered = tracemalloc.take_snapshot()
+    for user, status in zip(members, modes):
+        channel.add_user(user, status)
+    joined = tracemalloc.take_snapshot()
+    for user in members:
+        user.folded
+    folded = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def per_member(after, before):
+        return sum(stat.size_diff for stat in after.compare_to(before, "filename")) / args.members
+
+    user = members[len(members) // 2]
+    steps = (
+        ("user and registry", per_member(registered, start)),
+        ("channel membership", per_member(joined, registered)),
+        ("folded identity", per_member(folded, joined)),
+    )
+    print("{0} members, memory per member:".format(args.members))
+    for label, size in steps:
+        print("  {0:<20} {1:>7.0f} bytes".format(label, size))
+    print("  {0:<20} {1:>7.0f} bytes".format("total", sum(size for label, size in steps)))
+    print("User object alone: {0} bytes with __slots__, {1} bytes with a __dict__".format(
+        _instance_size(user), _instance_size(_dict_equivalent(user))))
+
+    print("Per call:")
+    checks = (
+        ("folded", lambda: user.folded),
+        ("lower()", lambda: user.lower()),
+        ("prefers_notice()", lambda: user.prefers_notice()),
+        ("stasis_count()", lambda: user.stasis_count()),
+    )
+    for label, check in checks:
+        timer = timeit.Timer(check)
+        print("  {0:<20} {1:>7.2f}us".format(label, min(timer.repeat(5, args.number)) / args.number * 1e6))
+
+if __name__ == "__main__":
+    main()
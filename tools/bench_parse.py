@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Checks and a benchmark for parsing received IRC lines.
+
+Runs oyoyo.parse.parse_message() and the parser it replaced over a mix
+of lines as servers send them: channel messages, numerics (WHOX, NAMES,
+ISUPPORT), JOINs with extended-join, MODE changes, lines with IRCv3 tags
+(escaped or not), trailing parameters (empty, or with colons and spaces
+in them), and lines with repeated spaces. It checks that both parsers
+agree on every line, then times them.
+
+The old parser did not know about message tags and kept an empty
+parameter for every extra space. The check allows for exactly these
+differences: the old parser is given the line without its tags (as it
+got them before tags were negotiated), the tags are compared against
+what they should be, and the old parser's empty parameters are ignored.
+
+    python3 tools/bench_parse.py --number 20000
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from oyoyo.ircevents import numeric_events
+from oyoyo.parse import parse_message
+
+# (line, expected tags)
+LINES = (
+    (b":nick!~ident@user/nick PRIVMSG ##werewolf :!join", {}),
+    (b":nick!~ident@user/nick PRIVMSG mywolfbot :see alice: she's the seer", {}),
+    (b":nick!~ident@user/nick NOTICE mywolfbot :", {}),
+    (b":nick!~ident@user/nick JOIN ##werewolf nick :Real Name", {}),
+    (b":nick!~ident@user/nick PART ##werewolf :Leaving", {}),
+    (b":nick!~ident@user/nick QUIT :Ping timeout: 240 seconds", {}),
+    (b":ChanServ!ChanServ@services. MODE ##werewolf +vvvv alice bob carol dave", {}),
+    (b":mywolfbot!~wolf@unaffiliated/mywolfbot MODE ##werewolf +b *!*@host:with:colons", {}),
+    (b":irc.example.net 354 mywolfbot 0 ##werewolf ~alice 10.0.0.1 user/alice irc.example.net alice H@ 0 alice :Alice A.", {}),
+    (b":irc.example.net 353 mywolfbot = ##werewolf :@mywolfbot +alice bob carol dave eve mallory", {}),
+    (b":irc.example.net 005 mywolfbot CHANTYPES=# PREFIX=(ov)@+ CHANMODES=eIbq,k,flj,CFLMPQScgimnprstuz MODES=4 "
+     b"WHOX CASEMAPPING=rfc1459 TARGMAX=NAMES:1,LIST:1,KICK:1,WHOIS:1,PRIVMSG:4,NOTICE:4 :are supported by this server", {}),
+    (b":irc.example.net 001 mywolfbot :Welcome to the Example Internet Relay Chat Network mywolfbot", {}),
+    (b":irc.example.net 433 * mywolfbot :Nickname is already in use.", {}),
+    (b"PING :irc.example.net", {}),
+    (b":irc.example.net CAP mywolfbot ACK :account-notify extended-join multi-prefix", {}),
+    (b"AUTHENTICATE +", {}),
+    (b"@time=2024-01-01T12:00:00.000Z;account=alice :alice!~alice@user/alice PRIVMSG ##werewolf :!vote bob",
+     {"time": "2024-01-01T12:00:00.000Z", "account": "alice"}),
+    (b"@msgid=abc;+draft/reply=xyz;batch :bob!~bob@user/bob PRIVMSG ##werewolf :hi",
+     {"msgid": "abc", "+draft/reply": "xyz", "batch": ""}),
+    (b"@example.com/tag=a\\sb\\:c\\\\d :irc.example.net NOTICE mywolfbot :escaped tag",
+     {"example.com/tag": "a b;c\\d"}),
+    (b"@account=carol :carol!~carol@user/carol ACCOUNT carol", {"account": "carol"}),
+    (b":nick!~ident@user/nick PRIVMSG  ##werewolf  :two  spaces  inside", {}),
+    (b":irc.example.net  MODE  ##werewolf  +o  alice", {}),
+    (b"@time=2024-01-01T12:00:00.000Z  :alice!~alice@user/alice  NOTICE  mywolfbot  :tagged, repeated spaces",
+     {"time": "2024-01-01T12:00:00.000Z"}),
+)
+
+def _old_parse(element):
+    """The parser used before parse_message(), as parse_raw_irc_command() was."""
+    parts = element.strip().split(bytes(" ", "utf_8"))
+    if parts[0].startswith(bytes(':', 'utf_8')):
+        prefix = parts[0][1:]
+        command = parts[1]
+        args = parts[2:]
+    else:
+        prefix = None
+        command = parts[0]
+        args = parts[1:]
+
+    if command.isdigit():
+        try:
+            command = numeric_events[command]
+        except KeyError:
+            pass
+    command = command.lower()
+    if isinstance(command, bytes): command = command.decode("utf_8")
+
+    if args[0].startswith(bytes(':', 'utf_8')):
+        args = [bytes(" ", "utf_8").join(args)[1:]]
+    else:
+        for idx, arg in enumerate(args):
+            if arg.startswith(bytes(':', 'utf_8')):
+                args = args[:idx] + [bytes(" ", 'utf_8').join(args[idx:])[1:]]
+                break
+
+    return (prefix, command, args)
+
+def _untagged(line):
+    if line.startswith(b"@"):
+        return line.split(b" ", 1)[1].lstrip(b" ")
+    return line
+
+def _without_empty_params(params):
+    """Drop the empty parameters the old parser made out of repeated spaces (but keep an empty trailing one)."""
+    return [param for param in params[:-1] if param] + params[-1:]
+
+def check():
+    failures = 0
+    for line, expected_tags in LINES:
+        tags, prefix, command, params = parse_message(line)
+        old_prefix, old_command, old_params = _old_parse(_untagged(line))
+        if b"  " in line:
+            old_params = _without_empty_params(old_params)
+            if old_command == "": # the old parser took the empty string after the prefix for the command
+                old_command, old_params = old_params[0].decode("latin_1").lower(), old_params[1:]
+        if (tags, prefix, command, params) != (expected_tags, old_prefix, old_command, old_params):
+            failures += 1
+            print("Mismatch for {0!r}:".format(line))
+            print("  new: {0!r}".format((tags, prefix, command, params)))
+            print("  old: {0!r}".format((expected_tags, old_prefix, old_command, old_params)))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=20000, help="passes over the lines per timing")
+    args = parser.parse_args()
+
+    failures = check()
+    print("{0} lines checked: {1} mismatched".format(len(LINES), failures))
+    if failures:
+        sys.exit(1)
+
+    # the old parser gets the lines without tags, as above, so that it doesn't take them for the command
+    untagged = [_untagged(line) for line, tags in LINES]
+    lines = [line for line, tags in LINES]
+    timings = (
+        ("old parser", lambda: [_old_parse(line) for line in untagged]),
+        ("parse_message()", lambda: [parse_message(line) for line in lines]),
+    )
+    count = len(LINES) * args.number
+    print("Per line, over the mix:")
+    for label, run in timings:
+        timer = timeit.Timer(run)
+        print("  {0:<16} {1:>6.2f}us".format(label, min(timer.repeat(5, args.number)) / count * 1e6))
+
+if __name__ == "__main__":
+    main()
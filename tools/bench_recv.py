@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the receive loop's line framing during a join burst.
+
+Builds a burst of server lines like the ones the bot gets when it joins
+a big channel: JOINs (with extended-join), WHOX replies, NAMES replies
+and channel messages. It sends the burst through a local socket pair
+and frames it into lines two ways:
+- with oyoyo.client.LineBuffer and recv_into(), as IRCClient does now;
+- with the old framing, which appended every recv() to a bytes object
+  and split the whole buffer on each read.
+It checks that both give the same lines before reporting the times.
+
+    python3 tools/bench_recv.py --lines 50000
+
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from oyoyo.client import LineBuffer
+
+def join_burst(count, channel="##werewolf"):
+    """Return count lines of a join burst, as the server would send them."""
+    lines = []
+    for i in range(count):
+        nick = "Player{0}".format(i)
+        kind = i % 4
+        if kind == 0:
+            lines.append(":{0}!~p{1}@user/p{1} JOIN {2} p{1} :Player number {1}".format(nick, i, channel))
+        elif kind == 1:
+            lines.append(":irc.example.net 354 mywolfbot 0 {0} ~p{1} 10.0.{2}.{3} user/p{1} irc.example.net {4} H{5} 0 p{1} :Player number {1}".format(
+                channel, i, i // 256 % 256, i % 256, nick, "+" if i % 3 == 0 else ""))
+        elif kind == 2:
+            lines.append(":irc.example.net 353 mywolfbot = {0} :{1}".format(channel, " ".join("Player{0}".format(j) for j in range(i, i + 20))))
+        else:
+            lines.append("@time=2024-01-01T00:00:00.000Z;account=p{1} :{0}!~p{1}@user/p{1} PRIVMSG {2} :!join".format(nick, i, channel))
+    return [line.encode("utf_8") for line in lines]
+
+def _send_all(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+def _receive(framing, data, recv_size):
+    """Send data through a socket pair and return the time taken to frame it, and the lines."""
+    reader, writer = socket.socketpair()
+    try:
+        sender = threading.Thread(target=_send_all, args=(writer, data), daemon=True)
+        start = time.perf_counter()
+        sender.start()
+        lines = framing(reader, recv_size)
+        elapsed = time.perf_counter() - start
+        sender.join()
+    finally:
+        reader.close()
+        writer.close()
+    return elapsed, lines
+
+def old_framing(sock, recv_size):
+    """The framing done by IRCClient.connect() before LineBuffer."""
+    lines = []
+    buffer = bytes()
+    while True:
+        received = sock.recv(recv_size)
+        if not received:
+            break
+        buffer += received
+        data = buffer.split(bytes("\n", "utf_8"))
+        buffer = data.pop()
+        for el in data:
+            lines.append(el.rstrip(b"\r")) # the parser used to strip it
+    return lines
+
+def new_framing(sock, recv_size):
+    """The framing done by IRCClient.connect() now."""
+    lines = []
+    buffer = LineBuffer(recv_size * 2)
+    while buffer.recv_into(sock, recv_size):
+        lines.extend(buffer.lines())
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=50000, help="number of lines in the burst")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each framing; the best one counts")
+    parser.add_argument("--old-recv-size", type=int, default=1024, help="bytes per read of the old framing")
+    parser.add_argument("--recv-size", type=int, default=16384, help="bytes per read of LineBuffer")
+    args = parser.parse_args()
+
+    lines = join_burst(args.lines)
+    data = b"\r\n".join(lines) + b"\r\n"
+    print("Burst of {0} lines, {1:.1f} MB".format(len(lines), len(data) / 1e6))
+
+    runs = (
+        ("old, {0} byte reads".format(args.old_recv_size), old_framing, args.old_recv_size),
+        ("old, {0} byte reads".format(args.recv_size), old_framing, args.recv_size),
+        ("LineBuffer, {0} byte reads".format(args.recv_size), new_framing, args.recv_size),
+    )
+    for label, framing, recv_size in runs:
+        best = None
+        for i in range(args.repeat):
+            elapsed, framed = _receive(framing, data, recv_size)
+            if framed != lines:
+                print("{0}: the lines differ from the ones sent".format(label))
+                sys.exit(1)
+            if best is None or elapsed < best:
+                best = elapsed
+        print("  {0:<28} {1:>8.1f}ms ({2:.2f}us per line)".format(label, best * 1000, best / len(lines) * 1e6))
+
+if __name__ == "__main__":
+    main()
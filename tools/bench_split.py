@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""Randomized checks and a benchmark for the outgoing message splitter.
+
+The checks feed oyoyo.split.split() and pack() random text: ASCII and
+multi-byte characters, spaces, newlines, and items of all sizes, against
+budgets down to a single 4-byte character. They verify that every line
+fits its budget in bytes, that no line is empty, that no text is lost or
+reordered (only the spaces at which lines are broken may be dropped),
+and that no line is cut in the middle of a UTF-8 character.
+
+The benchmark times what context._send() does for a message, from the
+line budget to the last line. It uses the same message shapes as the
+old character-counting code, which is kept here for comparison:
+
+    python3 tools/bench_split.py --cases 20000
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from oyoyo.split import bytelen, line_budget, pack, split
+
+ALPHABETS = (
+    "abcdefghijklmnopqrstuvwxyz0123456789[]{}|^_-.:!?",
+    "éèàüöçñßøåœ", # 2 bytes in UTF-8
+    "€→★☃♥中文日本語한국어", # 3 bytes
+    "😀🐺🌙🔪🧛", # 4 bytes
+)
+
+def random_text(rng, length):
+    chars = []
+    for i in range(length):
+        roll = rng.random()
+        if roll < 0.15:
+            chars.append(" ")
+        elif roll < 0.17:
+            chars.append("\n")
+        elif roll < 0.7:
+            chars.append(rng.choice(ALPHABETS[0]))
+        else:
+            chars.append(rng.choice(rng.choice(ALPHABETS[1:])))
+    return "".join(chars)
+
+def _content(text, dropped):
+    """Return text without the characters which splitting may drop (spaces, newlines and separators)."""
+    return text.translate({ord(char): None for char in dropped})
+
+def check_lines(lines, budget, expected, what, dropped=" \n"):
+    for line in lines:
+        if not line:
+            return "{0}: empty line".format(what)
+        if bytelen(line) > budget:
+            return "{0}: line of {1} bytes over budget {2}: {3!r}".format(what, bytelen(line), budget, line)
+        if "\ufffd" in line or "\n" in line:
+            return "{0}: broken character or newline in {1!r}".format(what, line)
+        try:
+            line.encode("utf_8")
+        except UnicodeEncodeError: # a lone surrogate, i.e. half a character
+            return "{0}: half a character in {1!r}".format(what, line)
+    if _content("".join(lines), dropped) != _content(expected, dropped):
+        return "{0}: text lost or reordered".format(what)
+    return None
+
+def run_checks(cases, seed):
+    rng = random.Random(seed)
+    failures = 0
+    for case in range(cases):
+        budget = rng.choice((4, 5, 7, rng.randint(4, 64), rng.randint(64, 500)))
+
+        text = random_text(rng, rng.randint(0, 1200)).replace("\n", " ")
+        error = check_lines(list(split(text, budget)), budget, text, "split")
+
+        if error is None:
+            items = [random_text(rng, rng.choice((0, 1, rng.randint(1, 20), rng.randint(20, 600))))
+                     for i in range(rng.randint(0, 30))]
+            sep = rng.choice((" ", "", ", "))
+            # the separator is left out where a line is broken
+            error = check_lines(list(pack(items, sep, budget)), budget, sep.join(items), "pack", " \n" + sep)
+
+        if error is not None:
+            failures += 1
+            if failures <= 10:
+                print("case {0} (seed {1}, budget {2}): {3}".format(case, seed, budget, error))
+    return failures
+
+def _old_send_lines(data, first, sep, nick, ident, host, send_type, name):
+    """The splitting done by context._send() before oyoyo.split, counting characters."""
+    full_address = "{0}!{1}@{2}".format(nick, ident, host)
+    length = 512 - 7 - len(full_address) - len(name) - len(send_type)
+    if length - len(first) > 0:
+        length -= len(first)
+    else:
+        first = ""
+    messages = []
+    count = 0
+    for line in data:
+        if count and count + len(sep) + len(line) > length:
+            count = len(line)
+            cur_sep = "\n"
+        elif not messages:
+            count = len(line)
+            cur_sep = ""
+        else:
+            count += len(sep) + len(line)
+            cur_sep = sep
+        messages.append(cur_sep)
+        messages.append(line)
+    return ["{0} {1} :{2}{3}".format(send_type, name, first, line) for line in "".join(messages).split("\n")]
+
+def _new_send_lines(data, first, sep, nick, ident, host, send_type, name):
+    """The splitting done by context._send() now."""
+    length = line_budget(nick, ident, host, send_type, name)
+    first_length = bytelen(first)
+    if length - first_length > 0:
+        length -= first_length
+    else:
+        first = ""
+    prefix = "{0} {1} :{2}".format(send_type, name, first)
+    return [prefix + line for line in pack(data, sep, length)]
+
+def run_benchmark(number):
+    sender = ("mywolfbot", "~wolf", "unaffiliated/mywolfbot")
+    shapes = (
+        ("short message", ["You have been lynched."], ""),
+        ("200 items", ["player{0}".format(i) for i in range(200)], ", "),
+        ("1.4kB non-ASCII", [("Die Werwölfe fressen ★ in der Nacht " * 40)[:1400]], ""),
+    )
+    print("{0:<18} {1:>10} {2:>10}".format("message", "old", "new"))
+    for label, data, sep in shapes:
+        times = []
+        for send in (_old_send_lines, _new_send_lines):
+            timer = timeit.Timer(lambda: send(data, "", sep, *sender, "PRIVMSG", "##werewolf"))
+            times.append(min(timer.repeat(5, number)) / number * 1e6)
+        print("{0:<18} {1:>8.1f}us {2:>8.1f}us".format(label, *times))
+    print("(the old code splits non-ASCII text by characters, which can overflow the 512-byte limit)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cases", type=int, default=20000, help="number of random cases to check")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--number", type=int, default=10000, help="calls per benchmark timing")
+    parser.add_argument("--no-bench", action="store_true", help="only run the checks")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    failures = run_checks(args.cases, seed)
+    print("{0} random cases (seed {1}): {2} failed".format(args.cases, seed, failures))
+
+    if not args.no_bench:
+        run_benchmark(args.number)
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""Check that var.USERS, the legacy view of the users registry, behaves as it used to.
+
+Adds a real user and a fake player (as !fjoin does in debug mode) to the
+registry, then checks that var.USERS only has the real user. It also
+checks that the legacy helpers which look users up in var.USERS handle
+the fake player as they always did: is_user_simple(),
+is_user_notice() and is_user_stasised().
+
+It imports the bot, so it needs a botconfig.py like the bot does:
+
+    python3 tools/check_legacy_users.py
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+class FakeClient:
+    nickname = "mywolfbot"
+    ident = "~wolf"
+    hostmask = "unaffiliated/mywolfbot"
+
+    def send(self, *args, **kwargs):
+        pass
+
+def main():
+    del sys.argv[1:] # src parses the command line when it is imported
+
+    from src import db, users
+    from src import settings as var
+    from src.utilities import is_user_simple, is_user_notice
+    from src.warnings import is_user_stasised
+
+    db.init_vars()
+    var.USERS = users.LegacyUsers() # as src.wolfgame does
+
+    cli = FakeClient()
+    users.Bot = users.BotUser(cli, cli.nickname)
+    users._add(cli, nick="alice!~alice@user/alice", account="alice")
+    fake = users._add(cli, nick="1") # what !fjoin does
+
+    failures = []
+    def check(condition, what):
+        if not condition:
+            failures.append(what)
+
+    check(fake.is_fake and fake.host is None, "the fake player is a FakeUser without a host")
+    check("alice" in var.USERS and var.USERS["alice"]["host"] == "user/alice", "the real user is in var.USERS")
+    check("1" not in var.USERS, "the fake player is not in var.USERS")
+    check(list(var.USERS) == ["alice"] and len(var.USERS) == 1, "var.USERS only lists the real user")
+    try:
+        var.USERS["1"]
+    except KeyError:
+        pass
+    else:
+        failures.append("var.USERS['1'] raises KeyError")
+
+    for helper, expected in ((is_user_simple, False), (is_user_notice, False), (is_user_stasised, -1)):
+        try:
+            result = helper("1")
+        except Exception as e:
+            failures.append("{0}('1') raised {1!r}".format(helper.__name__, e))
+        else:
+            check(result == expected, "{0}('1') returns {1!r}".format(helper.__name__, expected))
+
+    for failure in failures:
+        print("FAILED: {0}".format(failure))
+    print("{0} failed".format(len(failures)) if failures else "all checks passed")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
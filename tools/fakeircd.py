@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+
+"""A local stand-in IRC server and client swarm for end-to-end benchmarks.
+
+The server speaks just enough of the protocol for the bot to connect,
+authenticate and play: CAP (with SASL PLAIN), WHO/WHOX, JOIN, PART, QUIT,
+KICK, NICK, MODE, PRIVMSG, NOTICE, PING/PONG and a fixed RPL_ISUPPORT.
+The swarm connects N users to it, has them join games and send commands
+at a given rate, and reports command-to-reply latency and throughput.
+
+Point the bot at the server in botconfig.py (HOST = "127.0.0.1",
+PORT = 6667, USE_SSL = False, and the same CHANNEL as --channel), then:
+
+    python3 tools/fakeircd.py --users 20 --rate 5 --duration 300 --bot
+
+--bot starts ./wolfbot.py itself; leave it out to run the bot separately.
+Latency is measured from a user's command to the first line the bot
+addresses to (or mentions) that user; commands which get no reply within
+--reply-timeout seconds are counted as unanswered.
+
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from oyoyo.parse import parse_message, decode
+
+SERVER_NAME = "irc.fake.test"
+
+ISUPPORT = ("CHANTYPES=# PREFIX=(ov)@+ CHANMODES=b,k,l,imnst MODES=4 WHOX "
+            "CASEMAPPING=rfc1459 TARGMAX=PRIVMSG:4,NOTICE:4 STATUSMSG=@+ "
+            "NICKLEN=30 NETWORK=FakeNet")
+
+CAPS = {"account-notify", "extended-join", "multi-prefix", "sasl"}
+
+_lower_table = str.maketrans("[]\\^", "{}|~")
+
+def irc_lower(name):
+    return name.lower().translate(_lower_table)
+
+class Client:
+    def __init__(self, server, writer, address):
+        self.server = server
+        self.writer = writer
+        self.nick = None
+        self.ident = None
+        self.realname = None
+        self.host = "fake-{0}.test".format(address)
+        self.account = None
+        self.caps = set()
+        self.negotiating = False
+        self.registered = False
+        self.channels = set()
+        self.lines_in = 0
+
+    @property
+    def prefix(self):
+        return "{0}!{1}@{2}".format(self.nick, self.ident, self.host)
+
+    def send(self, line):
+        if not self.writer.is_closing():
+            self.writer.write(line.encode("utf-8") + b"\r\n")
+
+    def numeric(self, num, *params):
+        params = list(params)
+        if params:
+            params[-1] = ":" + params[-1]
+        self.send(" ".join([":" + SERVER_NAME, num, self.nick or "*"] + params))
+
+class Channel:
+    def __init__(self, name):
+        self.name = name
+        self.members = {} # Client: set of status modes
+        self.modes = {"n", "t"}
+        self.created = int(time.time())
+
+    def broadcast(self, line, exclude=None):
+        for member in self.members:
+            if member is not exclude:
+                member.send(line)
+
+    def status(self, client):
+        modes = self.members[client]
+        return "".join(symbol for mode, symbol in (("o", "@"), ("v", "+")) if mode in modes)
+
+class FakeIRCd:
+    """An in-process IRC server, good enough to run the bot against."""
+
+    def __init__(self, host="127.0.0.1", port=6667):
+        self.host = host
+        self.port = port
+        self.clients = {} # lowered nick: Client
+        self.channels = {} # lowered name: Channel
+        self.counter = 0
+        self.connections = set()
+        self.watchers = [] # callables getting (client, command, params) for every line
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    async def handle(self, reader, writer):
+        self.counter += 1
+        client = Client(self, writer, self.counter)
+        self.connections.add(client)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                client.lines_in += 1
+                tags, prefix, command, params = parse_message(line)
+                params = [decode(param) for param in params]
+                for watcher in self.watchers:
+                    watcher(client, command, params)
+                handler = getattr(self, "on_" + command, None)
+                if handler is None:
+                    if client.registered:
+                        client.numeric("421", command.upper(), "Unknown command")
+                    continue
+                handler(client, *params)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(client)
+            self.remove(client, "Connection closed")
+            writer.close()
+
+    async def stop(self):
+        self.server.close()
+        for client in list(self.connections):
+            client.writer.close()
+        await self.server.wait_closed()
+
+    def remove(self, client, reason):
+        if client.nick is None or self.clients.get(irc_lower(client.nick)) is not client:
+            return
+        line = ":{0} QUIT :{1}".format(client.prefix, reason)
+        seen = set()
+        for chan in client.channels:
+            for member in chan.members:
+                if member is not client and member not in seen:
+                    seen.add(member)
+                    member.send(line)
+            del chan.members[client]
+        client.channels.clear()
+        del self.clients[irc_lower(client.nick)]
+
+    def try_register(self, client):
+        if client.registered or client.negotiating or client.nick is None or client.ident is None:
+            return
+        client.registered = True
+        client.numeric("001", "Welcome to FakeNet {0}".format(client.prefix))
+        client.numeric("002", "Your host is {0}".format(SERVER_NAME))
+        client.numeric("003", "This server was created just now")
+        client.numeric("004", SERVER_NAME, "fakeircd", "iow", "bklmnostv")
+        client.send(":{0} 005 {1} {2} :are supported by this server".format(SERVER_NAME, client.nick, ISUPPORT))
+        client.numeric("375", "- {0} Message of the day -".format(SERVER_NAME))
+        client.numeric("372", "- This is a fake server for benchmarks.")
+        client.numeric("376", "End of /MOTD command.")
+
+    def find_channel(self, name):
+        return self.channels.get(irc_lower(name))
+
+    ### Registration
+
+    def on_cap(self, client, sub, *args):
+        sub = sub.upper()
+        if sub == "LS":
+            client.negotiating = True
+            client.send(":{0} CAP {1} LS :{2}".format(SERVER_NAME, client.nick or "*", " ".join(sorted(CAPS))))
+        elif sub == "REQ":
+            wanted = set(args[-1].split())
+            verb = "ACK" if wanted <= CAPS else "NAK"
+            if verb == "ACK":
+                client.caps |= wanted
+            client.send(":{0} CAP {1} {2} :{3}".format(SERVER_NAME, client.nick or "*", verb, args[-1]))
+        elif sub == "END":
+            client.negotiating = False
+            self.try_register(client)
+
+    def on_authenticate(self, client, data):
+        if data.upper() == "PLAIN":
+            client.send("AUTHENTICATE +")
+            return
+        try:
+            authzid, account, password = base64.b64decode(data).split(b"\0")
+        except ValueError:
+            client.numeric("904", "SASL authentication failed")
+            return
+        client.account = account.decode("utf-8")
+        client.numeric("900", client.prefix, client.account, "You are now logged in as {0}".format(client.account))
+        client.numeric("903", "SASL authentication successful")
+
+    def on_pass(self, client, *args):
+        pass
+
+    def on_nick(self, client, nick, *args):
+        other = self.clients.get(irc_lower(nick))
+        if other is not None and other is not client:
+            client.numeric("433", nick, "Nickname is already in use")
+            return
+        if client.nick is not None:
+            del self.clients[irc_lower(client.nick)]
+            if client.registered:
+                line = ":{0} NICK :{1}".format(client.prefix, nick)
+                targets = {client}
+                for chan in client.channels:
+                    targets.update(chan.members)
+                for target in targets:
+                    target.send(line)
+        client.nick = nick
+        self.clients[irc_lower(nick)] = client
+        self.try_register(client)
+
+    def on_user(self, client, ident, mode, unused, realname, *args):
+        client.ident = ident[:10]
+        client.realname = realname
+        self.try_register(client)
+
+    def on_ping(self, client, token, *args):
+        client.send(":{0} PONG {0} :{1}".format(SERVER_NAME, token))
+
+    def on_pong(self, client, *args):
+        pass
+
+    def on_quit(self, client, reason="", *args):
+        self.remove(client, "Quit: " + reason)
+        client.send("ERROR :Closing link")
+        client.writer.close()
+
+    ### Channels
+
+    def on_join(self, client, names, *keys):
+        for name in names.split(","):
+            chan = self.find_channel(name)
+            if chan is None:
+                chan = self.channels[irc_lower(name)] = Channel(name)
+            if client in chan.members:
+                continue
+            chan.members[client] = {"o"} if not chan.members else set()
+            client.channels.add(chan)
+
+            plain = ":{0} JOIN {1}".format(client.prefix, chan.name)
+            extended = "{0} {1} :{2}".format(plain, client.account or "*", client.realname)
+            for member in chan.members:
+                member.send(extended if "extended-join" in member.caps else plain)
+
+            names = ["{0}{1}".format(chan.status(member), member.nick) for member in chan.members]
+            client.numeric("353", "=", chan.name, " ".join(names))
+            client.numeric("366", chan.name, "End of /NAMES list.")
+
+    def _leave(self, chan, client):
+        del chan.members[client]
+        client.channels.discard(chan)
+        if not chan.members:
+            del self.channels[irc_lower(chan.name)]
+
+    def on_part(self, client, names, reason="", *args):
+        for name in names.split(","):
+            chan = self.find_channel(name)
+            if chan is None or client not in chan.members:
+                client.numeric("442", name, "You're not on that channel")
+                continue
+            chan.broadcast(":{0} PART {1} :{2}".format(client.prefix, chan.name, reason))
+            self._leave(chan, client)
+
+    def on_kick(self, client, name, nick, reason="", *args):
+        chan = self.find_channel(name)
+        target = self.clients.get(irc_lower(nick))
+        if chan is None or target not in chan.members:
+            client.numeric("441", nick, name, "They aren't on that channel")
+            return
+        chan.broadcast(":{0} KICK {1} {2} :{3}".format(client.prefix, chan.name, target.nick, reason))
+        self._leave(chan, target)
+
+    def on_mode(self, client, target, modes=None, *args):
+        chan = self.find_channel(target)
+        if chan is None:
+            if irc_lower(target) == irc_lower(client.nick or ""):
+                client.numeric("221", "+i")
+            else:
+                client.numeric("403", target, "No such channel")
+            return
+
+        if modes is None:
+            client.numeric("324", chan.name, "+" + "".join(sorted(chan.modes)))
+            client.numeric("329", chan.name, str(chan.created))
+            return
+
+        if modes[0] not in "+-": # list query, e.g. "MODE #chan b"
+            if "b" in modes:
+                client.numeric("368", chan.name, "End of Channel Ban List")
+            return
+
+        args = list(args)
+        applied, applied_args = [], []
+        sign = "+"
+        for char in modes:
+            if char in "+-":
+                sign = char
+                applied.append(char)
+                continue
+            if char in "ov":
+                if not args:
+                    continue
+                nick = args.pop(0)
+                member = self.clients.get(irc_lower(nick))
+                if member is None or member not in chan.members:
+                    continue
+                if sign == "+":
+                    chan.members[member].add(char)
+                else:
+                    chan.members[member].discard(char)
+                applied.append(char)
+                applied_args.append(member.nick)
+            elif char in "bkl":
+                if char == "b" or sign == "+" or char == "k":
+                    if not args:
+                        continue
+                    applied_args.append(args.pop(0))
+                applied.append(char)
+            else:
+                if sign == "+":
+                    chan.modes.add(char)
+                else:
+                    chan.modes.discard(char)
+                applied.append(char)
+
+        line = ":{0} MODE {1} {2}".format(client.prefix, chan.name, "".join(applied))
+        if applied_args:
+            line += " " + " ".join(applied_args)
+        chan.broadcast(line)
+
+    def on_who(self, client, mask, fields=None, *args):
+        chan = self.find_channel(mask)
+        if chan is not None:
+            entries = [(member, chan.name, chan.status(member)) for member in chan.members]
+        else:
+            other = self.clients.get(irc_lower(mask))
+            entries = [(other, "*", "")] if other is not None else []
+
+        whox, data = None, "0"
+        if fields is not None and fields.startswith("%"):
+            whox, _, data = fields[1:].partition(",")
+            data = data or "0"
+
+        for member, channame, status in entries:
+            if whox is None:
+                client.numeric("352", channame, member.ident, member.host, SERVER_NAME,
+                               member.nick, "H" + status, "0 " + member.realname)
+            else:
+                client.numeric("354", data, channame, member.ident, "127.0.0.1", member.host,
+                               SERVER_NAME, member.nick, "H" + status, "0", "0",
+                               member.account or "0", member.realname)
+        client.numeric("315", mask, "End of /WHO list.")
+
+    def on_topic(self, client, *args):
+        pass
+
+    ### Messages
+
+    def _message(self, client, command, targets, text):
+        line = ":{0} {1} {{0}} :{2}".format(client.prefix, command, text)
+        for target in targets.split(","):
+            name = target.lstrip("@+")
+            chan = self.find_channel(name)
+            if chan is not None:
+                chan.broadcast(line.format(target), exclude=client)
+                continue
+            other = self.clients.get(irc_lower(target))
+            if other is not None:
+                other.send(line.format(other.nick))
+            elif command == "PRIVMSG":
+                client.numeric("401", target, "No such nick/channel")
+
+    def on_privmsg(self, client, targets, text="", *args):
+        self._message(client, "PRIVMSG", targets, text)
+
+    def on_notice(self, client, targets, text="", *args):
+        self._message(client, "NOTICE", targets, text)
+
+class SwarmUser:
+    """One scripted user of the swarm."""
+
+    def __init__(self, swarm, nick):
+        self.swarm = swarm
+        self.nick = nick
+        self.pending = [] # send times of commands still waiting for a reply
+        self.writer = None
+
+    async def connect(self, host, port):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.send("NICK {0}".format(self.nick))
+        self.send("USER {0} 0 * :swarm user".format(self.nick))
+        self.send("JOIN {0}".format(self.swarm.channel))
+        asyncio.ensure_future(self.read(reader))
+
+    def send(self, line):
+        if not self.writer.is_closing():
+            self.writer.write(line.encode("utf-8") + b"\r\n")
+
+    def command(self, text, private=False):
+        self.pending.append(time.time())
+        self.swarm.commands += 1
+        if private:
+            self.send("PRIVMSG {0} :{1}".format(self.swarm.bot_nick, text))
+        else:
+            self.send("PRIVMSG {0} :{1}".format(self.swarm.channel, text))
+
+    def replied(self):
+        if self.pending:
+            self.swarm.latencies.append(time.time() - self.pending.pop(0))
+
+    async def read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            tags, prefix, command, params = parse_message(line)
+            if command not in ("privmsg", "notice") or prefix is None or len(params) < 2:
+                continue
+            nick = decode(prefix).split("!")[0]
+            if irc_lower(nick) != irc_lower(self.swarm.bot_nick):
+                continue
+            target, text = decode(params[0]), decode(params[1])
+            if irc_lower(target) == irc_lower(self.nick):
+                self.replied()
+            elif self.swarm.users[0] is self: # one user tracks the channel for everyone
+                self.swarm.channel_message(text)
+
+class Swarm:
+    """Drive N users through games and collect reply latencies."""
+
+    def __init__(self, users, channel, bot_nick, rate, reply_timeout):
+        self.channel = channel
+        self.bot_nick = bot_nick
+        self.rate = rate
+        self.reply_timeout = reply_timeout
+        self.users = [SwarmUser(self, "swarm{0}".format(i)) for i in range(users)]
+        self.latencies = []
+        self.unanswered = 0
+        self.commands = 0
+        self.games = 0
+        self.joined = set()
+        self.in_game = False
+        # (command, sent in private) pairs used during games
+        self.game_commands = [("!vote {0}", False), ("!lynch {0}", False), ("!stats", False),
+                              ("!time", False), ("kill {0}", True), ("see {0}", True),
+                              ("visit {0}", True), ("guard {0}", True)]
+
+    def channel_message(self, text):
+        lowered = irc_lower(text)
+        for user in self.users:
+            if irc_lower(user.nick) in lowered:
+                user.replied()
+                if "has joined the game" in text:
+                    self.joined.add(user)
+        if "Game lasted" in text:
+            self.games += 1
+            self.in_game = False
+            self.joined.clear()
+        elif "Welcome to Werewolf" in text or "Night lasted" in text or "It is now nighttime" in text:
+            self.in_game = True
+
+    def expire(self):
+        cutoff = time.time() - self.reply_timeout
+        for user in self.users:
+            while user.pending and user.pending[0] < cutoff:
+                user.pending.pop(0)
+                self.unanswered += 1
+
+    def step(self):
+        names = [user.nick for user in self.users]
+        if not self.in_game:
+            waiting = [user for user in self.users if user not in self.joined]
+            if waiting:
+                random.choice(waiting).command("!join")
+            else:
+                random.choice(self.users).command("!start")
+            return
+
+        text, private = random.choice(self.game_commands)
+        random.choice(self.users).command(text.format(random.choice(names)), private=private)
+
+    async def run(self, host, port, duration):
+        for user in self.users:
+            await user.connect(host, port)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(2)
+
+        start = time.time()
+        while time.time() - start < duration:
+            self.step()
+            self.expire()
+            await asyncio.sleep(1 / self.rate)
+        await asyncio.sleep(self.reply_timeout)
+        self.expire()
+        elapsed = time.time() - start
+
+        for user in self.users:
+            user.writer.close()
+        return elapsed
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--channel", default="##mywolfgame")
+    parser.add_argument("--bot-nick", default=None, help="defaults to botconfig.NICK")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=2, help="swarm commands per second")
+    parser.add_argument("--duration", type=float, default=120, help="seconds to run the swarm for")
+    parser.add_argument("--reply-timeout", type=float, default=10)
+    parser.add_argument("--bot", action="store_true", help="start ./wolfbot.py against the server")
+    parser.add_argument("--server-only", action="store_true", help="run the server without a swarm")
+    args = parser.parse_args()
+
+    bot_nick = args.bot_nick
+    if bot_nick is None:
+        try:
+            import botconfig
+            bot_nick = botconfig.NICK
+        except ImportError:
+            bot_nick = "mywolfbot"
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ircd = FakeIRCd(args.host, args.port)
+    loop.run_until_complete(ircd.start())
+    print("Fake IRC server listening on {0}:{1}".format(args.host, args.port))
+
+    bot_lines = [0]
+    def count_bot_lines(client, command, params):
+        if client.nick is not None and irc_lower(client.nick) == irc_lower(bot_nick):
+            bot_lines[0] += 1
+    ircd.watchers.append(count_bot_lines)
+
+    bot = None
+    if args.bot:
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        bot = subprocess.Popen([sys.executable, "wolfbot.py"], cwd=root)
+
+    try:
+        if args.server_only:
+            loop.run_forever()
+            return
+
+        deadline = time.time() + 60
+        while irc_lower(bot_nick) not in ircd.clients or ircd.find_channel(args.channel) is None:
+            if time.time() > deadline:
+                print("The bot did not join {0} within 60 seconds.".format(args.channel))
+                return
+            loop.run_until_complete(asyncio.sleep(0.5))
+        loop.run_until_complete(asyncio.sleep(5)) # let it finish syncing the channel
+
+        swarm = Swarm(args.users, args.channel, bot_nick, args.rate, args.reply_timeout)
+        bot_lines[0] = 0
+        elapsed = loop.run_until_complete(swarm.run(args.host, args.port, args.duration))
+
+        print("Ran for {0:.1f}s with {1} users, {2} games finished".format(elapsed, args.users, swarm.games))
+        print("Commands sent: {0} ({1:.2f}/s), replies: {2}, unanswered: {3}".format(
+            swarm.commands, swarm.commands / elapsed, len(swarm.latencies), swarm.unanswered))
+        print("Bot output: {0} lines ({1:.2f}/s)".format(bot_lines[0], bot_lines[0] / elapsed))
+        print("Reply latency: p50 {0:.3f}s, p99 {1:.3f}s, max {2:.3f}s".format(
+            percentile(swarm.latencies, 50), percentile(swarm.latencies, 99),
+            max(swarm.latencies) if swarm.latencies else float("nan")))
+    finally:
+        if bot is not None:
+            bot.terminate()
+            bot.wait()
+        loop.run_until_complete(ircd.stop())
+        loop.run_until_complete(asyncio.sleep(0.1)) # let the connection handlers see EOF
+        loop.close()
+
+if __name__ == "__main__":
+    main()
+
+# vim: set sw=4 expandtab:
@@ -46,9 +46,10 @@ except ImportError:
           "- The lykos developers"]))
     sys.exit(1)
 
-from oyoyo.client import IRCClient
+from oyoyo.client import IRCClient, AdaptiveTokenBucket
 
 import src
+import src.settings as var
 from src import handler
 from src.events import Event
 
@@ -70,10 +71,29 @@ def main():
                      sasl_auth=botconfig.SASL_AUTHENTICATION,
                      server_pass=botconfig.SERVER_PASS,
                      use_ssl=botconfig.USE_SSL,
+                     ssl_verify=getattr(botconfig, "SSL_VERIFY", True),
+                     use_asyncio=getattr(botconfig, "USE_ASYNCIO", False),
+                     tokenbucket=AdaptiveTokenBucket(var.FLOOD_CAPACITY, var.FLOOD_FILL_RATE,
+                                                     min_tokens=var.FLOOD_MIN_CAPACITY,
+                                                     max_tokens=var.FLOOD_MAX_CAPACITY,
+                                                     min_fill_rate=var.FLOOD_MIN_FILL_RATE,
+                                                     max_fill_rate=var.FLOOD_MAX_FILL_RATE),
                      connect_cb=handler.connect_callback,
+                     disconnect_cb=handler.disconnect_callback,
+                     reconnect=var.RECONNECT,
+                     reconnect_delay=var.RECONNECT_DELAY,
+                     reconnect_max_delay=var.RECONNECT_MAX_DELAY,
+                     read_timeout=var.SERVER_PING_INTERVAL * 2 if var.SERVER_PING_INTERVAL > 0 else None,
                      stream_handler=src.stream,
+                     stream_filter=src.stream_enabled,
+                     raw_history_size=getattr(botconfig, "RAW_HISTORY_SIZE", 0),
     )
-    cli.mainLoop()
+    try:
+        cli.mainLoop()
+    finally:
+        if cli.raw_history:
+            with open("rawlines.log", "ab") as f:
+                cli.dump_raw_history(f)
 
 
 if __name__ == "__main__":